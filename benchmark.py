@@ -0,0 +1,834 @@
+"""Offline benchmark for bot.py.
+
+Runs the real MusicPlayer, command handlers and MusicPlayerControls against a fake
+yt-dlp extractor and fake voice clients, so no Discord or YouTube connection is needed.
+
+    python benchmark.py --guilds 50 --queue-size 10000 --duration 30 --output run.json
+
+When ffmpeg is installed, tracks are real Opus files served over local HTTP, so ffmpeg
+CPU per stream is measured too; otherwise a frame generator stands in for ffmpeg.
+--source-codec aac serves AAC instead, so every stream is transcoded; compare runs with
+TRANSCODE_BITRATE=auto and TRANSCODE_BITRATE=256 to see what matching the bitrate saves.
+
+    python benchmark.py --gateway
+
+feeds a synthetic hour of chat, typing, reaction and voice events for 1,000 guilds
+through the default mode and LEAN_MODE, and reports events, cache sizes and memory.
+"""
+import argparse
+import asyncio
+import contextlib
+import datetime
+import hashlib
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+# Keep the benchmark independent of whatever the local .env configures
+os.environ.setdefault('RESOLVE_CACHE_DB', '')
+os.environ.setdefault('METRICS_PORT', '0')
+os.environ.setdefault('CLUSTER_WORKERS', '0')
+
+import discord
+from aiohttp import web
+
+import bot
+
+OPUS_SILENCE = b'\xf8\xff\xfe'
+FRAME_SECONDS = 0.02
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct))]
+
+
+def summarize(values):
+    """p50/p99/max in milliseconds"""
+    if not values:
+        return {'count': 0, 'p50_ms': None, 'p99_ms': None, 'max_ms': None}
+    return {
+        'count': len(values),
+        'p50_ms': round(percentile(values, 0.5) * 1000, 3),
+        'p99_ms': round(percentile(values, 0.99) * 1000, 3),
+        'max_ms': round(max(values) * 1000, 3),
+    }
+
+
+def rss_bytes():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+# ==================== FAKE EXTRACTOR ====================
+
+class FakeYoutubeDL:
+    """Stands in for yt_dlp.YoutubeDL, returning canned info dicts after an injected delay"""
+
+    media_url = None
+    media_codec = 'opus'
+    track_seconds = 5
+    latency = 0.2
+    jitter = 0.05
+    playlist_size = 200
+    calls = 0
+
+    def __init__(self, options=None):
+        self.options = options or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        pass
+
+    def get_info_extractor(self, ie_key):
+        return None
+
+    def _wait(self):
+        FakeYoutubeDL.calls += 1
+        time.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+
+    @classmethod
+    def info(cls, video_id, title=None):
+        return {
+            'id': video_id,
+            'title': title or f"Track {video_id}",
+            'duration': cls.track_seconds,
+            'thumbnail': '',
+            'url': cls.media_url or f"fake://{video_id}",
+            'extractor_key': 'Youtube',
+            'webpage_url': f"https://www.youtube.com/watch?v={video_id}",
+            'acodec': 'opus' if cls.media_codec == 'opus' else 'mp4a.40.2',
+            'asr': 48000 if cls.media_codec == 'opus' else 44100,
+            'audio_channels': 2,
+            'abr': 128,
+        }
+
+    def extract_info(self, query, download=False, process=True):
+        self._wait()
+        if 'list=' in query:
+            return {'_type': 'playlist', 'title': 'Benchmark playlist', 'entries': self._playlist(query)}
+        video_id = bot.extract_video_id(query)
+        if video_id:
+            return self.info(video_id)
+        prefix, _, text = query.partition(':')
+        video_id = hashlib.sha1(text.encode()).hexdigest()[:11]
+        if self.options.get('extract_flat'):
+            entry = {'_type': 'url', 'id': video_id, 'title': text, 'url': f"https://www.youtube.com/watch?v={video_id}"}
+        else:
+            entry = self.info(video_id, title=text)
+        return {'_type': 'playlist', 'entries': [entry]}
+
+    def _playlist(self, query):
+        for index in range(self.playlist_size):
+            video_id = hashlib.sha1(f"{query}#{index}".encode()).hexdigest()[:11]
+            yield {'_type': 'url', 'ie_key': 'Youtube', 'id': video_id, 'title': f"Playlist track {index}",
+                   'duration': self.track_seconds}
+
+
+class FakeOpusSource(discord.AudioSource):
+    """Opus silence frames for one track; used when ffmpeg is not installed"""
+
+    def __init__(self, seconds):
+        self.remaining = int(seconds / FRAME_SECONDS)
+
+    def read(self):
+        if self.remaining <= 0:
+            return b''
+        self.remaining -= 1
+        return OPUS_SILENCE
+
+    def is_opus(self):
+        return True
+
+
+# ==================== FAKE DISCORD ====================
+
+class FakeVoiceClient:
+    """Consumes frames from the playing source every 20 ms, like discord.py's AudioPlayer"""
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.source = None
+        self.frames = 0
+        self._connected = True
+        self._paused = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def is_connected(self):
+        return self._connected
+
+    def is_playing(self):
+        return self._thread is not None and self._thread.is_alive() and not self._paused.is_set()
+
+    def is_paused(self):
+        return self._thread is not None and self._thread.is_alive() and self._paused.is_set()
+
+    async def move_to(self, channel):
+        self.channel = channel
+
+    async def disconnect(self, force=False):
+        self.stop()
+        self._connected = False
+
+    def play(self, source, *, after=None, **kwargs):
+        if self.is_playing() or self.is_paused():
+            raise discord.ClientException('Already playing audio.')
+        self.source = source
+        self._stopped = threading.Event()
+        self._paused.clear()
+        self._thread = threading.Thread(target=self._run, args=(source, after, self._stopped), daemon=True)
+        self._thread.start()
+
+    def _run(self, source, after, stopped):
+        next_frame = time.perf_counter()
+        error = None
+        try:
+            while not stopped.is_set():
+                if self._paused.is_set():
+                    time.sleep(FRAME_SECONDS)
+                    next_frame = time.perf_counter()
+                    continue
+                if not source.read():
+                    break
+                self.frames += 1
+                next_frame += FRAME_SECONDS
+                time.sleep(max(0.0, next_frame - time.perf_counter()))
+        except Exception as e:
+            error = e
+        finally:
+            source.cleanup()
+        if after is not None:
+            after(error)
+
+    def pause(self):
+        self._paused.set()
+
+    def resume(self):
+        self._paused.clear()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=1)
+
+
+class FakeVoiceChannel:
+    def __init__(self, guild_id):
+        self.id = guild_id * 10
+        self.name = f"voice-{guild_id}"
+        self.bitrate = 64000
+
+    async def connect(self, **kwargs):
+        return FakeVoiceClient(self)
+
+
+class FakeMember:
+    def __init__(self, member_id, channel):
+        self.id = member_id
+        self.voice = type('VoiceState', (), {'channel': channel})()
+
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.name = f"guild-{guild_id}"
+
+
+class Timing:
+    """Records when a fake command first answered and when it last touched its reply"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.first = None
+        self.last = None
+
+    def mark(self):
+        now = time.perf_counter()
+        if self.first is None:
+            self.first = now
+        self.last = now
+
+
+class FakeMessage:
+    ids = iter(range(1, 10 ** 12))
+
+    def __init__(self, timing, channel, message_id=None):
+        self.timing = timing
+        self.channel = channel
+        self.id = message_id or next(self.ids)
+
+    async def edit(self, **kwargs):
+        self.timing.mark()
+        return self
+
+
+class FakeTextChannel:
+    def __init__(self, guild_id):
+        self.id = guild_id * 10 + 1
+
+    async def send(self, content=None, **kwargs):
+        return FakeMessage(Timing(), self)
+
+    def get_partial_message(self, message_id):
+        # Panel edits happen later; keep them out of the command's reply timing
+        return FakeMessage(Timing(), self, message_id)
+
+
+class FakeContext:
+    """Enough of commands.Context for the prefix command handlers"""
+
+    def __init__(self, guild_id, member):
+        self.guild = FakeGuild(guild_id)
+        self.channel = FakeTextChannel(guild_id)
+        self.author = member
+        self.timing = Timing()
+
+    async def send(self, content=None, **kwargs):
+        self.timing.mark()
+        return FakeMessage(self.timing, self.channel)
+
+
+class FakeResponse:
+    def __init__(self, timing):
+        self.timing = timing
+        self._done = False
+
+    def is_done(self):
+        return self._done
+
+    async def defer(self, **kwargs):
+        self._done = True
+        self.timing.mark()
+
+    async def send_message(self, content=None, **kwargs):
+        self._done = True
+        self.timing.mark()
+
+    async def edit_message(self, **kwargs):
+        self._done = True
+        self.timing.mark()
+
+
+class FakeFollowup:
+    def __init__(self, timing, channel):
+        self.timing = timing
+        self.channel = channel
+
+    async def send(self, content=None, **kwargs):
+        self.timing.mark()
+        return FakeMessage(self.timing, self.channel)
+
+
+class FakeInteraction:
+    """Enough of discord.Interaction for the slash command and button handlers"""
+
+    def __init__(self, guild_id, member):
+        self.guild = FakeGuild(guild_id)
+        self.guild_id = guild_id
+        self.channel = FakeTextChannel(guild_id)
+        self.message = None
+        self.user = member
+        self.created_at = discord.utils.utcnow()
+        self.timing = Timing()
+        self.response = FakeResponse(self.timing)
+        self.followup = FakeFollowup(self.timing, self.channel)
+
+    def is_expired(self):
+        return discord.utils.utcnow() - self.created_at > datetime.timedelta(minutes=15)
+
+
+# ==================== BENCHMARK ====================
+
+class Benchmark:
+    def __init__(self, args):
+        self.args = args
+        self.members = {}
+        self.latencies = {}  # command -> {'first': [...], 'complete': [...]}
+        self.errors = 0
+
+    def member(self, guild_id):
+        if guild_id not in self.members:
+            self.members[guild_id] = FakeMember(guild_id * 100, FakeVoiceChannel(guild_id))
+        return self.members[guild_id]
+
+    async def run_command(self, name, handler, target, *args, **kwargs):
+        try:
+            await handler(target, *args, **kwargs)
+        except Exception as e:
+            self.errors += 1
+            print(f"{name} failed: {e!r}", file=sys.stderr)
+        timing = target.timing
+        bucket = self.latencies.setdefault(name, {'first': [], 'complete': []})
+        if timing.first is not None:
+            bucket['first'].append(timing.first - timing.started)
+            bucket['complete'].append(timing.last - timing.started)
+
+    def prefix(self, name):
+        return bot.bot.get_command(name).callback
+
+    def slash(self, name):
+        return bot.tree.get_command(name).callback
+
+    async def burst(self):
+        """Fire concurrent /play and !play commands at every guild"""
+        jobs = []
+        for guild_id in range(1, self.args.guilds + 1):
+            for index in range(self.args.burst):
+                query = f"benchmark song {guild_id}-{index}"
+                if index % 2:
+                    ctx = FakeContext(guild_id, self.member(guild_id))
+                    jobs.append(self.run_command('!play', self.prefix('play'), ctx, query=query))
+                else:
+                    interaction = FakeInteraction(guild_id, self.member(guild_id))
+                    jobs.append(self.run_command('/play', self.slash('play'), interaction, query))
+        started = time.perf_counter()
+        await asyncio.gather(*jobs)
+        return time.perf_counter() - started
+
+    async def playlists(self):
+        jobs = []
+        for guild_id in range(1, min(self.args.guilds, self.args.playlist_guilds) + 1):
+            interaction = FakeInteraction(guild_id, self.member(guild_id))
+            url = f"https://www.youtube.com/playlist?list=PLbench{guild_id}"
+            jobs.append(self.run_command('/play playlist', self.slash('play'), interaction, url))
+        await asyncio.gather(*jobs)
+
+    def fill_queues(self):
+        """Grow every guild's queue to queue_size and measure memory per guild"""
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        added = 0
+        for guild_id in range(1, self.args.guilds + 1):
+            player = bot.players.peek(guild_id)
+            while len(player.queue) < self.args.queue_size:
+                index = len(player.queue)
+                video_id = hashlib.sha1(f"{guild_id}/{index}".encode()).hexdigest()[:11]
+                try:
+                    player.queue.append(bot.Track(video_id, f"Queued track {index}", FakeYoutubeDL.track_seconds,
+                                                  requester=guild_id * 100))
+                except bot.QueueFull:
+                    break
+                added += 1
+        traced = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        return {
+            'tracks_added': added,
+            'queue_bytes_per_guild': traced // max(1, self.args.guilds),
+            'bytes_per_track': traced // max(1, added),
+        }
+
+    async def queue_commands(self):
+        """Queue browsing and editing on long queues"""
+        for guild_id in range(1, self.args.guilds + 1):
+            member = self.member(guild_id)
+            pages = max(1, self.args.queue_size // bot.QUEUE_PAGE_SIZE)
+            await self.run_command('!queue', self.prefix('queue'), FakeContext(guild_id, member), page=pages // 2)
+            await self.run_command('/queue', self.slash('queue'), FakeInteraction(guild_id, member), pages)
+            await self.run_command('!move', self.prefix('move'), FakeContext(guild_id, member),
+                                   self.args.queue_size // 2, 1)
+            await self.run_command('!remove', self.prefix('remove'), FakeContext(guild_id, member),
+                                   self.args.queue_size // 3)
+            await self.run_command('!shuffle', self.prefix('shuffle'), FakeContext(guild_id, member))
+
+    async def press(self, guild_id, button):
+        player = bot.players.peek(guild_id)
+        view = bot.MusicPlayerControls(player)
+        await view.update_buttons()
+        item = getattr(view, button)
+        await self.run_command(f"button {item.label.lower()}", item.callback, FakeInteraction(guild_id, self.member(guild_id)))
+
+    async def playback(self):
+        """Let every guild play, pressing control buttons along the way"""
+        clients = [bot.players.peek(guild_id).voice_client for guild_id in range(1, self.args.guilds + 1)]
+        frames_before = sum(client.frames for client in clients if client)
+        cpu_before = time.process_time()
+        started = time.perf_counter()
+        deadline = started + self.args.duration
+        while time.perf_counter() < deadline:
+            await asyncio.sleep(self.args.press_every)
+            guild_id = random.randint(1, self.args.guilds)
+            await self.press(guild_id, random.choice(['next_button', 'play_pause_button']))
+            # Leave paused guilds paused for at most one round
+            for guild_id, client in enumerate(clients, start=1):
+                if client and client.is_paused():
+                    bot.players.peek(guild_id).resume()
+        wall = time.perf_counter() - started
+        stream_seconds = (sum(client.frames for client in clients if client) - frames_before) * FRAME_SECONDS
+        cpu = time.process_time() - cpu_before
+        return {
+            'wall_seconds': round(wall, 3),
+            'stream_seconds': round(stream_seconds, 3),
+            'average_live_streams': round(stream_seconds / wall, 2) if wall else 0,
+            'bot_cpu_per_stream': round(cpu / stream_seconds, 5) if stream_seconds else None,
+        }
+
+    async def pause_resume(self, guild_id=1, pause_seconds=1.0):
+        """Pause a song past the ffmpeg idle kill, resume it, and check it carries on from the same stream"""
+        player = bot.players.peek(guild_id)
+        client = player.voice_client if player else None
+        if not client or not client.is_playing() or not isinstance(client.source, bot.PlaybackEngine):
+            return None
+        engine = client.source
+        current, switches = engine.current, engine.switches
+        ffmpeg = bot.tracked_ffmpeg(current)
+        supervisor = bot.ffmpeg_supervisor
+        player.pause()
+        # A short idle kill stands in for a long pause; playing guilds read every 20 ms, so only this one is idle
+        idle_kill, supervisor.idle_kill = supervisor.idle_kill, pause_seconds / 2
+        try:
+            await asyncio.sleep(pause_seconds)
+            await asyncio.get_running_loop().run_in_executor(None, supervisor.sample)
+        finally:
+            supervisor.idle_kill = idle_kill
+        killed = ffmpeg is not None and ffmpeg._process.poll() is not None
+        player.resume()
+        frames = client.frames
+        await asyncio.sleep(0.5)
+        result = {
+            'ffmpeg': ffmpeg is not None,
+            'killed': killed,
+            # A stream that died while paused is reopened by recovery, which swaps the engine's source
+            'recovered': engine.switches == switches and engine.current is not current,
+            'frames_after_resume': client.frames - frames,
+        }
+        if result['killed'] or result['recovered'] or not result['frames_after_resume']:
+            self.errors += 1
+            print(f"pause/resume failed: {result}", file=sys.stderr)
+        return result
+
+
+async def serve_media(path):
+    """Serve the benchmark track over HTTP so ffmpeg reads it like a real stream"""
+    app = web.Application()
+    name = os.path.basename(path)
+    app.router.add_get(f'/{name}', lambda request: web.FileResponse(path))
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}/{name}"
+
+
+def make_media(directory, seconds, codec='opus'):
+    """A 128 kbps test track: Opus (played with passthrough) or AAC (transcoded)"""
+    if codec == 'opus':
+        path, encoder, rate = os.path.join(directory, 'track.webm'), 'libopus', '48000'
+    else:
+        path, encoder, rate = os.path.join(directory, 'track.m4a'), 'aac', '44100'
+    subprocess.run(
+        ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-f', 'lavfi', '-i', f"sine=frequency=440:duration={seconds}",
+         '-c:a', encoder, '-b:a', '128k', '-ar', rate, '-ac', '2', '-y', path],
+        check=True
+    )
+    return path
+
+
+async def main(args):
+    random.seed(args.seed)
+    FakeYoutubeDL.latency = args.extract_ms / 1000
+    FakeYoutubeDL.jitter = args.extract_jitter_ms / 1000
+    FakeYoutubeDL.track_seconds = args.track_seconds
+    FakeYoutubeDL.playlist_size = args.playlist_size
+    FakeYoutubeDL.media_codec = args.source_codec
+    bot.load_yt_dlp().YoutubeDL = FakeYoutubeDL
+
+    use_ffmpeg = not args.no_ffmpeg and shutil.which('ffmpeg') is not None
+    media_runner = None
+    tempdir = tempfile.TemporaryDirectory()
+    if use_ffmpeg:
+        media_runner, FakeYoutubeDL.media_url = await serve_media(
+            make_media(tempdir.name, args.track_seconds, args.source_codec)
+        )
+    else:
+        bot.MusicPlayer.get_audio_source = lambda player, url, *rest, **options: FakeOpusSource(args.track_seconds)
+
+    result = {
+        'config': {**vars(args), 'ffmpeg': use_ffmpeg, 'python': sys.version.split()[0],
+                   'gapless': bot.GAPLESS, 'opus_passthrough': bot.OPUS_PASSTHROUGH,
+                   'resolver_workers': bot.RESOLVER_WORKERS, 'transcode_bitrate': bot.TRANSCODE_BITRATE,
+                   'voice_channel_bitrate': FakeVoiceChannel(0).bitrate},
+        'started_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+    }
+    bench = Benchmark(args)
+    rss_start = rss_bytes()
+    async with bot.bot:
+        await bot.bot.setup_hook()
+        bot.players.max_players = max(bot.players.max_players, args.guilds)
+        bot.PlaybackEngine.stats['gaps'].clear()
+
+        print(f"Burst: {args.guilds} guilds x {args.burst} concurrent /play and !play", file=sys.stderr)
+        result['burst_seconds'] = round(await bench.burst(), 3)
+        if args.playlist_guilds:
+            print(f"Playlists: {min(args.guilds, args.playlist_guilds)} guilds", file=sys.stderr)
+            await bench.playlists()
+        rss_players = rss_bytes()
+
+        print(f"Queues: filling to {args.queue_size} tracks", file=sys.stderr)
+        result['memory'] = bench.fill_queues()
+        await bench.queue_commands()
+        result['memory']['rss_per_guild'] = (rss_bytes() - rss_start) // max(1, args.guilds)
+        result['memory']['rss_per_guild_before_fill'] = (rss_players - rss_start) // max(1, args.guilds)
+        # Filling queues blocks the loop on purpose; let the watchdog see it end, then start counting
+        await asyncio.sleep(max(0.2, bot.loop_watchdog.interval * 2))
+        bot.LoopWatchdog.stats.update(stalls=0, longest=0.0)
+
+        print(f"Playback: {args.duration}s", file=sys.stderr)
+        result['playback'] = await bench.playback()
+        print("Pause: past the ffmpeg idle kill, then resume", file=sys.stderr)
+        result['pause_resume'] = await bench.pause_resume()
+        result['playback']['ffmpeg_cpu_per_stream'] = {
+            mode: round(bot.TrackedFFmpegMixin.cpu_per_stream(mode), 5) for mode in bot.TrackedFFmpegMixin.stats
+        } if use_ffmpeg else None
+        # Streams one core can sustain, per mode that actually ran
+        result['playback']['ffmpeg_streams_per_core'] = {
+            mode: round(1 / cpu, 1) for mode, cpu in result['playback']['ffmpeg_cpu_per_stream'].items() if cpu
+        } if use_ffmpeg else None
+        if use_ffmpeg:
+            # Memory of the ffmpeg processes still running, as the supervisor sees it
+            bot.ffmpeg_supervisor.sample()
+            result['playback']['ffmpeg_rss_per_stream_mb'] = {
+                mode: round(rss / count / 1024 / 1024, 1)
+                for mode, (count, _, rss) in bot.ffmpeg_supervisor.usage().items() if count
+            }
+        result['supervisor'] = dict(bot.FFmpegSupervisor.stats)
+
+        engine = bot.PlaybackEngine.stats
+        gaps = list(engine['gaps'])
+        result['transitions'] = {'gapless': engine['gapless'], 'fallback': engine['fallback'], 'gap': summarize(gaps)}
+        result['panel'] = dict(bot.NowPlayingPanel.stats)
+        recovery = bot.MusicPlayer.stats
+        result['recovery'] = {
+            'failures': recovery['recoveries'], 'resumed': recovery['recovered'],
+            'gave_up': recovery['recovery_failed'], 'resume': summarize(list(recovery['recovery_seconds'])),
+        }
+        result['time_to_first_audio'] = {
+            'ttfa': summarize(list(bot.tracer.stats['ttfa'])),
+            'outcomes': dict(bot.tracer.stats['outcomes']),
+            'spans': {name: summarize(list(values)) for name, values in sorted(bot.tracer.stats['spans'].items())},
+        }
+        result['commands'] = {
+            name: {'first_response': summarize(bucket['first']), 'complete': summarize(bucket['complete'])}
+            for name, bucket in sorted(bench.latencies.items())
+        }
+        result['loop'] = {
+            'stalls': bot.LoopWatchdog.stats['stalls'],
+            'longest_stall_ms': round(bot.LoopWatchdog.stats['longest'] * 1000, 3),
+        }
+        result['resolver'] = {
+            'extractor_calls': FakeYoutubeDL.calls,
+            'cache_hit_rate': round(bot.resolve_cache.hit_rate(), 4),
+        }
+        result['errors'] = bench.errors
+
+        await bot.players.evict_all()
+    bot.resolver.shutdown()
+    if media_runner is not None:
+        await media_runner.cleanup()
+    tempdir.cleanup()
+    return result
+
+
+# ==================== GATEWAY ====================
+
+GATEWAY_BOT_ID = 1
+GATEWAY_JOINED = '2024-01-01T00:00:00+00:00'
+# Which intent each simulated dispatch needs; events the mode did not ask for are never sent by Discord
+GATEWAY_EVENTS = {
+    'MESSAGE_CREATE': 'guild_messages',
+    'TYPING_START': 'guild_typing',
+    'MESSAGE_REACTION_ADD': 'guild_reactions',
+    'VOICE_STATE_UPDATE': 'voice_states',
+}
+
+
+def fake_user(user_id):
+    return {'id': str(user_id), 'username': f'user{user_id}', 'discriminator': '0', 'global_name': None,
+            'avatar': None, 'public_flags': 0}
+
+
+def fake_member(user_id=None):
+    member = {'roles': [], 'joined_at': GATEWAY_JOINED, 'deaf': False, 'mute': False, 'flags': 0}
+    if user_id is not None:
+        member['user'] = fake_user(user_id)
+    return member
+
+
+def fake_voice_state(guild_id, user_id, channel_id):
+    return {'guild_id': str(guild_id), 'user_id': str(user_id), 'channel_id': channel_id and str(channel_id), 'session_id': 'x',
+            'deaf': False, 'mute': False, 'self_deaf': False, 'self_mute': False, 'self_video': False,
+            'suppress': False, 'request_to_speak_timestamp': None, 'member': fake_member(user_id)}
+
+
+def fake_guild(guild_id):
+    """A GUILD_CREATE payload: 10 text and 3 voice channels, 10 roles, 3 members in voice"""
+    base = guild_id * 1000
+    channels = [{'id': str(base + i), 'type': 0, 'name': f'text-{i}', 'position': i,
+                 'permission_overwrites': [], 'flags': 0} for i in range(1, 11)]
+    channels += [{'id': str(base + 100 + i), 'type': 2, 'name': f'voice-{i}', 'position': i, 'bitrate': 64000,
+                  'user_limit': 0, 'permission_overwrites': [], 'flags': 0} for i in range(3)]
+    roles = [{'id': str(guild_id if i == 0 else base + 200 + i), 'name': f'role-{i}', 'permissions': '0',
+              'position': i, 'color': 0, 'hoist': False, 'managed': False, 'mentionable': False, 'flags': 0}
+             for i in range(10)]
+    listeners = [base + 500 + i for i in range(3)]
+    return {
+        'id': str(guild_id), 'name': f'guild-{guild_id}', 'icon': None, 'owner_id': str(base + 999),
+        'channels': channels, 'roles': roles, 'emojis': [], 'stickers': [], 'threads': [],
+        'stage_instances': [], 'guild_scheduled_events': [], 'presences': [], 'features': [],
+        'members': [fake_member(GATEWAY_BOT_ID)] + [fake_member(user_id) for user_id in listeners],
+        'voice_states': [fake_voice_state(guild_id, user_id, base + 100) for user_id in listeners],
+        'member_count': 500, 'large': False, 'unavailable': False, 'joined_at': GATEWAY_JOINED, 'flags': 0,
+        'premium_tier': 0, 'afk_timeout': 300, 'verification_level': 0, 'default_message_notifications': 0,
+        'explicit_content_filter': 0, 'mfa_level': 0, 'nsfw_level': 0, 'preferred_locale': 'en-US',
+        'system_channel_flags': 0,
+    }
+
+
+def fake_event(event, guild_id, rng, message_ids):
+    """One dispatch payload from a random chatter in the guild's first text channel"""
+    user_id = 10 ** 6 + rng.randrange(100000)
+    channel_id = str(guild_id * 1000 + 1)
+    if event == 'MESSAGE_CREATE':
+        message_ids.append(10 ** 15 + len(message_ids))
+        return {'id': str(message_ids[-1]), 'channel_id': channel_id, 'guild_id': str(guild_id),
+                'author': fake_user(user_id), 'member': fake_member(), 'content': "has anyone seen the new episode?",
+                'timestamp': GATEWAY_JOINED, 'edited_timestamp': None, 'tts': False, 'mention_everyone': False,
+                'mentions': [], 'mention_roles': [], 'attachments': [], 'embeds': [], 'pinned': False,
+                'type': 0, 'flags': 0}
+    if event == 'TYPING_START':
+        return {'channel_id': channel_id, 'guild_id': str(guild_id), 'user_id': str(user_id),
+                'timestamp': 1700000000, 'member': fake_member(user_id)}
+    if event == 'MESSAGE_REACTION_ADD':
+        message_id = rng.choice(message_ids) if message_ids else 10 ** 15
+        return {'user_id': str(user_id), 'channel_id': channel_id, 'message_id': str(message_id),
+                'guild_id': str(guild_id), 'emoji': {'id': None, 'name': '👍'}, 'member': fake_member(user_id),
+                'burst': False, 'type': 0}
+    # Somebody joins or leaves the second voice channel
+    channel = guild_id * 1000 + 101 if rng.random() < 0.5 else None
+    return fake_voice_state(guild_id, user_id, channel)
+
+
+async def gateway_probe(args):
+    """Feed one simulated hour of gateway traffic through this process's bot, in whatever LEAN_MODE it started"""
+    rng = random.Random(args.seed)
+    rates = {'MESSAGE_CREATE': args.messages_per_hour, 'TYPING_START': args.typing_per_hour,
+             'MESSAGE_REACTION_ADD': args.reactions_per_hour, 'VOICE_STATE_UPDATE': args.voice_per_hour}
+    async with bot.bot:
+        await bot.bot.setup_hook()
+        state = bot.bot._connection
+        state.user = discord.ClientUser(state=state, data=fake_user(GATEWAY_BOT_ID))
+        parsers = state.parsers
+        start_rss = rss_bytes()
+        start_cpu = time.process_time()
+        for guild_id in range(1, args.gateway_guilds + 1):
+            parsers['GUILD_CREATE'](fake_guild(guild_id))
+        guilds_rss = rss_bytes()
+
+        sent = [event for event, rate in rates.items() if getattr(bot.bot.intents, GATEWAY_EVENTS[event])
+                for _ in range(int(rate * args.gateway_guilds))]
+        rng.shuffle(sent)
+        message_ids = []
+        for i, event in enumerate(sent):
+            parsers[event](fake_event(event, rng.randint(1, args.gateway_guilds), rng, message_ids))
+            if i % 1000 == 0:
+                await asyncio.sleep(0)  # let listener tasks run, as they would between socket reads
+        await asyncio.sleep(0.1)
+        end_rss = rss_bytes()
+        cpu = time.process_time() - start_cpu
+
+        per_thousand = 1000 / args.gateway_guilds
+        return {
+            'mode': 'lean' if bot.LEAN_MODE else 'default',
+            'intents': sorted(name for name, enabled in bot.bot.intents if enabled),
+            'guilds': len(bot.bot.guilds),
+            'prefix_commands': sorted(command.name for command in bot.bot.commands),
+            'events_per_hour': dict(bot.gateway_monitor.events),
+            'events_per_hour_per_1000_guilds': round(
+                sum(count for event, count in bot.gateway_monitor.events.items() if event != 'GUILD_CREATE')
+                * per_thousand),
+            'cached_messages': len(bot.bot.cached_messages),
+            'cached_users': len(bot.bot.users),
+            'guild_cache_mb_per_1000_guilds': round((guilds_rss - start_rss) * per_thousand / 1024 / 1024, 2),
+            'rss_growth_mb_per_1000_guilds': round((end_rss - start_rss) * per_thousand / 1024 / 1024, 2),
+            'rss_mb': round(end_rss / 1024 / 1024, 1),
+            'cpu_seconds_per_1000_guilds': round(cpu * per_thousand, 3),
+        }
+
+
+def gateway_compare(args):
+    """Run the probe once per mode in a fresh process; LEAN_MODE is read at import time"""
+    result = {'simulated_hour': {'guilds': args.gateway_guilds, 'messages_per_guild': args.messages_per_hour,
+                                 'typing_per_guild': args.typing_per_hour,
+                                 'reactions_per_guild': args.reactions_per_hour,
+                                 'voice_updates_per_guild': args.voice_per_hour}}
+    for mode in ('default', 'lean'):
+        command = [sys.executable, os.path.abspath(__file__), '--gateway-probe',
+                   '--gateway-guilds', str(args.gateway_guilds), '--seed', str(args.seed),
+                   '--messages-per-hour', str(args.messages_per_hour), '--typing-per-hour', str(args.typing_per_hour),
+                   '--reactions-per-hour', str(args.reactions_per_hour), '--voice-per-hour', str(args.voice_per_hour)]
+        env = {**os.environ, 'LEAN_MODE': 'true' if mode == 'lean' else 'false'}
+        completed = subprocess.run(command, env=env, capture_output=True, text=True, check=True)
+        result[mode] = json.loads(completed.stdout)
+    return result
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark for the music bot")
+    parser.add_argument('--guilds', type=int, default=50, help="guilds to simulate")
+    parser.add_argument('--burst', type=int, default=4, help="concurrent play commands per guild")
+    parser.add_argument('--queue-size', type=int, default=10000, help="tracks queued per guild")
+    parser.add_argument('--playlist-guilds', type=int, default=5, help="guilds that also load a playlist")
+    parser.add_argument('--playlist-size', type=int, default=200, help="tracks per fake playlist")
+    parser.add_argument('--track-seconds', type=float, default=5.0, help="length of every fake track")
+    parser.add_argument('--duration', type=float, default=20.0, help="seconds of playback to measure")
+    parser.add_argument('--press-every', type=float, default=0.5, help="seconds between control button presses")
+    parser.add_argument('--extract-ms', type=float, default=200.0, help="mean fake extractor latency")
+    parser.add_argument('--extract-jitter-ms', type=float, default=50.0, help="fake extractor latency jitter")
+    parser.add_argument('--no-ffmpeg', action='store_true', help="use generated frames even if ffmpeg is installed")
+    parser.add_argument('--source-codec', choices=['opus', 'aac'], default='opus',
+                        help="codec of the served track; aac forces a transcode")
+    parser.add_argument('--gateway', action='store_true',
+                        help="compare gateway events and memory of the default and lean modes instead")
+    parser.add_argument('--gateway-probe', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--gateway-guilds', type=int, default=1000, help="guilds for --gateway")
+    parser.add_argument('--messages-per-hour', type=float, default=60, help="messages per guild per hour")
+    parser.add_argument('--typing-per-hour', type=float, default=40, help="typing indicators per guild per hour")
+    parser.add_argument('--reactions-per-hour', type=float, default=15, help="reactions per guild per hour")
+    parser.add_argument('--voice-per-hour', type=float, default=6, help="voice joins and leaves per guild per hour")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="write JSON here instead of stdout")
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    # The bot logs with print(); keep stdout for the JSON result
+    with contextlib.redirect_stdout(sys.stderr):
+        if args.gateway:
+            result = gateway_compare(args)
+        elif args.gateway_probe:
+            result = asyncio.run(gateway_probe(args))
+        else:
+            result = asyncio.run(main(args))
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+        print(f"Wrote {args.output}", file=sys.stderr)
+    else:
+        print(output)
@@ -1,10 +1,40 @@
+import time
+STARTED_AT = time.monotonic()  # startup phases are timed from here, before the heavy imports
 import discord
+from discord import app_commands
 from discord.ext import commands
-import yt_dlp
 import asyncio
+import bisect
+import concurrent.futures
+import contextlib
+import datetime
+import difflib
+import hashlib
+import heapq
+import io
+import json
+import math
+import multiprocessing
+import multiprocessing.connection
 import os
+import random
+import re
+import signal
+import sqlite3
+import subprocess
+import sys
+import threading
+import traceback
+import urllib.parse
+import urllib.request
+import weakref
+from array import array
+from collections import OrderedDict, deque
+from itertools import islice, takewhile
 from dotenv import load_dotenv
 
+yt_dlp = None  # imported on first use, see load_yt_dlp()
+
 # Load environment variables
 load_dotenv()
 
@@ -12,9 +42,14 @@ load_dotenv()
 TOKEN = os.getenv('DISCORD_TOKEN')
 PREFIX = os.getenv('DISCORD_PREFIX', '!')
 
+# Send Opus streams to Discord without re-encoding them (remux only)
+OPUS_PASSTHROUGH = os.getenv('OPUS_PASSTHROUGH', 'true').lower() in ('1', 'true', 'yes')
+
 # yt-dlp options for high-quality audio streaming
 YDL_OPTIONS = {
-    'format': 'bestaudio[ext=m4a]/bestaudio[ext=webm]/bestaudio/best',
+    # Prefer 48 kHz Opus when passthrough is on so most streams skip the transcode
+    'format': ('bestaudio[acodec=opus][asr=48000]/' if OPUS_PASSTHROUGH else '')
+              + 'bestaudio[ext=m4a]/bestaudio[ext=webm]/bestaudio/best',
     'noplaylist': True,
     'nocheckcertificate': True,
     'ignoreerrors': False,
@@ -29,277 +64,4634 @@ YDL_OPTIONS = {
     'prefer_ffmpeg': True,
 }
 
-# FFmpeg options optimized for stability
+# yt-dlp options for listing playlists and albums without resolving every entry
+PLAYLIST_YDL_OPTIONS = {
+    **YDL_OPTIONS,
+    'noplaylist': False,
+    'extract_flat': 'in_playlist',
+    'lazy_playlist': True,
+}
+
+# FFmpeg options optimized for stability (the encoder bitrate is chosen per stream, see choose_bitrate)
 FFMPEG_OPTIONS = {
     'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5',
-    'options': '-vn -b:a 256k -ar 48000 -ac 2 -bufsize 512k'
+    'options': '-vn'
 }
 
-intents = discord.Intents.default()
-intents.message_content = True
-intents.voice_states = True
+# Transcode bitrate: 'auto' matches the voice channel's bitrate, capped at the source's; or a fixed kbps
+TRANSCODE_BITRATE = os.getenv('TRANSCODE_BITRATE', 'auto')
+OPUS_COMPLEXITY = os.getenv('OPUS_COMPLEXITY', 'auto')  # libopus complexity 0-10; 'auto' scales it with the bitrate
 
-# Disable default help command so we can use our custom one
-bot = commands.Bot(command_prefix=PREFIX, intents=intents, help_command=None)
-tree = bot.tree  # Slash command tree
+# FFmpeg options for Opus passthrough (codec copy, no decode/encode)
+FFMPEG_PASSTHROUGH_OPTIONS = {
+    'before_options': FFMPEG_OPTIONS['before_options'],
+    'options': '-vn'
+}
 
+# ffmpeg supervisor (caps, degrades and accounts for every ffmpeg child process)
+FFMPEG_MAX_PROCESSES = int(os.getenv('FFMPEG_MAX_PROCESSES', '0'))  # 0 = no cap; beyond it new players wait for a slot
+FFMPEG_ADMIT_WAIT = float(os.getenv('FFMPEG_ADMIT_WAIT', '10'))  # seconds a new player waits for a slot before /play is refused
+FFMPEG_MAX_TRANSCODES = os.getenv('FFMPEG_MAX_TRANSCODES', 'auto')  # full-quality transcodes; 'auto' sizes it from measured CPU, 0 = no cap
+FFMPEG_CPU_HIGH = float(os.getenv('FFMPEG_CPU_HIGH', '0.85'))  # host CPU share above which new transcodes are degraded
+FFMPEG_DEGRADED_BITRATE = int(os.getenv('FFMPEG_DEGRADED_BITRATE', '64'))  # kbps for transcodes started while saturated
+FFMPEG_IDLE_KILL = float(os.getenv('FFMPEG_IDLE_KILL', '900'))  # seconds unread before an ffmpeg process is killed
+FFMPEG_SAMPLE_INTERVAL = float(os.getenv('FFMPEG_SAMPLE_INTERVAL', '5'))  # seconds between /proc samples
 
-class MusicPlayer:
-    def __init__(self):
-        self.queue = []
-        self.current = None
-        self.voice_client = None
-        self.is_playing = False
-        self.is_paused = False
-        self.control_view = None  # Store the current control view
+# Resolver pool settings (yt-dlp extraction runs off the event loop)
+RESOLVER_MODE = os.getenv('RESOLVER_MODE', 'thread')  # 'thread' or 'process'
+RESOLVER_WORKERS = int(os.getenv('RESOLVER_WORKERS', '4'))
+RESOLVER_MAX_PENDING = int(os.getenv('RESOLVER_MAX_PENDING', '64'))
+RESOLVER_GUILD_CONCURRENCY = int(os.getenv('RESOLVER_GUILD_CONCURRENCY', '2'))
+RESOLVER_TIMEOUT = float(os.getenv('RESOLVER_TIMEOUT', '30'))
+RESOLVER_GUILD_MAX_PENDING = int(os.getenv('RESOLVER_GUILD_MAX_PENDING', '8'))  # lookups one guild may have queued or running
+# Token buckets for /play and !play: lookups per minute, and how many may be made back to back (rate 0 turns a limit off)
+RESOLVER_USER_RATE = float(os.getenv('RESOLVER_USER_RATE', '6'))
+RESOLVER_USER_BURST = int(os.getenv('RESOLVER_USER_BURST', '5'))
+RESOLVER_GUILD_RATE = float(os.getenv('RESOLVER_GUILD_RATE', '30'))
+RESOLVER_GUILD_BURST = int(os.getenv('RESOLVER_GUILD_BURST', '20'))
 
-    async def join_voice_channel(self, channel):
-        """Join a voice channel"""
-        if self.voice_client and self.voice_client.is_connected():
-            await self.voice_client.move_to(channel)
-        else:
-            self.voice_client = await channel.connect()
-        return self.voice_client
+# Priority classes, most urgent first: someone is waiting on the reply, a queued song needs a
+# fresh stream URL, and a playlist entry is resolved before it gets near the front of the queue
+RESOLVE_INTERACTIVE, RESOLVE_PREFETCH, RESOLVE_BACKGROUND = 0, 1, 2
+RESOLVE_PRIORITIES = ('interactive', 'prefetch', 'background')
+RESOLVE_PENDING_SHARE = (1.0, 0.75, 0.5)  # of max_pending a class may fill, so lower classes are turned away first
 
-    async def leave_voice_channel(self):
-        """Leave the voice channel"""
-        if self.voice_client:
-            await self.voice_client.disconnect()
-            self.voice_client = None
-        self.queue.clear()
-        self.current = None
-        self.is_playing = False
-        self.is_paused = False
+# Resolve cache settings (query -> video ID -> stream URL)
+RESOLVE_CACHE_SIZE = int(os.getenv('RESOLVE_CACHE_SIZE', '2048'))
+RESOLVE_CACHE_QUERY_TTL = float(os.getenv('RESOLVE_CACHE_QUERY_TTL', str(7 * 24 * 3600)))
+RESOLVE_CACHE_DEFAULT_TTL = float(os.getenv('RESOLVE_CACHE_DEFAULT_TTL', '3600'))
+RESOLVE_CACHE_EXPIRY_MARGIN = float(os.getenv('RESOLVE_CACHE_EXPIRY_MARGIN', '300'))
+RESOLVE_CACHE_DB = os.getenv('RESOLVE_CACHE_DB', '')  # SQLite file; empty keeps the cache in memory only
 
-    def get_audio_source(self, url):
-        """Get audio source from URL with high-quality settings"""
-        return discord.FFmpegOpusAudio(
-            url,
-            **FFMPEG_OPTIONS
-        )
+# Queue prefetch settings (keeps upcoming songs resolved before they play)
+PREFETCH_DEPTH = int(os.getenv('PREFETCH_DEPTH', '3'))
+PREFETCH_REFRESH_MARGIN = float(os.getenv('PREFETCH_REFRESH_MARGIN', '900'))
+PREFETCH_INTERVAL = float(os.getenv('PREFETCH_INTERVAL', '60'))
+PREFETCH_OPEN_SOURCE = os.getenv('PREFETCH_OPEN_SOURCE', 'false').lower() in ('1', 'true', 'yes')
 
-    async def play_next(self):
-        """Play the next song in the queue"""
-        if len(self.queue) > 0:
-            self.is_playing = True
-            self.is_paused = False
-            self.current = self.queue.pop(0)
-            
-            source = self.get_audio_source(self.current['url'])
-            self.voice_client.play(
-                source,
-                after=lambda e: asyncio.run_coroutine_threadsafe(
-                    self.play_next(), bot.loop
-                ) if e is None else None
-            )
-        else:
-            self.is_playing = False
-            self.current = None
+# Gapless playback settings (next song is opened and buffered before the current one ends)
+GAPLESS = os.getenv('GAPLESS', 'true').lower() in ('1', 'true', 'yes')
+GAPLESS_WARM_FRAMES = int(os.getenv('GAPLESS_WARM_FRAMES', '25'))  # 20 ms frames buffered ahead
+GAPLESS_LEAD = float(os.getenv('GAPLESS_LEAD', '20'))  # seconds before the current song ends that the next one is opened
+CROSSFADE_MS = int(os.getenv('CROSSFADE_MS', '0'))  # needs PCM decoding, so it disables Opus passthrough
 
-    async def add_to_queue(self, url, title):
-        """Add a song to the queue"""
-        self.queue.append({'url': url, 'title': title})
-        if not self.is_playing and self.voice_client and not self.voice_client.is_playing():
-            await self.play_next()
+# Stream recovery (a song whose stream fails mid-way is re-resolved and resumed where it stopped)
+RECOVERY_ATTEMPTS = int(os.getenv('RECOVERY_ATTEMPTS', '3'))  # per song, before it is skipped
+RECOVERY_TIMEOUT = float(os.getenv('RECOVERY_TIMEOUT', '20'))  # seconds of silence before moving on to the next song
+RECOVERY_MIN_REMAINING = float(os.getenv('RECOVERY_MIN_REMAINING', '5'))  # streams ending closer than this to the song's end finished normally
 
-    def pause(self):
-        """Pause the current song"""
-        if self.voice_client and self.voice_client.is_playing():
-            self.voice_client.pause()
-            self.is_paused = True
+# yt-dlp instance pool (reuses HTTP connections, cookies and loaded extractors between resolves)
+YDL_POOL_SIZE = int(os.getenv('YDL_POOL_SIZE', str(RESOLVER_WORKERS)))
+YDL_POOL_MAX_USES = int(os.getenv('YDL_POOL_MAX_USES', '100'))  # recycle an instance after this many resolves
 
-    def resume(self):
-        """Resume the paused song"""
-        if self.voice_client and self.voice_client.is_paused():
-            self.voice_client.resume()
-            self.is_paused = False
+# Search settings (text queries race several search sources at once)
+SEARCH_ORDER = [name.strip() for name in os.getenv('SEARCH_ORDER', 'ytmusic,youtube').split(',') if name.strip()]
+SEARCH_GRACE = float(os.getenv('SEARCH_GRACE', '0.5'))  # seconds to wait for a preferred source after another wins
+SEARCH_FLAT = os.getenv('SEARCH_FLAT', 'true').lower() in ('1', 'true', 'yes')  # flat search, then resolve only the winner
 
-    def stop(self):
-        """Stop the current song"""
-        if self.voice_client:
-            self.voice_client.stop()
-        self.is_playing = False
-        self.current = None
+# Local audio cache (popular tracks are saved to disk as Ogg Opus; off when AUDIO_CACHE_DIR is empty)
+AUDIO_CACHE_DIR = os.getenv('AUDIO_CACHE_DIR', '')
+AUDIO_CACHE_MAX_BYTES = int(float(os.getenv('AUDIO_CACHE_MAX_MB', '2048')) * 1024 * 1024)
+AUDIO_CACHE_MIN_PLAYS = int(os.getenv('AUDIO_CACHE_MIN_PLAYS', '3'))  # plays before a track is saved
+AUDIO_CACHE_POLICY = os.getenv('AUDIO_CACHE_POLICY', 'lru')  # 'lru' or 'lfu'
+AUDIO_CACHE_MAX_TRACK_SECONDS = float(os.getenv('AUDIO_CACHE_MAX_TRACK_SECONDS', '1200'))
+AUDIO_CACHE_WORKERS = int(os.getenv('AUDIO_CACHE_WORKERS', '1'))
+AUDIO_CACHE_BITRATE = os.getenv('AUDIO_CACHE_BITRATE', '160k')  # used when the source is not already Opus
 
+# /play autocomplete: songs kept in the local title index
+TITLE_INDEX_SIZE = int(os.getenv('TITLE_INDEX_SIZE', '5000'))
 
-# Global music player instance
-music_player = MusicPlayer()
+# Playlist ingestion settings
+PLAYLIST_MAX_TRACKS = int(os.getenv('PLAYLIST_MAX_TRACKS', '1000'))
 
+# Per-guild player settings
+QUEUE_CAPACITY = int(os.getenv('QUEUE_CAPACITY', '10000'))
+PLAYER_IDLE_TIMEOUT = float(os.getenv('PLAYER_IDLE_TIMEOUT', '300'))
+PLAYER_PAUSED_TIMEOUT = float(os.getenv('PLAYER_PAUSED_TIMEOUT', '3600'))  # seconds a paused player keeps its queue and voice connection
+MAX_PLAYERS = int(os.getenv('MAX_PLAYERS', '1000'))
 
-# Music Player Control Buttons
-class MusicPlayerControls(discord.ui.View):
-    def __init__(self, timeout=300):
-        super().__init__(timeout=timeout)
-        self.control_message = None
-    
-    async def update_buttons(self):
-        """Update button states based on player status"""
-        # Update play/pause button
-        if music_player.is_paused:
-            self.play_pause_button.emoji = "▶️"
-            self.play_pause_button.label = "Resume"
-        else:
-            self.play_pause_button.emoji = "⏸️"
-            self.play_pause_button.label = "Pause"
-        
-        # Enable/disable buttons based on state
-        has_music = music_player.current is not None
-        self.play_pause_button.disabled = not has_music
-        self.stop_button.disabled = not has_music
-        self.next_button.disabled = len(music_player.queue) == 0
-        self.previous_button.disabled = True  # Previous not implemented yet
-    
-    @discord.ui.button(emoji="⏮️", style=discord.ButtonStyle.secondary, label="Previous")
-    async def previous_button(self, interaction: discord.Interaction, button: discord.ui.Button):
-        """Go to previous song (not implemented - would need history)"""
-        await interaction.response.send_message("⏮️ Previous song feature not available yet", ephemeral=True)
-    
-    @discord.ui.button(emoji="⏸️", style=discord.ButtonStyle.primary, label="Pause")
-    async def play_pause_button(self, interaction: discord.Interaction, button: discord.ui.Button):
-        """Toggle play/pause"""
-        if music_player.is_paused:
-            music_player.resume()
-            await interaction.response.send_message("▶️ Resumed", ephemeral=True)
-        elif music_player.voice_client and music_player.voice_client.is_playing():
-            music_player.pause()
-            await interaction.response.send_message("⏸️ Paused", ephemeral=True)
-        else:
-            await interaction.response.send_message("Nothing is currently playing", ephemeral=True)
-            return
-        
-        # Update button state
-        await self.update_buttons()
-        if self.control_message:
+# Now-playing panel edits are coalesced: wait this long after a change, and never edit more often than every PANEL_MIN_INTERVAL
+PANEL_DEBOUNCE = float(os.getenv('PANEL_DEBOUNCE', '0.75'))
+PANEL_MIN_INTERVAL = float(os.getenv('PANEL_MIN_INTERVAL', '2'))
+
+# Session snapshots, so queues survive restarts (empty SESSION_DB turns them off)
+SESSION_DB = os.getenv('SESSION_DB', '')
+SESSION_SNAPSHOT_INTERVAL = float(os.getenv('SESSION_SNAPSHOT_INTERVAL', '5'))
+SESSION_MAX_AGE = float(os.getenv('SESSION_MAX_AGE', '3600'))  # older sessions are not restored
+
+# Sharding and cluster settings
+SHARD_COUNT = os.getenv('SHARD_COUNT', '')  # empty runs one unsharded bot, 'auto' asks Discord
+SHARD_IDS = [int(shard) for shard in os.getenv('SHARD_IDS', '').split(',') if shard.strip()]  # shards this process or cluster runs
+_cluster_workers = os.getenv('CLUSTER_WORKERS', '0')  # worker processes to spread shards across
+CLUSTER_WORKERS = (os.cpu_count() or 1) if _cluster_workers == 'auto' else int(_cluster_workers)
+CLUSTER_ID = os.getenv('CLUSTER_ID')  # set by the cluster launcher for its workers
+CLUSTER_IPC_HOST = os.getenv('CLUSTER_IPC_HOST', '127.0.0.1')
+CLUSTER_IPC_PORT = int(os.getenv('CLUSTER_IPC_PORT', '6200'))
+CLUSTER_IPC_KEY = os.getenv('CLUSTER_IPC_KEY', '')  # set by the cluster launcher for its workers
+CLUSTER_STATS_INTERVAL = float(os.getenv('CLUSTER_STATS_INTERVAL', '15'))
+CLUSTER_READY_TIMEOUT = float(os.getenv('CLUSTER_READY_TIMEOUT', '10'))  # seconds per shard before the next worker starts anyway
+
+# Metrics and health check server (off when METRICS_PORT is 0; cluster workers use the ports after it)
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+HEALTH_MAX_LOOP_LAG = float(os.getenv('HEALTH_MAX_LOOP_LAG', '5'))
+HEALTH_GATEWAY_GRACE = float(os.getenv('HEALTH_GATEWAY_GRACE', '60'))  # seconds a dropped gateway connection may take to come back
+HEALTH_STARTUP_GRACE = float(os.getenv('HEALTH_STARTUP_GRACE', '120'))
+
+# Event loop watchdog and profiler settings
+LOOP_WATCHDOG = os.getenv('LOOP_WATCHDOG', 'true').lower() in ('1', 'true', 'yes')
+LOOP_LAG_THRESHOLD = float(os.getenv('LOOP_LAG_THRESHOLD', '0.25'))  # seconds blocked before the stack is logged
+PROFILE_MAX_SECONDS = float(os.getenv('PROFILE_MAX_SECONDS', '120'))
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', '0.005'))  # seconds between stack samples
+
+# /play tracing: spans from the command arriving to the song's first audio frame
+TRACE_FILE = os.getenv('TRACE_FILE', '')  # JSON lines file for finished traces; empty keeps them for !stats and /metrics only
+TRACE_FORMAT = os.getenv('TRACE_FORMAT', 'json')  # 'json', or 'otlp' for OTLP/JSON lines the OpenTelemetry Collector can read
+TRACE_AUDIO_WAIT = float(os.getenv('TRACE_AUDIO_WAIT', '60'))  # seconds a trace waits for first audio before it is written without it
+
+# Slash commands are only synced when their hash differs from the one saved here
+COMMAND_SYNC_FILE = os.getenv('COMMAND_SYNC_FILE', '.command_sync')
+
+# Slash-only lean mode: no message events or message content, no message cache, voice-only member cache
+LEAN_MODE = os.getenv('LEAN_MODE', 'false').lower() in ('1', 'true', 'yes')
+
+# ==================== CLUSTER LAUNCHER ====================
+
+def recommended_shard_count(token):
+    """Ask Discord how many shards the bot should run"""
+    request = urllib.request.Request(
+        'https://discord.com/api/v10/gateway/bot',
+        headers={'Authorization': f'Bot {token}', 'User-Agent': 'DiscordBot (discord-music-bot, 1.0)'}
+    )
+    with urllib.request.urlopen(request, timeout=15) as response:
+        return int(json.load(response)['shards'])
+
+
+def split_shards(shard_ids, workers):
+    """Split shard IDs into contiguous ranges of near-equal size"""
+    workers = max(1, min(workers, len(shard_ids)))
+    size, extra = divmod(len(shard_ids), workers)
+    ranges = []
+    start = 0
+    for index in range(workers):
+        end = start + size + (1 if index < extra else 0)
+        ranges.append(shard_ids[start:end])
+        start = end
+    return ranges
+
+
+def format_shards(shards):
+    if not shards:
+        return "all"
+    return str(shards[0]) if len(shards) == 1 else f"{shards[0]}-{shards[-1]}"
+
+
+class ClusterLauncher:
+    """Runs shard ranges in worker processes and relays stats and commands between them"""
+
+    def __init__(self, shard_count, shard_ids, workers, host='127.0.0.1', port=6200):
+        self.shard_count = shard_count
+        self.ranges = split_shards(shard_ids, workers)
+        self.address = (host, port)
+        self.authkey = os.urandom(32)
+        self.listener = None
+        self.processes = {}  # cluster id -> Popen
+        self.connections = {}  # cluster id -> Connection
+        self.stats = {}  # cluster id -> latest snapshot
+        self.ready = {}  # cluster id -> Event set once its shards are connected
+        self._backoff = {}  # cluster id -> seconds before the next restart
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+
+    def run(self):
+        """Start every worker, then restart any that exit until asked to stop"""
+        self.listener = multiprocessing.connection.Listener(self.address, authkey=self.authkey)
+        threading.Thread(target=self._accept, name='cluster-accept', daemon=True).start()
+        signal.signal(signal.SIGTERM, lambda *_: self._stopping.set())
+        signal.signal(signal.SIGINT, lambda *_: self._stopping.set())
+        print(f"Starting {len(self.ranges)} cluster(s) for {self.shard_count} shard(s)")
+        try:
+            for cluster_id, shards in enumerate(self.ranges):
+                self._spawn(cluster_id)
+                # Start clusters one at a time so their shards do not trip the gateway identify limit
+                deadline = time.monotonic() + CLUSTER_READY_TIMEOUT * len(shards) + 30
+                while not self.ready[cluster_id].wait(1.0):
+                    if self._stopping.is_set() or time.monotonic() > deadline:
+                        break
+                    if self.processes[cluster_id].poll() is not None:
+                        break  # crashed; _supervise restarts it
+                if self._stopping.is_set():
+                    break
+            self._supervise()
+        finally:
+            self._shutdown()
+
+    def _spawn(self, cluster_id):
+        shards = self.ranges[cluster_id]
+        env = {
+            **os.environ,
+            'SHARD_COUNT': str(self.shard_count),
+            'SHARD_IDS': ','.join(str(shard) for shard in shards),
+            'CLUSTER_ID': str(cluster_id),
+            'CLUSTER_IPC_HOST': self.address[0],
+            'CLUSTER_IPC_PORT': str(self.address[1]),
+            'CLUSTER_IPC_KEY': self.authkey.hex(),
+        }
+        self.ready[cluster_id] = threading.Event()
+        self.processes[cluster_id] = subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env)
+        print(f"Started cluster {cluster_id} (shards {format_shards(shards)}) as pid {self.processes[cluster_id].pid}")
+
+    def _supervise(self):
+        while not self._stopping.wait(1.0):
+            for cluster_id, process in list(self.processes.items()):
+                code = process.poll()
+                if code is None:
+                    continue
+                delay = self._backoff.get(cluster_id, 5.0)
+                print(f"Cluster {cluster_id} exited with code {code}, restarting in {delay:.0f}s")
+                self.stats.pop(cluster_id, None)
+                if self._stopping.wait(delay):
+                    return
+                self._backoff[cluster_id] = min(delay * 2, 300.0)
+                self._spawn(cluster_id)
+
+    def _shutdown(self):
+        for process in self.processes.values():
+            if process.poll() is None:
+                process.send_signal(signal.SIGINT)
+        for cluster_id, process in self.processes.items():
             try:
-                await self.control_message.edit(view=self)
-            except:
-                pass
-    
-    @discord.ui.button(emoji="⏹️", style=discord.ButtonStyle.danger, label="Stop")
-    async def stop_button(self, interaction: discord.Interaction, button: discord.ui.Button):
-        """Stop playback"""
-        music_player.stop()
-        await interaction.response.send_message("⏹️ Stopped", ephemeral=True)
-        
-        # Update button state
-        await self.update_buttons()
-        if self.control_message:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                print(f"Cluster {cluster_id} did not stop in time, killing it")
+                process.kill()
+        if self.listener is not None:
+            self.listener.close()
+
+    def _accept(self):
+        while not self._stopping.is_set():
+            try:
+                conn = self.listener.accept()
+            except multiprocessing.AuthenticationError:
+                continue
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(conn,), name='cluster-conn', daemon=True).start()
+
+    def _send(self, conn, message):
+        with self._lock:
+            conn.send(message)
+
+    def broadcast(self, message):
+        """Send a message to every connected worker, returning how many got it"""
+        sent = 0
+        with self._lock:
+            connections = list(self.connections.values())
+        for conn in connections:
             try:
-                await self.control_message.edit(view=self)
-            except:
+                self._send(conn, message)
+                sent += 1
+            except OSError:
                 pass
-    
-    @discord.ui.button(emoji="⏭️", style=discord.ButtonStyle.secondary, label="Next")
-    async def next_button(self, interaction: discord.Interaction, button: discord.ui.Button):
-        """Skip to next song"""
-        if music_player.voice_client and music_player.voice_client.is_playing():
-            music_player.voice_client.stop()
-            await interaction.response.send_message("⏭️ Skipped", ephemeral=True)
-        elif len(music_player.queue) > 0:
-            await music_player.play_next()
-            await interaction.response.send_message("⏭️ Playing next song", ephemeral=True)
-        else:
-            await interaction.response.send_message("No songs in queue", ephemeral=True)
+        return sent
+
+    def _serve(self, conn):
+        cluster_id = None
+        try:
+            while True:
+                message = conn.recv()
+                op = message.get('op')
+                if op == 'hello':
+                    cluster_id = message['cluster']
+                    with self._lock:
+                        self.connections[cluster_id] = conn
+                elif op == 'ready':
+                    self.ready[cluster_id].set()
+                    self._backoff.pop(cluster_id, None)
+                elif op == 'stats':
+                    self.stats[cluster_id] = message['data']
+                elif op == 'cluster_stats':
+                    self._send(conn, {'op': 'reply', 'id': message['id'], 'data': dict(self.stats)})
+                elif op == 'broadcast':
+                    sent = self.broadcast({'op': 'command', 'command': message['command']})
+                    self._send(conn, {'op': 'reply', 'id': message['id'], 'data': sent})
+        except (EOFError, OSError):
+            pass
+        finally:
+            with self._lock:
+                if self.connections.get(cluster_id) is conn:
+                    del self.connections[cluster_id]
+            conn.close()
+
+
+class MetricsServer:
+    """Serves /metrics and /healthz from its own thread, so a stalled bot loop can still be reported"""
+
+    def __init__(self, host, port, bot_loop):
+        self.host = host
+        self.port = port
+        self.bot_loop = bot_loop
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='metrics', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        from aiohttp import web  # only needed when metrics are served
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        app = web.Application()
+        app.router.add_get('/metrics', self.metrics)
+        app.router.add_get('/healthz', self.healthz)
+        runner = web.AppRunner(app, access_log=None)
+        try:
+            loop.run_until_complete(runner.setup())
+            loop.run_until_complete(web.TCPSite(runner, self.host, self.port).start())
+        except OSError as e:
+            print(f"Failed to start metrics server on {self.host}:{self.port}: {e}")
             return
-        
-        # Update button state
-        await self.update_buttons()
-        if self.control_message:
+        print(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+        loop.run_forever()
+
+    async def metrics(self, request):
+        from aiohttp import web
+        # Collect on the bot loop so player and stream state is never read mid-update
+        async def collect():
+            return render_metrics()
+        try:
+            future = asyncio.run_coroutine_threadsafe(collect(), self.bot_loop)
+            body = await asyncio.wait_for(asyncio.wrap_future(future), timeout=HEALTH_MAX_LOOP_LAG)
+        except asyncio.TimeoutError:
+            return web.Response(status=503, text="event loop is not responding\n")
+        return web.Response(text=body, content_type='text/plain', charset='utf-8')
+
+    async def healthz(self, request):
+        from aiohttp import web
+        problems = health_problems()
+        if problems:
+            return web.Response(status=503, text="\n".join(problems) + "\n")
+        return web.Response(text="ok\n")
+
+
+def metrics_port(cluster_id=None):
+    """Metrics port of a process: the cluster launcher keeps METRICS_PORT, worker N takes METRICS_PORT + 1 + N"""
+    return METRICS_PORT if cluster_id is None else METRICS_PORT + 1 + int(cluster_id)
+
+
+class ClusterHealthServer(MetricsServer):
+    """Serves one /healthz for the whole cluster from the launcher.
+
+    It is healthy only when every worker is running and its own /healthz answers ok, so a
+    stuck or crash-looping worker fails the container health check too.
+    """
+
+    def __init__(self, host, port, launcher):
+        super().__init__(host, port, None)
+        self.launcher = launcher
+
+    async def metrics(self, request):
+        from aiohttp import web
+        first, last = metrics_port(0), metrics_port(len(self.launcher.ranges) - 1)
+        return web.Response(status=404, text=f"each cluster worker serves its own /metrics on ports {first}-{last}\n")
+
+    async def healthz(self, request):
+        from aiohttp import ClientError, ClientSession, ClientTimeout, web
+        host = '127.0.0.1' if METRICS_HOST in ('', '0.0.0.0', '::') else METRICS_HOST
+        problems = []
+        async with ClientSession(timeout=ClientTimeout(total=HEALTH_MAX_LOOP_LAG + 1)) as session:
+            for cluster_id in range(len(self.launcher.ranges)):
+                process = self.launcher.processes.get(cluster_id)
+                if process is None or process.poll() is not None:
+                    problems.append(f"cluster {cluster_id} is not running")
+                    continue
+                try:
+                    async with session.get(f"http://{host}:{metrics_port(cluster_id)}/healthz") as response:
+                        if response.status != 200:
+                            reason = (await response.text()).strip().replace("\n", "; ")
+                            problems.append(f"cluster {cluster_id}: {reason}")
+                except (ClientError, asyncio.TimeoutError) as e:
+                    problems.append(f"cluster {cluster_id} health check failed: {str(e) or type(e).__name__}")
+        if problems:
+            return web.Response(status=503, text="\n".join(problems) + "\n")
+        return web.Response(text="ok\n")
+
+
+def run_cluster():
+    """Spread this bot's shards across CLUSTER_WORKERS processes"""
+    shard_count = int(SHARD_COUNT) if SHARD_COUNT.isdigit() else recommended_shard_count(TOKEN)
+    shard_ids = SHARD_IDS or list(range(shard_count))
+    launcher = ClusterLauncher(shard_count, shard_ids, CLUSTER_WORKERS, host=CLUSTER_IPC_HOST, port=CLUSTER_IPC_PORT)
+    if METRICS_PORT:
+        ClusterHealthServer(METRICS_HOST, metrics_port(), launcher).start()
+    launcher.run()
+
+
+if __name__ == "__main__" and TOKEN and CLUSTER_WORKERS > 0 and CLUSTER_ID is None:
+    # The launcher only starts and watches workers; exit before the bot, its caches and databases are set up
+    run_cluster()
+    sys.exit()
+
+if SHARD_IDS and not SHARD_COUNT.isdigit():
+    # discord.py needs the total to place manual shard IDs; only the cluster launcher can look it up
+    sys.exit("Error: SHARD_IDS needs SHARD_COUNT set to the total number of shards, or CLUSTER_WORKERS to run them as a cluster")
+
+
+if LEAN_MODE:
+    # Slash commands and playback need guilds and voice states; DMs keep the owner's admin commands working
+    intents = discord.Intents.none()
+    intents.guilds = True
+    intents.voice_states = True
+    intents.dm_messages = True
+    cache_options = {
+        'max_messages': None,
+        'chunk_guilds_at_startup': False,
+        'member_cache_flags': discord.MemberCacheFlags.from_intents(intents),  # members in voice channels only
+    }
+else:
+    intents = discord.Intents.default()
+    intents.message_content = True
+    intents.voice_states = True
+    cache_options = {}
+
+# Disable default help command so we can use our custom one
+SHARDED = bool(SHARD_COUNT or SHARD_IDS)
+if SHARDED:
+    bot = commands.AutoShardedBot(
+        command_prefix=PREFIX,
+        intents=intents,
+        help_command=None,
+        shard_count=int(SHARD_COUNT) if SHARD_COUNT.isdigit() else None,
+        shard_ids=SHARD_IDS or None,
+        **cache_options
+    )
+else:
+    bot = commands.Bot(command_prefix=PREFIX, intents=intents, help_command=None, **cache_options)
+tree = bot.tree  # Slash command tree
+
+
+# ==================== QUEUE ====================
+
+def format_duration(seconds):
+    """Format seconds as m:ss or h:mm:ss"""
+    seconds = int(seconds or 0)
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes}:{seconds:02d}"
+
+
+def parse_timestamp(text):
+    """Parse seconds, m:ss or h:mm:ss into seconds; None when it is not a time"""
+    try:
+        parts = [float(part) for part in text.strip().split(':')]
+    except ValueError:
+        return None
+    if not 1 <= len(parts) <= 3 or any(part < 0 or not math.isfinite(part) for part in parts):
+        return None
+    seconds = 0.0
+    for part in parts:
+        seconds = seconds * 60 + part
+    return seconds
+
+
+class Track:
+    """A queued song. Slotted so long queues stay small in memory."""
+
+    __slots__ = ('id', 'title', 'duration', 'requester', 'url', 'expires_at', 'passthrough', 'abr', 'trace')
+
+    def __init__(self, id, title, duration=0, requester=None, url=None, expires_at=None, passthrough=False, abr=None):
+        self.id = id  # video key: YouTube ID, or page URL for other sites
+        self.title = title
+        self.duration = duration or 0
+        self.requester = requester  # user ID
+        self.url = url  # resolved stream URL
+        self.expires_at = expires_at
+        self.passthrough = passthrough
+        self.abr = abr  # source bitrate in kbps, caps the transcode bitrate
+        self.trace = None  # PlayTrace waiting for this song's first audio frame
+
+    @classmethod
+    def from_info(cls, info, requester=None):
+        """Build a track from a get_video_info result"""
+        track = cls(video_key(info), info['title'], info.get('duration'), requester)
+        track.update_stream(info)
+        return track
+
+    def update_stream(self, info):
+        """Store a freshly resolved stream URL"""
+        self.url = info['url']
+        self.expires_at = parse_stream_expiry(info['url'])
+        self.passthrough = is_opus_passthrough(info)
+        self.abr = info.get('abr')
+
+
+class QueueFull(Exception):
+    """Raised when a queue is at capacity"""
+
+
+class TrackQueue:
+    """Deque-backed queue of Tracks with a bounded capacity and a running total duration"""
+
+    def __init__(self, capacity=10000):
+        self.capacity = capacity
+        self.total_duration = 0
+        self._tracks = deque()
+        # Change tracking for incremental session snapshots: appends and pops only move
+        # the sequence numbers, anything that reorders the queue bumps the generation
+        self.head_seq = 0  # sequence number of the first track
+        self.generation = 0
+
+    def __len__(self):
+        return len(self._tracks)
+
+    def __bool__(self):
+        return bool(self._tracks)
+
+    def __iter__(self):
+        return iter(self._tracks)
+
+    def __getitem__(self, index):
+        return self._tracks[index]
+
+    @property
+    def tail_seq(self):
+        """Sequence number the next appended track gets"""
+        return self.head_seq + len(self._tracks)
+
+    def append(self, track):
+        if len(self._tracks) >= self.capacity:
+            raise QueueFull(f"The queue is full ({self.capacity} songs)")
+        self._tracks.append(track)
+        self.total_duration += track.duration
+
+    def popleft(self):
+        track = self._tracks.popleft()
+        self.total_duration -= track.duration
+        self.head_seq += 1
+        return track
+
+    def clear(self):
+        self._tracks.clear()
+        self.total_duration = 0
+        self.generation += 1
+
+    def head(self, count):
+        """The first count tracks"""
+        return list(islice(self._tracks, count))
+
+    def page(self, page, per_page=10):
+        """Tracks on a 0-based page.
+
+        islice would walk every track before the page; indexing a deque jumps over whole
+        blocks from the nearer end, so a deep page of a long queue stays cheap.
+        """
+        start = page * per_page
+        tracks = self._tracks
+        return [tracks[index] for index in range(start, min(start + per_page, len(tracks)))]
+
+    def remove(self, index):
+        """Remove and return the track at a 0-based position"""
+        if not 0 <= index < len(self._tracks):
+            raise IndexError("position out of range")
+        self._tracks.rotate(-index)
+        track = self._tracks.popleft()
+        self._tracks.rotate(index)
+        self.total_duration -= track.duration
+        self.generation += 1
+        return track
+
+    def move(self, index, new_index):
+        """Move the track at a 0-based position to another position"""
+        if not 0 <= new_index < len(self._tracks):
+            raise IndexError("position out of range")
+        track = self.remove(index)
+        self._tracks.insert(new_index, track)
+        self.total_duration += track.duration
+        return track
+
+    def shuffle(self):
+        tracks = list(self._tracks)
+        random.shuffle(tracks)
+        self._tracks = deque(tracks)
+        self.generation += 1
+
+
+# ==================== AUDIO SOURCES ====================
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def read_process_cpu(pid):
+    """CPU seconds (user + system) used by a process so far, or None if /proc is unavailable"""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            # The command name may contain spaces, so split after its closing parenthesis
+            fields = f.read().rpartition(')')[2].split()
+        return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def read_process_rss(pid):
+    """Resident memory of a process in bytes, or None if /proc is unavailable"""
+    try:
+        with open(f'/proc/{pid}/statm') as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def read_host_cpu():
+    """(busy, total) CPU ticks of the whole host since boot, or None if /proc is unavailable"""
+    try:
+        with open('/proc/stat') as f:
+            fields = [int(value) for value in f.readline().split()[1:]]
+        idle = fields[3] + (fields[4] if len(fields) > 4 else 0)  # idle + iowait
+        total = sum(fields[:8])  # guest time is already counted in user time
+        return total - idle, total
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def is_opus_passthrough(info):
+    """True when a resolved format can be sent to Discord without re-encoding"""
+    return (
+        OPUS_PASSTHROUGH
+        and info.get('acodec', '').startswith('opus')
+        and info.get('asr') == 48000
+        and info.get('audio_channels') in (2, None)
+    )
+
+
+def choose_bitrate(channel_bitrate, source_abr=None, override=None):
+    """Transcode bitrate in kbps: the guild's override, else the voice channel's, capped at the source's"""
+    if override:
+        return override
+    if TRANSCODE_BITRATE != 'auto':
+        return int(TRANSCODE_BITRATE)
+    # Discord drops whatever goes over the channel bitrate, and bits the source never had cannot be restored
+    kbps = (channel_bitrate or 64000) // 1000
+    if source_abr:
+        kbps = min(kbps, int(math.ceil(source_abr)))
+    return max(32, min(kbps, 512))
+
+
+def opus_complexity(kbps):
+    """libopus complexity for a bitrate: full at 160 kbps and up, down to 5 at 80 kbps and below"""
+    if OPUS_COMPLEXITY != 'auto':
+        return int(OPUS_COMPLEXITY)
+    return max(5, min(10, kbps // 16))
+
+
+class TrackedFFmpegMixin:
+    """Accounts ffmpeg CPU time per mode (passthrough or transcode) for FFmpeg audio sources.
+
+    Every source registers its process with the ffmpeg supervisor, which samples its CPU
+    time while it runs (ffmpeg is reaped at end of stream, so it cannot be read afterwards).
+    """
+
+    stats = {
+        mode: {'started': 0, 'cpu_seconds': 0.0, 'stream_seconds': 0.0}
+        for mode in ('passthrough', 'transcode', 'cached')
+    }
+
+    def __init__(self, source, mode='transcode', degraded=False, **kwargs):
+        self.mode = mode
+        self.degraded = degraded  # transcoded cheaper because the host was saturated
+        self.started_at = time.monotonic()
+        self.last_read = self.started_at
+        self.waiting = False  # opened ahead of time and not played yet, so never idle-killed
+        self.paused = False  # its player is paused; it is read again on resume, so never idle-killed
+        self.cpu_seconds = 0.0
+        self._accounted = False
+        super().__init__(source, **kwargs)
+        self.stats[mode]['started'] += 1
+        ffmpeg_supervisor.register(self)
+
+    @property
+    def pid(self):
+        process = getattr(self, '_process', None)
+        return getattr(process, 'pid', None)
+
+    def sample_cpu(self):
+        cpu = read_process_cpu(self.pid) if self.pid is not None else None
+        if cpu is not None:
+            self.cpu_seconds = cpu
+        return self.cpu_seconds
+
+    def read(self):
+        self.last_read = time.monotonic()
+        return super().read()
+
+    def cleanup(self):
+        if not self._accounted and self.pid is not None:
+            self._accounted = True
+            ffmpeg_supervisor.unregister(self)
+            stats = self.stats[self.mode]
+            stats['cpu_seconds'] += self.sample_cpu()
+            stats['stream_seconds'] += time.monotonic() - self.started_at
+        super().cleanup()
+
+    @classmethod
+    def cpu_per_stream(cls, mode):
+        """Average share of one core an ffmpeg process of this mode uses, including live ones"""
+        stats = cls.stats[mode]
+        cpu = stats['cpu_seconds']
+        seconds = stats['stream_seconds']
+        now = time.monotonic()
+        for source in ffmpeg_supervisor.sources():
+            if source.mode == mode:
+                cpu += source.sample_cpu()
+                seconds += now - source.started_at
+        return cpu / seconds if seconds else 0.0
+
+
+class TrackedOpusAudio(TrackedFFmpegMixin, discord.FFmpegOpusAudio):
+    """FFmpegOpusAudio with CPU accounting"""
+
+
+class TrackedPCMAudio(TrackedFFmpegMixin, discord.FFmpegPCMAudio):
+    """FFmpegPCMAudio with CPU accounting, used when crossfading"""
+
+
+class StreamLimitReached(Exception):
+    """Raised when no ffmpeg slot frees up for a new player in time"""
+
+
+class FFmpegProcess:
+    """The supervisor's record of one ffmpeg child process"""
+
+    __slots__ = ('process', 'source', 'mode', 'cpu_seconds', 'cpu_share', 'rss', 'sampled_at')
+
+    def __init__(self, source):
+        self.process = source._process
+        self.source = weakref.ref(source)
+        self.mode = source.mode
+        self.cpu_seconds = 0.0
+        self.cpu_share = 0.0  # of one core, over the last sample interval
+        self.rss = 0
+        self.sampled_at = time.monotonic()
+
+
+class FFmpegSupervisor:
+    """Owns every ffmpeg child process the bot starts.
+
+    A background pass (run in an executor, off the event loop) samples each process's CPU
+    and memory and the host's CPU from /proc, reaps processes whose source went away and
+    kills ones nobody has read for idle_kill seconds, such as the stream of a player that
+    lost its voice connection. Its view of the host feeds three decisions: new transcodes
+    are degraded (lower bitrate and complexity) while the host is saturated, sources are
+    not opened ahead of time then, and new players wait for a slot when max_processes
+    processes are running.
+    """
+
+    stats = {'killed': 0, 'reaped': 0, 'degraded': 0, 'admitted': 0, 'queued': 0, 'rejected': 0}
+
+    def __init__(self, max_processes=0, max_transcodes='auto', cpu_high=0.85, idle_kill=900, interval=5):
+        self.max_processes = max_processes
+        self.max_transcodes = max_transcodes
+        self.cpu_high = cpu_high
+        self.idle_kill = idle_kill
+        self.interval = interval
+        self.host_cpu = None  # busy share of all cores over the last interval
+        self._host_ticks = read_host_cpu()
+        self._processes = {}  # pid -> FFmpegProcess
+        self._lock = threading.Lock()  # sources register and clean up from the audio threads
+        self._task = None
+
+    def __len__(self):
+        return len(self._processes)
+
+    def register(self, source):
+        if source.pid is None:
+            return
+        with self._lock:
+            self._processes[source.pid] = FFmpegProcess(source)
+
+    def unregister(self, source):
+        with self._lock:
+            self._processes.pop(source.pid, None)
+
+    def sources(self):
+        """Live sources with a running ffmpeg"""
+        with self._lock:
+            records = list(self._processes.values())
+        return [source for source in (record.source() for record in records) if source is not None]
+
+    def count(self, mode=None):
+        with self._lock:
+            return sum(1 for record in self._processes.values() if mode is None or record.mode == mode)
+
+    def transcode_capacity(self):
+        """Full-quality transcodes the host can run; 0 means no cap"""
+        if self.max_transcodes != 'auto':
+            return int(self.max_transcodes)
+        stats = TrackedFFmpegMixin.stats['transcode']
+        if stats['stream_seconds'] < 600:
+            return 0  # not enough finished transcodes to know what one costs yet
+        per_stream = stats['cpu_seconds'] / stats['stream_seconds']
+        if per_stream <= 0:
+            return 0
+        return max(1, int((os.cpu_count() or 1) * self.cpu_high / per_stream))
+
+    @property
+    def saturated(self):
+        """True when new transcodes should be made cheaper"""
+        if self.host_cpu is not None and self.host_cpu >= self.cpu_high:
+            return True
+        capacity = self.transcode_capacity()
+        return bool(capacity) and self.count('transcode') >= capacity
+
+    def full(self):
+        return bool(self.max_processes) and len(self._processes) >= self.max_processes
+
+    def degrade(self):
+        """True (and counted) when a transcode about to start should be degraded"""
+        if self.saturated:
+            self.stats['degraded'] += 1
+            return True
+        return False
+
+    def can_open_early(self):
+        """Whether the prefetcher may start ffmpeg for a song before it is needed"""
+        if self.saturated:
+            return False
+        return not self.max_processes or len(self._processes) < self.max_processes * 0.9
+
+    async def admit(self, player, timeout=10.0):
+        """Wait until a player that is not playing yet may start a stream.
+
+        Players that are already playing are always admitted, since their next song takes
+        over from the current one. Raises StreamLimitReached after timeout seconds.
+        """
+        if player.is_playing or (player.voice_client and player.voice_client.is_playing()) or not self.full():
+            self.stats['admitted'] += 1
+            return
+        self.stats['queued'] += 1
+        deadline = time.monotonic() + timeout
+        while self.full():
+            if time.monotonic() >= deadline:
+                self.stats['rejected'] += 1
+                raise StreamLimitReached("Too many songs are playing right now")
+            await asyncio.sleep(0.25)
+        self.stats['admitted'] += 1
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.interval)
             try:
-                await self.control_message.edit(view=self)
-            except:
-                pass
+                await loop.run_in_executor(None, self.sample)
+            except Exception as e:
+                print(f"ffmpeg supervisor pass failed: {e}")
+
+    def sample(self):
+        """Sample every process and the host, and kill or reap stragglers (blocks on /proc)"""
+        ticks = read_host_cpu()
+        if ticks is not None and self._host_ticks is not None and ticks[1] > self._host_ticks[1]:
+            self.host_cpu = (ticks[0] - self._host_ticks[0]) / (ticks[1] - self._host_ticks[1])
+        self._host_ticks = ticks
+
+        now = time.monotonic()
+        with self._lock:
+            records = list(self._processes.items())
+        for pid, record in records:
+            source = record.source()
+            if record.process.poll() is not None:
+                # Exited; poll() reaped it. The source's cleanup accounts for it unless it is gone
+                if source is None:
+                    self._forget(pid, 'reaped')
+                continue
+            held = source is not None and (source.waiting or source.paused)
+            if source is None or (not held and now - source.last_read > self.idle_kill):
+                # Nobody will read this stream again
+                self._kill(record.process)
+                self._forget(pid, 'killed')
+                continue
+            cpu = read_process_cpu(pid)
+            if cpu is not None:
+                elapsed = now - record.sampled_at
+                if elapsed > 0:
+                    record.cpu_share = max(0.0, cpu - record.cpu_seconds) / elapsed
+                record.cpu_seconds = source.cpu_seconds = cpu
+            record.rss = read_process_rss(pid) or record.rss
+            record.sampled_at = now
+
+    def _forget(self, pid, event):
+        with self._lock:
+            if self._processes.pop(pid, None) is not None:
+                self.stats[event] += 1
+
+    @staticmethod
+    def _kill(process):
+        try:
+            process.kill()
+            process.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            pass
+
+    def usage(self):
+        """{mode: (processes, CPU share of one core, RSS bytes)} from the last sample"""
+        with self._lock:
+            records = list(self._processes.values())
+        usage = {mode: [0, 0.0, 0] for mode in TrackedFFmpegMixin.stats}
+        for record in records:
+            totals = usage[record.mode]
+            totals[0] += 1
+            totals[1] += record.cpu_share
+            totals[2] += record.rss
+        return {mode: tuple(totals) for mode, totals in usage.items()}
+
+
+ffmpeg_supervisor = FFmpegSupervisor(
+    max_processes=FFMPEG_MAX_PROCESSES,
+    max_transcodes=FFMPEG_MAX_TRANSCODES,
+    cpu_high=FFMPEG_CPU_HIGH,
+    idle_kill=FFMPEG_IDLE_KILL,
+    interval=FFMPEG_SAMPLE_INTERVAL,
+)
+
+
+def tracked_ffmpeg(source):
+    """The ffmpeg source under any wrappers, or None when it is not one"""
+    while source is not None and not isinstance(source, TrackedFFmpegMixin):
+        source = getattr(source, 'source', None)
+    return source
+
+
+class WarmSource(discord.AudioSource):
+    """Wraps a source and buffers its first frames so playback can start without waiting"""
+
+    def __init__(self, source):
+        self.source = source
+        self.buffer = deque()
+        self._lock = threading.Lock()
+        # After warming, nothing reads the source until its track starts, which can be a long song away
+        self._waiting = isinstance(source, TrackedFFmpegMixin)
+        if self._waiting:
+            source.waiting = True
+
+    @property
+    def ready(self):
+        return bool(self.buffer)
+
+    def warm(self, frames):
+        """Read up to frames frames ahead of time (blocks, so run it in an executor)"""
+        with self._lock:
+            while len(self.buffer) < frames:
+                data = self.source.read()
+                if not data:
+                    break
+                self.buffer.append(data)
+
+    def read(self):
+        if self._waiting:
+            # Playback started: the idle clock runs from here
+            self._waiting = False
+            self.source.waiting = False
+            self.source.last_read = time.monotonic()
+        with self._lock:
+            if self.buffer:
+                return self.buffer.popleft()
+            return self.source.read()
+
+    def is_opus(self):
+        return self.source.is_opus()
+
+    def cleanup(self):
+        self.buffer.clear()
+        self.source.cleanup()
+
+
+PCM_SILENCE = b'\x00' * discord.opus.Encoder.FRAME_SIZE  # one 20 ms frame
+
+
+def mix_pcm_frames(outgoing, incoming, weight):
+    """Mix two 16-bit stereo PCM frames, weight being the share of the incoming frame"""
+    a = array('h', outgoing)
+    b = array('h', incoming)
+    if len(b) < len(a):
+        b.extend([0] * (len(a) - len(b)))
+    mixed = array('h', (
+        max(-32768, min(32767, int(x * (1.0 - weight) + y * weight))) for x, y in zip(a, b)
+    ))
+    return mixed.tobytes()
+
+
+class PlaybackEngine(discord.AudioSource):
+    """The single source a voice client plays; switches tracks at the frame boundary.
+
+    When the current track runs out, the next track's source (opened and warmed by the
+    prefetcher) is taken and its first frame is returned from the same read() call, so
+    there is no gap. With a crossfade the last frames of the outgoing track are mixed
+    with the first frames of the incoming one; this needs PCM sources. When a stream
+    ends well before its track should, silence is played while the player reopens it.
+    """
+
+    stats = {'gapless': 0, 'fallback': 0, 'gaps': deque(maxlen=500)}
+
+    def __init__(self, player, source, gapless=True, crossfade_ms=0, gap_started=None, start_offset=0.0, track=None):
+        self.player = player
+        self.gapless = gapless
+        self.current = source
+        self.track = track  # the queue entry being played
+        self.pcm = not source.is_opus()
+        self.fade_frames = crossfade_ms // 20 if self.pcm else 0
+        self._ahead = deque()  # read-ahead of the current track, used for the crossfade
+        self._incoming = None
+        self._incoming_track = None
+        self._exhausted = False
+        self._skip = False
+        self._recovering = None  # deadline while waiting for a replacement after the stream failed
+        self._gap_started = gap_started
+        self._offset = start_offset  # where the current track's source started, in seconds
+        self._frames = 0  # frames played of the current track
+        self._replacement = None  # (source, offset, switches, catch_up) to continue the current track from
+        self._replace_lock = threading.Lock()  # replace() runs on the loop, the audio thread applies it
+        self.switches = 0  # tracks switched to so far
+
+    @property
+    def position(self):
+        """Seconds into the current track"""
+        return self._offset + self._frames * 0.02
+
+    def is_opus(self):
+        return not self.pcm
+
+    def skip(self):
+        """Finish the current track at the next frame and move on to the next one"""
+        self._skip = True
+
+    def replace(self, source, offset, switches, catch_up=True):
+        """Continue the current track from source, opened offset seconds in.
+
+        Picked up by the audio thread at the next frame, unless the engine has switched
+        tracks since switches was read. With catch_up, what played from the old source
+        while the new one was opening is skipped; without, playback jumps to offset.
+        A replacement still pending is closed; the newest one wins.
+        """
+        with self._replace_lock:
+            previous, self._replacement = self._replacement, (source, offset, switches, catch_up)
+        if previous is not None:
+            previous[0].cleanup()
+
+    def hold(self, paused):
+        """Mark the current track's ffmpeg as paused (or resumed) for the supervisor's idle kill"""
+        source = tracked_ffmpeg(self.current)
+        if source is not None:
+            source.paused = paused
+            source.last_read = time.monotonic()  # the idle clock restarts on resume
+
+    def _apply_replacement(self):
+        with self._replace_lock:
+            replacement, self._replacement = self._replacement, None
+        if replacement is None:
+            return
+        source, offset, switches, catch_up = replacement
+        if switches != self.switches or source.is_opus() != self.is_opus():
+            source.cleanup()
+            return
+        position = offset
+        if catch_up:
+            # Drop what was played from the old source while the new one was opening
+            position = max(offset, self.position)
+            for _ in range(round((position - offset) / 0.02)):
+                if not source.read():
+                    break
+        self.current.cleanup()
+        self.current = source
+        self._ahead.clear()
+        self._exhausted = False
+        self._recovering = None
+        self._offset = position
+        self._frames = 0
+
+    def _start_recovery(self):
+        """Ask the player to resume a track whose stream ended early; False when it simply finished"""
+        track = self.track
+        if track is None or not track.duration or self.position >= track.duration - RECOVERY_MIN_REMAINING:
+            return False
+        # Anything read ahead is played again from the new source
+        self._ahead.clear()
+        self._recovering = time.perf_counter() + RECOVERY_TIMEOUT
+        asyncio.run_coroutine_threadsafe(
+            self.player.recover(track, self.position, engine=self, switches=self.switches), bot.loop
+        )
+        return True
+
+    def _silence(self):
+        return PCM_SILENCE if self.pcm else discord.opus.OPUS_SILENCE
+
+    def _handover(self):
+        """Take the next prepared source; called from the audio thread"""
+        if not self.gapless:
+            return None
+        entry, source = self.player.prefetcher.take_head()
+        if source is None:
+            return None
+        if source.is_opus() != self.is_opus():
+            source.cleanup()
+            return None
+        bot.loop.call_soon_threadsafe(self.player.on_track_advanced, entry)
+        self._incoming_track = entry
+        return source
+
+    def _record_gap(self):
+        if self._gap_started is not None:
+            self.stats['gaps'].append(time.perf_counter() - self._gap_started)
+            self._gap_started = None
+
+    def read(self):
+        data = self._read()
+        if data and self._recovering is None:
+            self._frames += 1
+            if self._frames == 1 and self.track is not None and self.track.trace is not None:
+                # The voice client sends this frame next: the requester starts hearing the song
+                self.track.trace.heard()
+                self.track.trace = None
+        return data
+
+    def _read(self):
+        if self._replacement is not None:
+            self._apply_replacement()
+        if self._skip:
+            self._skip = False
+            self._ahead.clear()
+            self._exhausted = True
+            self._recovering = None
+
+        if self._recovering is not None:
+            # Keep the voice connection busy with silence until the stream is back
+            if time.perf_counter() < self._recovering:
+                return self._silence()
+            self._recovering = None
+            self._exhausted = True
+            self._gap_started = time.perf_counter()
+
+        if not self._exhausted:
+            # Keep enough of the current track read ahead to fade it out
+            while len(self._ahead) <= self.fade_frames:
+                data = self.current.read()
+                if not data:
+                    if self._start_recovery():
+                        return self._silence()
+                    self._exhausted = True
+                    self._gap_started = time.perf_counter()
+                    break
+                self._ahead.append(data)
+            if not self._exhausted:
+                data = self._ahead.popleft()
+                self._record_gap()
+                return data
+
+        if self._incoming is None:
+            self._incoming = self._handover()
+            if self._incoming is None:
+                if self._ahead:
+                    return self._ahead.popleft()
+                return b''
+            self.stats['gapless'] += 1
+
+        if self._ahead:
+            # Crossfade: mix the tail of the outgoing track into the head of the incoming one
+            weight = 1.0 - len(self._ahead) / (self.fade_frames + 1)
+            self._record_gap()
+            return mix_pcm_frames(self._ahead.popleft(), self._incoming.read(), weight)
+
+        self.current.cleanup()
+        self.current = self._incoming
+        self.track = self._incoming_track
+        self._incoming = None
+        self._exhausted = False
+        self._offset = 0.0
+        self._frames = 0
+        self.switches += 1
+        data = self.current.read()
+        if data:
+            self._record_gap()
+        return data
+
+    def cleanup(self):
+        self.current.cleanup()
+        if self._incoming is not None:
+            self._incoming.cleanup()
+            self._incoming = None
+        with self._replace_lock:
+            replacement, self._replacement = self._replacement, None
+        if replacement is not None:
+            replacement[0].cleanup()
+
+    @classmethod
+    def gap_percentile(cls, percentile):
+        gaps = sorted(cls.stats['gaps'])
+        if not gaps:
+            return 0.0
+        return gaps[min(len(gaps) - 1, int(len(gaps) * percentile))]
+
+
+class QueuePrefetcher:
+    """Keeps the next few queue entries resolved in the background.
+
+    Entries whose stream URL expires within the refresh margin are re-resolved, and
+    optionally the head of the queue gets its ffmpeg source opened ahead of time so
+    play_next can start it without waiting for the connection.
+    """
+
+    stats = {'refreshed': 0, 'refresh_failed': 0, 'sources_used': 0, 'sources_discarded': 0, 'stale_at_play': 0}
+
+    def __init__(self, player, depth=3, refresh_margin=900, interval=60, open_source=False, open_lead=None):
+        self.player = player
+        self.depth = depth
+        self.refresh_margin = refresh_margin
+        self.interval = interval
+        self.open_source = open_source
+        self.open_lead = open_lead  # open the source only this many seconds before the current song ends; None = at once
+        self.prepared = None  # (entry, WarmSource) opened ahead of time for queue[0]
+        self._lock = threading.Lock()  # the audio thread takes prepared sources at track boundaries
+        self._wake = asyncio.Event()
+        self._task = None
+
+    def poke(self):
+        """Ask the prefetcher to look at the queue again, starting it if needed"""
+        self._wake.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        """Stop the background task and close any source opened ahead of time"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self.discard()
+
+    def discard(self):
+        with self._lock:
+            prepared, self.prepared = self.prepared, None
+        if prepared is not None:
+            prepared[1].cleanup()
+            self.stats['sources_discarded'] += 1
+
+    def take(self, entry):
+        """Return the source opened ahead of time for entry, if there is one"""
+        with self._lock:
+            if self.prepared is not None and self.prepared[0] is entry:
+                source = self.prepared[1]
+                self.prepared = None
+                self.stats['sources_used'] += 1
+                return source
+        self.discard()
+        return None
+
+    def take_head(self):
+        """Return (entry, source) for the head of the queue if its source is open (thread-safe)"""
+        with self._lock:
+            queue = self.player.queue
+            if self.prepared is None or not queue or queue[0] is not self.prepared[0]:
+                return None, None
+            prepared, self.prepared = self.prepared, None
+            self.stats['sources_used'] += 1
+            return prepared
+
+    def needs_refresh(self, entry, margin):
+        """True when an entry has no stream URL yet or it expires within margin seconds"""
+        if audio_cache.has(entry.id):
+            return False  # played from disk, so the URL does not matter
+        if entry.url is None:
+            return True
+        return entry.expires_at is not None and entry.expires_at - margin <= time.time()
+
+    async def refresh(self, entry, margin, priority=RESOLVE_PREFETCH):
+        """Re-resolve an entry so its stream URL stays valid for at least margin seconds"""
+        if not entry.id:
+            return False
+        try:
+            info = await resolver.resolve(
+                video_key_url(entry.id), guild_id=self.player.guild_id, min_ttl=margin, priority=priority
+            )
+        except (ResolverBusy, asyncio.TimeoutError):
+            info = None
+        if not info:
+            self.stats['refresh_failed'] += 1
+            return False
+        entry.update_stream(info)
+        self.stats['refreshed'] += 1
+        return True
+
+    async def _run(self):
+        while True:
+            self._wake.clear()
+            due = None
+            try:
+                due = await self._prefetch()
+            except Exception as e:
+                print(f"Prefetch failed: {e}")
+            if self.player.queue:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), self.interval if due is None else min(self.interval, due))
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                await self._wake.wait()
+
+    def _open_delay(self):
+        """Seconds until the head's source should be opened, or None when it should not be opened early"""
+        if self.open_lead is None:
+            return 0.0
+        current = self.player.current
+        if current is None or not current.duration:
+            # play_next opens it when nothing is playing; live streams have no end to prepare for
+            return None
+        return max(0.0, current.duration - self.player.position() - self.open_lead)
+
+    async def _prefetch(self):
+        """Refresh the next entries and open the head's source; returns seconds until it is due, if it is waiting"""
+        for entry in self.player.queue.head(self.depth):
+            if self.needs_refresh(entry, self.refresh_margin):
+                # Playlist entries have never been resolved; that is background work
+                priority = RESOLVE_BACKGROUND if entry.url is None else RESOLVE_PREFETCH
+                await self.refresh(entry, self.refresh_margin, priority)
+
+        if not self.open_source:
+            return None
+        head = self.player.queue[0] if self.player.queue else None
+        if self.prepared is not None:
+            entry = self.prepared[0]
+            if entry is not head or self.needs_refresh(entry, RESOLVE_CACHE_EXPIRY_MARGIN):
+                self.discard()
+        if self.prepared is None and head is not None and not self.needs_refresh(head, RESOLVE_CACHE_EXPIRY_MARGIN) \
+                and ffmpeg_supervisor.can_open_early():
+            # Holding a second ffmpeg and connection for the whole song is wasteful; open it near the end
+            delay = self._open_delay()
+            if delay is None or delay > 0:
+                return delay
+            source = WarmSource(self.player.get_audio_source(head.url, head.passthrough, key=head.id, abr=head.abr))
+            with self._lock:
+                self.prepared = (head, source)
+            # Buffer the first frames so the track can start the moment it is needed
+            await asyncio.get_running_loop().run_in_executor(None, source.warm, GAPLESS_WARM_FRAMES)
+
+
+class MusicPlayer:
+    # Streams that failed mid-song and were resumed where they stopped
+    stats = {'recoveries': 0, 'recovered': 0, 'recovery_failed': 0, 'recovery_seconds': deque(maxlen=500), 'seeks': 0}
+
+    def __init__(self, guild_id=None):
+        self.guild_id = guild_id
+        self.queue = TrackQueue(QUEUE_CAPACITY)
+        self.current = None
+        self.voice_client = None
+        self.engine = None
+        self.is_playing = False
+        self.is_paused = False
+        self.panel = NowPlayingPanel(self, debounce=PANEL_DEBOUNCE, min_interval=PANEL_MIN_INTERVAL)
+        self.last_active = time.monotonic()
+        self.ingests = set()  # playlist ingestions streaming into the queue
+        self._track_ended_at = None  # when the last track finished, to measure the gap
+        self.bitrate_override = None  # kbps set with the bitrate command
+        self.bitrate = None  # kbps the current track is transcoded at
+        self._recovery = (None, 0)  # (track, attempts) for the song whose stream keeps failing
+        self.prefetcher = QueuePrefetcher(
+            self,
+            depth=PREFETCH_DEPTH,
+            refresh_margin=PREFETCH_REFRESH_MARGIN,
+            interval=PREFETCH_INTERVAL,
+            open_source=PREFETCH_OPEN_SOURCE or GAPLESS,
+            open_lead=None if PREFETCH_OPEN_SOURCE else GAPLESS_LEAD,
+        )
+
+    async def join_voice_channel(self, channel):
+        """Join a voice channel"""
+        if self.voice_client and self.voice_client.is_connected():
+            await self.voice_client.move_to(channel)
+            await self.adapt_bitrate()
+        else:
+            self.voice_client = await channel.connect()
+        return self.voice_client
+
+    def target_bitrate(self, abr=None):
+        """Transcode bitrate in kbps for the voice channel the player is in"""
+        channel = self.voice_client.channel if self.voice_client else None
+        return choose_bitrate(getattr(channel, 'bitrate', None), abr, self.bitrate_override)
+
+    async def adapt_bitrate(self):
+        """Re-encode at the bitrate the channel allows now (after a move, a channel edit or an override)"""
+        kbps = self.target_bitrate(self.current.abr if self.current else None)
+        if kbps == self.bitrate:
+            return
+        self.bitrate = kbps
+        # Sources opened ahead of time use the old bitrate
+        self.prefetcher.discard()
+        self.prefetcher.poke()
+        engine = self.voice_client.source if self.voice_client else None
+        if not isinstance(engine, PlaybackEngine) or self.current is None:
+            return
+        if engine.pcm:
+            # Crossfading: discord.py encodes the mixed PCM itself
+            self.voice_client.encoder.set_bitrate(kbps)
+            return
+        if getattr(getattr(engine.current, 'source', engine.current), 'mode', None) != 'transcode':
+            return  # passthrough and cached audio are not re-encoded
+        switches, offset = engine.switches, engine.position
+        source = await self.open_at(self.current, offset)
+        if source is not None:
+            engine.replace(source, offset, switches)
+
+    async def open_at(self, track, position, refresh=False):
+        """Open a song position seconds in and buffer its first frames; None when it cannot be played.
+
+        The stream URL is re-resolved first when it is about to expire, or always with
+        refresh (after the stream failed). The input seek means ffmpeg asks the server
+        for that part of the file instead of downloading it from the start.
+        """
+        if not audio_cache.has(track.id) and (refresh or self.prefetcher.needs_refresh(track, 30)):
+            if refresh:
+                resolve_cache.invalidate(track.id)
+            if not await self.prefetcher.refresh(track, 30, RESOLVE_INTERACTIVE):
+                return None
+        source = WarmSource(self.get_audio_source(track.url, track.passthrough, key=track.id, start=position, abr=track.abr))
+        await asyncio.get_running_loop().run_in_executor(None, source.warm, GAPLESS_WARM_FRAMES)
+        if not source.ready:
+            source.cleanup()
+            return None
+        return source
+
+    async def recover(self, track, position, engine=None, switches=0):
+        """Re-resolve a song whose stream failed and continue it at position.
+
+        With engine (the stream ended early) the engine is still playing silence and gets
+        the new source swapped in; without, the audio player stopped on an error and a
+        new engine is started. The song is skipped after RECOVERY_ATTEMPTS failures.
+        """
+        started = time.perf_counter()
+        previous, attempts = self._recovery
+        attempts = attempts + 1 if previous is track else 1
+        self._recovery = (track, attempts)
+        self.stats['recoveries'] += 1
+        print(f"Stream for {track.title} failed at {format_duration(position)} (attempt {attempts}), resuming")
+
+        source = None
+        if attempts <= RECOVERY_ATTEMPTS:
+            try:
+                source = await self.open_at(track, position, refresh=True)
+            except Exception as e:
+                print(f"Could not reopen {track.title}: {e}")
+        if self.voice_client is None or self.current is not track:
+            # Stopped or left while the stream was reopened
+            if source is not None:
+                source.cleanup()
+            return
+        elapsed = time.perf_counter() - started
+        if source is None:
+            self.stats['recovery_failed'] += 1
+            RECOVERY_SECONDS.observe(elapsed, outcome='failed')
+            print(f"Giving up on {track.title}")
+            if engine is not None:
+                if engine.switches == switches:
+                    engine.skip()
+            else:
+                await self.play_next()
+            return
+
+        self.stats['recovered'] += 1
+        self.stats['recovery_seconds'].append(elapsed)
+        RECOVERY_SECONDS.observe(elapsed, outcome='recovered')
+        if engine is not None:
+            engine.replace(source, position, switches)
+        else:
+            self._play(source, position)
+
+    async def seek(self, position):
+        """Jump to position seconds into the current song; False when nothing seekable is playing"""
+        engine = self.engine
+        track = self.current
+        if track is None or not track.duration or engine is None or self.voice_client is None \
+                or self.voice_client.source is not engine or engine.track is not track:
+            return False
+        switches = engine.switches
+        position = min(max(0.0, position), track.duration)
+        source = await self.open_at(track, position)
+        if source is None:
+            return False
+        engine.replace(source, position, switches, catch_up=False)
+        self.stats['seeks'] += 1
+        return True
+
+    @classmethod
+    def recovery_percentile(cls, percentile):
+        times = sorted(cls.stats['recovery_seconds'])
+        if not times:
+            return 0.0
+        return times[min(len(times) - 1, int(len(times) * percentile))]
+
+    async def leave_voice_channel(self):
+        """Leave the voice channel"""
+        if self.voice_client:
+            await self.voice_client.disconnect()
+            self.voice_client = None
+        session_store.forget(self.guild_id)
+        self.cancel_ingests()
+        self.queue.clear()
+        self.prefetcher.stop()
+        self.current = None
+        self.engine = None
+        self.is_playing = False
+        self.is_paused = False
+        await self.panel.close()
+
+    def get_audio_source(self, url, passthrough=False, key=None, start=0.0, abr=None):
+        """Get audio source from URL, remuxing Opus streams instead of re-encoding them"""
+        # Input seek, used to resume a track where it was when the bot restarted
+        seek = f' -ss {start:.2f}' if start > 0 else ''
+        cached = audio_cache.lookup(key) if key else None
+        if cached is not None:
+            # Cached tracks are Ogg Opus on local disk: no reconnect options needed
+            if CROSSFADE_MS > 0:
+                return TrackedPCMAudio(cached, mode='cached', before_options=seek.strip() or None, options='-vn')
+            return TrackedOpusAudio(cached, mode='cached', codec='copy', before_options=seek.strip() or None, options='-vn')
+        if CROSSFADE_MS > 0:
+            # Crossfading mixes decoded audio, so every track is decoded to PCM
+            return TrackedPCMAudio(
+                url,
+                mode='transcode',
+                before_options=FFMPEG_OPTIONS['before_options'] + seek,
+                options='-vn'
+            )
+        if passthrough:
+            return TrackedOpusAudio(
+                url,
+                mode='passthrough',
+                codec='copy',
+                before_options=FFMPEG_PASSTHROUGH_OPTIONS['before_options'] + seek,
+                options=FFMPEG_PASSTHROUGH_OPTIONS['options']
+            )
+        kbps = self.target_bitrate(abr)
+        complexity = opus_complexity(kbps)
+        degraded = ffmpeg_supervisor.degrade()
+        if degraded:
+            # The host is saturated: a cheaper encode beats stuttering for everyone
+            kbps = min(kbps, FFMPEG_DEGRADED_BITRATE)
+            complexity = min(complexity, 3)
+        return TrackedOpusAudio(
+            url,
+            mode='transcode',
+            degraded=degraded,
+            bitrate=kbps,
+            before_options=FFMPEG_OPTIONS['before_options'] + seek,
+            options=f"{FFMPEG_OPTIONS['options']} -compression_level {complexity}"
+        )
+
+    def is_idle(self, timeout, paused_timeout=None):
+        """True when nothing has played for longer than timeout seconds, or paused_timeout while paused"""
+        if self.voice_client and self.voice_client.is_playing():
+            return False
+        if paused_timeout is not None and self.voice_client and self.voice_client.is_paused():
+            timeout = paused_timeout
+        return time.monotonic() - self.last_active > timeout
+
+    def position(self):
+        """Seconds into the current song"""
+        source = self.voice_client.source if self.voice_client else None
+        if isinstance(source, PlaybackEngine):
+            return source.position
+        return 0.0
+
+    async def play_next(self, start_at=0.0):
+        """Play the next song in the queue, start_at seconds into it"""
+        self.last_active = time.monotonic()
+        self.is_playing = len(self.queue) > 0
+        while len(self.queue) > 0:
+            self.is_paused = False
+            self.current = self.queue.popleft()
+            start, start_at = start_at, 0.0  # only the first song resumes mid-way
+            
+            # Use the source the prefetcher opened ahead of time when there is one
+            source = self.prefetcher.take(self.current) if not start else None
+            if source is None:
+                if self.prefetcher.needs_refresh(self.current, 30):
+                    if self.current.url is not None:
+                        QueuePrefetcher.stats['stale_at_play'] += 1
+                    with trace_span(self.current.trace, 'stream_refresh'):
+                        await self.prefetcher.refresh(self.current, 30, RESOLVE_INTERACTIVE)
+                if self.current.url is None and not audio_cache.has(self.current.id):
+                    # Playlist entries are resolved lazily; skip ones that cannot be played
+                    print(f"Skipping {self.current.title}: could not resolve a stream")
+                    continue
+                with trace_span(self.current.trace, 'ffmpeg_spawn'):
+                    source = self.get_audio_source(
+                        self.current.url, self.current.passthrough, key=self.current.id, start=start,
+                        abr=self.current.abr
+                    )
+            audio_cache.record_play(self.current)
+            title_index.add(self.current.id, self.current.title, self.current.duration, self.guild_id, played=True)
+            self.prefetcher.poke()
+            if self._track_ended_at is not None:
+                PlaybackEngine.stats['fallback'] += 1
+            self._play(source, start)
+            return
+        
+        self.is_playing = False
+        self.current = None
+        self._track_ended_at = None
+        self.panel.request_update()
+
+    def _play(self, source, start=0.0):
+        """Start a new engine on the current song"""
+        self.engine = PlaybackEngine(
+            self, source, gapless=GAPLESS, crossfade_ms=CROSSFADE_MS, gap_started=self._track_ended_at,
+            start_offset=start, track=self.current
+        )
+        self._track_ended_at = None
+        self.bitrate = self.target_bitrate(self.current.abr)
+        if self.current.trace is not None:
+            self.current.trace.wait_for_audio(mode=getattr(getattr(source, 'source', source), 'mode', None))
+        # The bitrate only matters when crossfading, where discord.py encodes the PCM
+        self.voice_client.play(self.engine, after=self._after_playback, bitrate=self.bitrate)
+        self.panel.request_update()
+
+    def _after_playback(self, error):
+        """Called from the audio thread when the engine runs out of tracks or fails"""
+        self._track_ended_at = time.perf_counter()
+        if error is None:
+            asyncio.run_coroutine_threadsafe(self.play_next(), bot.loop)
+            return
+        print(f"Player error: {error}")
+        engine = self.engine
+        if engine is not None and engine.track is not None:
+            # Pick the song up where the error stopped it instead of abandoning the queue
+            asyncio.run_coroutine_threadsafe(self.recover(engine.track, engine.position), bot.loop)
+        else:
+            asyncio.run_coroutine_threadsafe(self.play_next(), bot.loop)
+
+    def on_track_advanced(self, entry):
+        """The engine switched to the next track without stopping"""
+        if self.queue and self.queue[0] is entry:
+            self.queue.popleft()
+        self.current = entry
+        self.bitrate = self.target_bitrate(entry.abr)
+        self.last_active = time.monotonic()
+        audio_cache.record_play(entry)
+        title_index.add(entry.id, entry.title, entry.duration, self.guild_id, played=True)
+        self.prefetcher.poke()
+        self.panel.request_update()
+
+    def skip(self):
+        """Skip the current song, handing over to the next one without a gap when possible"""
+        if self.voice_client and self.voice_client.is_playing():
+            if isinstance(self.voice_client.source, PlaybackEngine):
+                self.voice_client.source.skip()
+            else:
+                self.voice_client.stop()
+
+    async def add_to_queue(self, track):
+        """Add a song to the queue (raises QueueFull when it is at capacity)"""
+        self.queue.append(track)
+        if not self.is_playing and self.voice_client and not self.voice_client.is_playing():
+            await self.play_next()
+        else:
+            self.prefetcher.poke()
+            self.panel.request_update()
+
+    def cancel_ingests(self):
+        """Stop every playlist that is still being added to the queue"""
+        for ingest in list(self.ingests):
+            ingest.cancel()
+
+    def clear_queue(self):
+        """Remove every upcoming song"""
+        self.cancel_ingests()
+        self.queue.clear()
+        self.prefetcher.discard()
+        self.panel.request_update()
+
+    def remove(self, index):
+        """Remove the upcoming song at a 0-based position"""
+        track = self.queue.remove(index)
+        self.prefetcher.poke()
+        self.panel.request_update()
+        return track
+
+    def move(self, index, new_index):
+        """Move an upcoming song to another 0-based position"""
+        track = self.queue.move(index, new_index)
+        self.prefetcher.poke()
+        self.panel.request_update()
+        return track
+
+    def shuffle(self):
+        """Shuffle the upcoming songs"""
+        self.queue.shuffle()
+        self.prefetcher.poke()
+        self.panel.request_update()
+
+    def pause(self):
+        """Pause the current song"""
+        if self.voice_client and self.voice_client.is_playing():
+            self.voice_client.pause()
+            if isinstance(self.voice_client.source, PlaybackEngine):
+                self.voice_client.source.hold(True)
+            self.is_paused = True
+            self.last_active = time.monotonic()  # the paused timeout counts from here
+            self.panel.request_update()
+
+    def resume(self):
+        """Resume the paused song"""
+        if self.voice_client and self.voice_client.is_paused():
+            if isinstance(self.voice_client.source, PlaybackEngine):
+                self.voice_client.source.hold(False)
+            self.voice_client.resume()
+            self.is_paused = False
+            self.panel.request_update()
+
+    def stop(self):
+        """Stop the current song"""
+        if self.voice_client:
+            self.voice_client.stop()
+        self.is_playing = False
+        self.current = None
+        self.panel.request_update()
+
+
+class PlayerLimitReached(Exception):
+    """Raised when the maximum number of live players is reached"""
+
+
+class GuildPlayerManager:
+    """Creates one MusicPlayer per guild on demand and evicts idle ones"""
+
+    def __init__(self, idle_timeout=300, max_players=1000, paused_timeout=3600):
+        self.idle_timeout = idle_timeout
+        self.paused_timeout = paused_timeout
+        self.max_players = max_players
+        self._players = {}
+        self._reaper = None
+
+    def __len__(self):
+        return len(self._players)
+
+    def get(self, guild_id):
+        """Return the guild's player, creating it if needed"""
+        player = self._players.get(guild_id)
+        if player is None:
+            if len(self._players) >= self.max_players:
+                raise PlayerLimitReached("The bot is playing in too many servers right now")
+            player = self._players[guild_id] = MusicPlayer(guild_id)
+        player.last_active = time.monotonic()
+        return player
+
+    def peek(self, guild_id):
+        """Return the guild's player without creating one"""
+        player = self._players.get(guild_id)
+        if player is not None:
+            player.last_active = time.monotonic()
+        return player
+
+    async def evict(self, guild_id):
+        """Disconnect a guild's player and free its queue"""
+        player = self._players.pop(guild_id, None)
+        if player is not None:
+            try:
+                await player.leave_voice_channel()
+            except Exception as e:
+                print(f"Failed to disconnect idle player for guild {guild_id}: {e}")
+
+    def __iter__(self):
+        return iter(list(self._players.values()))
+
+    def queue_depths(self):
+        """(guild ID, songs queued) for every live player"""
+        return [(guild_id, len(player.queue)) for guild_id, player in list(self._players.items())]
+
+    async def evict_all(self):
+        """Disconnect every player"""
+        for guild_id in list(self._players):
+            await self.evict(guild_id)
+
+    def start(self):
+        """Start the background task that evicts idle players"""
+        if self._reaper is None or self._reaper.done():
+            self._reaper = asyncio.create_task(self._reap())
+
+    async def _reap(self):
+        interval = max(5.0, min(60.0, self.idle_timeout / 2))
+        while True:
+            await asyncio.sleep(interval)
+            idle = [
+                guild_id for guild_id, player in self._players.items()
+                if player.is_idle(self.idle_timeout, self.paused_timeout)
+            ]
+            for guild_id in idle:
+                await self.evict(guild_id)
+            if idle:
+                print(f"Evicted {len(idle)} idle player(s), {len(self._players)} still live")
+
+
+players = GuildPlayerManager(idle_timeout=PLAYER_IDLE_TIMEOUT, max_players=MAX_PLAYERS, paused_timeout=PLAYER_PAUSED_TIMEOUT)
+
+
+# Music Player Control Buttons
+class MusicPlayerControls(discord.ui.View):
+    """Now-playing buttons. Persistent: the buttons have fixed custom IDs and act on the
+    clicking guild's player, so one registered instance keeps old panels working after a
+    restart. Instances built with a player only render that player's button states."""
+
+    def __init__(self, player=None):
+        super().__init__(timeout=None)
+        self.player = player
+
+    async def update_buttons(self):
+        """Update button states based on player status"""
+        # Update play/pause button
+        if self.player.is_paused:
+            self.play_pause_button.emoji = "▶️"
+            self.play_pause_button.label = "Resume"
+        else:
+            self.play_pause_button.emoji = "⏸️"
+            self.play_pause_button.label = "Pause"
+        
+        # Enable/disable buttons based on state
+        has_music = self.player.current is not None
+        self.play_pause_button.disabled = not has_music
+        self.stop_button.disabled = not has_music
+        self.next_button.disabled = len(self.player.queue) == 0
+        self.previous_button.disabled = True  # Previous not implemented yet
+
+    @staticmethod
+    def _player_for(interaction):
+        """The clicking guild's player; a panel from before a restart becomes its panel again"""
+        player = players.peek(interaction.guild_id)
+        if player is not None and interaction.message is not None:
+            player.panel.reclaim(interaction.message)
+        return player
+    
+    @discord.ui.button(emoji="⏮️", style=discord.ButtonStyle.secondary, label="Previous", custom_id="music:previous")
+    async def previous_button(self, interaction: discord.Interaction, button: discord.ui.Button):
+        """Go to previous song (not implemented - would need history)"""
+        await interaction.response.send_message("⏮️ Previous song feature not available yet", ephemeral=True)
+    
+    @discord.ui.button(emoji="⏸️", style=discord.ButtonStyle.primary, label="Pause", custom_id="music:play_pause")
+    async def play_pause_button(self, interaction: discord.Interaction, button: discord.ui.Button):
+        """Toggle play/pause"""
+        player = self._player_for(interaction)
+        if player is not None and player.is_paused:
+            player.resume()
+            await interaction.response.send_message("▶️ Resumed", ephemeral=True)
+        elif player is not None and player.voice_client and player.voice_client.is_playing():
+            player.pause()
+            await interaction.response.send_message("⏸️ Paused", ephemeral=True)
+        else:
+            await interaction.response.send_message("Nothing is currently playing", ephemeral=True)
+    
+    @discord.ui.button(emoji="⏹️", style=discord.ButtonStyle.danger, label="Stop", custom_id="music:stop")
+    async def stop_button(self, interaction: discord.Interaction, button: discord.ui.Button):
+        """Stop playback"""
+        player = self._player_for(interaction)
+        if player is None:
+            await interaction.response.send_message("Nothing is currently playing", ephemeral=True)
+            return
+        player.stop()
+        await interaction.response.send_message("⏹️ Stopped", ephemeral=True)
+    
+    @discord.ui.button(emoji="⏭️", style=discord.ButtonStyle.secondary, label="Next", custom_id="music:next")
+    async def next_button(self, interaction: discord.Interaction, button: discord.ui.Button):
+        """Skip to next song"""
+        player = self._player_for(interaction)
+        if player is not None and player.voice_client and player.voice_client.is_playing():
+            player.skip()
+            await interaction.response.send_message("⏭️ Skipped", ephemeral=True)
+        elif player is not None and len(player.queue) > 0:
+            await player.play_next()
+            await interaction.response.send_message("⏭️ Playing next song", ephemeral=True)
+        else:
+            await interaction.response.send_message("No songs in queue", ephemeral=True)
+
+
+class NowPlayingPanel:
+    """The single now-playing message of a guild, kept in sync with its player.
+
+    Player state changes only mark the panel stale. The edit waits for the debounce
+    delay, so a burst of changes (a playlist streaming in, a row of skips) becomes one
+    edit showing the latest state, and edits are spaced at least min_interval apart to
+    stay inside the channel's message edit rate limit. In a channel the bot may not post
+    in, the panel is not posted, or is dropped on the first refused edit.
+    """
+
+    stats = {'requests': 0, 'edits': 0, 'posted': 0, 'failed': 0, 'forbidden': 0}
+
+    def __init__(self, player, debounce=0.75, min_interval=2.0):
+        self.player = player
+        self.debounce = debounce
+        self.min_interval = min_interval
+        self.message = None  # PartialMessage, so edits go through the bot's own rate limit buckets
+        self._stale = False
+        self._task = None
+        self._last_edit = 0.0
+
+    def allowed(self, channel):
+        """Whether the bot can see channel and post embeds in it; counted when it cannot"""
+        guild = getattr(channel, 'guild', None)
+        if guild is None or guild.me is None:
+            return True  # DMs, or a channel the cache does not know; the API decides
+        permissions = channel.permissions_for(guild.me)
+        if permissions.view_channel and permissions.send_messages and permissions.embed_links:
+            return True
+        self.stats['forbidden'] += 1
+        return False
+
+    async def render(self):
+        """Embed and buttons for the player's current state"""
+        player = self.player
+        track = player.current
+        if track is None:
+            embed = discord.Embed(
+                title="🎵 Nothing Playing",
+                description="Use `/play` to queue a song" if LEAN_MODE else f"Use `{PREFIX}play` or `/play` to queue a song",
+                color=discord.Color.dark_grey()
+            )
+        else:
+            embed = discord.Embed(
+                title="⏸️ Paused" if player.is_paused else "🎵 Now Playing",
+                description=f"**{track.title}**",
+                color=discord.Color.green()
+            )
+            embed.add_field(name="Duration", value=format_duration(track.duration), inline=True)
+            if track.requester:
+                embed.add_field(name="Requested by", value=f"<@{track.requester}>", inline=True)
+        if player.queue:
+            embed.add_field(name="Up Next", value=player.queue[0].title, inline=False)
+            embed.set_footer(
+                text=f"{len(player.queue)} song(s) queued • {format_duration(player.queue.total_duration)}"
+            )
+        view = MusicPlayerControls(player)
+        await view.update_buttons()
+        # The view only carries button states. Stopped views are not tracked per message by
+        # discord.py, so every click goes to the persistent view registered in setup_hook.
+        view.stop()
+        return embed, view
+
+    def request_update(self):
+        """Mark the panel stale; it is edited after the debounce delay"""
+        if self.message is None:
+            return
+        self.stats['requests'] += 1
+        self._stale = True
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush())
+
+    async def _flush(self):
+        # Changes made while an edit is in flight keep the loop going for one more edit
+        while self._stale and self.message is not None:
+            await asyncio.sleep(max(self.debounce, self._last_edit + self.min_interval - time.monotonic()))
+            self._stale = False
+            await self._edit()
+
+    async def _edit(self):
+        message = self.message
+        if message is None:
+            return
+        embed, view = await self.render()
+        self._last_edit = time.monotonic()
+        try:
+            await message.edit(content=None, embed=embed, view=view)
+            self.stats['edits'] += 1
+        except discord.NotFound:
+            # Someone deleted the panel; the next play command posts a new one
+            if self.message is message:
+                self.message = None
+        except discord.Forbidden:
+            # Permissions were taken away; stop refreshing until a play command finds a usable channel
+            self.stats['forbidden'] += 1
+            if self.message is message:
+                self.message = None
+            print(f"No permission to update the now playing panel in guild {self.player.guild_id}, leaving it")
+        except discord.HTTPException as e:
+            self.stats['failed'] += 1
+            print(f"Failed to update the now playing panel in guild {self.player.guild_id}: {e}")
+
+    async def _retire(self):
+        """Take the buttons off the current panel so only one panel is live"""
+        old, self.message = self.message, None
+        if old is not None:
+            try:
+                await old.edit(view=None)
+            except discord.HTTPException:
+                pass  # deleted or no longer editable; nothing to clean up
+
+    async def adopt(self, message, refresh=True):
+        """Turn a command's reply into the panel; refresh=False when it already shows the panel"""
+        if not self.allowed(message.channel):
+            await self._retire()
+            return
+        partial = message.channel.get_partial_message(message.id)
+        if self.message is None or self.message.id != partial.id:
+            await self._retire()
+            self.message = partial
+        self._stale = False
+        if refresh:
+            await self._edit()
+        else:
+            self._last_edit = time.monotonic()
+
+    async def ensure(self, channel):
+        """Post the panel in channel, unless it is already there"""
+        if self.message is not None and self.message.channel.id == channel.id:
+            self.request_update()
+            return
+        await self._retire()
+        if not self.allowed(channel):
+            return
+        embed, view = await self.render()
+        try:
+            message = await channel.send(embed=embed, view=view)
+        except discord.HTTPException as e:
+            self.stats['failed'] += 1
+            print(f"Failed to post the now playing panel in guild {self.player.guild_id}: {e}")
+            return
+        self.stats['posted'] += 1
+        self._last_edit = time.monotonic()
+        self.message = channel.get_partial_message(message.id)
+
+    def reclaim(self, message):
+        """Use a clicked panel again when the player has none (after a restart)"""
+        if self.message is None and self.allowed(message.channel):
+            self.message = message.channel.get_partial_message(message.id)
+            self.request_update()
+
+    async def close(self):
+        """Show that the player left and take the buttons off"""
+        message, self.message = self.message, None
+        self._stale = False
+        if message is None:
+            return
+        embed = discord.Embed(title="👋 Left the voice channel", color=discord.Color.dark_grey())
+        try:
+            await message.edit(content=None, embed=embed, view=None)
+        except discord.HTTPException:
+            pass  # deleted or no longer editable; nothing to clean up
+
+
+# ==================== YT-DLP POOL ====================
+
+def load_yt_dlp():
+    """Import yt-dlp on first use; it is slow to import and not needed to connect"""
+    global yt_dlp
+    if yt_dlp is None:
+        import yt_dlp as module
+        yt_dlp = module
+    return yt_dlp
+
+
+class YoutubeDLPool:
+    """Reusable YoutubeDL instances for one set of options.
+
+    Each instance keeps its HTTP connection pool, cookie jar and loaded extractors between
+    checkouts. Instances are recycled after max_uses checkouts, or straight away when the
+    code using them raises.
+    """
+
+    stats = {'created': 0, 'reused': 0, 'recycled': 0}
+
+    def __init__(self, options, size=4, max_uses=100):
+        self.options = options
+        self.size = size  # idle instances kept; busier moments create extra ones
+        self.max_uses = max_uses
+        self._idle = []  # [YoutubeDL, uses]
+        self._lock = threading.Lock()
+
+    def _create(self):
+        ydl = load_yt_dlp().YoutubeDL(self.options)
+        ydl.get_info_extractor('Youtube')  # most resolves need it, so load it up front
+        YoutubeDLPool.stats['created'] += 1
+        return [ydl, 0]
+
+    def _recycle(self, slot):
+        YoutubeDLPool.stats['recycled'] += 1
+        try:
+            slot[0].close()
+        except Exception as e:
+            print(f"Error closing yt-dlp instance: {e}")
+
+    @contextlib.contextmanager
+    def checkout(self):
+        """Borrow an instance for the duration of a with block"""
+        with self._lock:
+            slot = self._idle.pop() if self._idle else None
+        if slot is None:
+            slot = self._create()
+        else:
+            YoutubeDLPool.stats['reused'] += 1
+        try:
+            yield slot[0]
+        except BaseException:
+            self._recycle(slot)
+            raise
+        slot[1] += 1
+        if slot[1] < self.max_uses:
+            with self._lock:
+                if len(self._idle) < self.size:
+                    self._idle.append(slot)
+                    return
+        self._recycle(slot)
+
+    def warm(self):
+        """Fill the pool so the first resolves do not pay for set-up"""
+        while True:
+            with self._lock:
+                if len(self._idle) >= self.size:
+                    return
+            slot = self._create()
+            with self._lock:
+                if len(self._idle) >= self.size:
+                    break
+                self._idle.append(slot)
+        self._recycle(slot)
+
+    def drain(self):
+        """Close every idle instance"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for slot in idle:
+            self._recycle(slot)
+
+    @property
+    def idle(self):
+        return len(self._idle)
+
+
+ydl_pools = {
+    'resolve': YoutubeDLPool(YDL_OPTIONS, size=YDL_POOL_SIZE, max_uses=YDL_POOL_MAX_USES),
+    'search': YoutubeDLPool(
+        {**YDL_OPTIONS, 'extract_flat': True},
+        size=YDL_POOL_SIZE * max(1, len(SEARCH_ORDER)),
+        max_uses=YDL_POOL_MAX_USES
+    ),
+    'playlist': YoutubeDLPool(PLAYLIST_YDL_OPTIONS, size=2, max_uses=YDL_POOL_MAX_USES),
+}
+
+
+def warm_ydl_pools():
+    """Pre-create the instances resolves and searches use"""
+    ydl_pools['resolve'].warm()
+    if SEARCH_FLAT:
+        ydl_pools['search'].warm()
+
+
+def refresh_ydl_pools():
+    """Replace every idle instance with a fresh one"""
+    for pool in ydl_pools.values():
+        pool.drain()
+    warm_ydl_pools()
+
+
+# ==================== SEARCH ====================
+
+class SearchStrategy:
+    """Turns a text query into a video using a single yt-dlp search source"""
+
+    def __init__(self, name, prefix, flat=SEARCH_FLAT):
+        self.name = name
+        self.prefix = prefix  # yt-dlp search prefix, e.g. ytsearch
+        self.flat = flat  # only list results; the winner gets one targeted format resolve
+        self.stats = {'runs': 0, 'wins': 0, 'failures': 0, 'cancelled': 0, 'latency': deque(maxlen=500)}
+
+    def search(self, query, cancelled):
+        """Return the first result for query, or None"""
+        if cancelled.is_set():
+            return None
+        with ydl_pools['search' if self.flat else 'resolve'].checkout() as ydl:
+            info = ydl.extract_info(f"{self.prefix}:{query}", download=False)
+        entries = (info or {}).get('entries')
+        if not entries or cancelled.is_set():
+            return None
+        return entries[0]
+
+    def latency_percentile(self, percentile):
+        latencies = sorted(self.stats['latency'])
+        if not latencies:
+            return 0.0
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percentile))]
+
+
+SEARCH_STRATEGIES = {}
+
+
+def register_search_strategy(strategy):
+    """Make a search strategy available to SEARCH_ORDER"""
+    SEARCH_STRATEGIES[strategy.name] = strategy
+    return strategy
+
+
+register_search_strategy(SearchStrategy('ytmusic', 'ytmsearch'))
+register_search_strategy(SearchStrategy('youtube', 'ytsearch'))
+register_search_strategy(SearchStrategy('soundcloud', 'scsearch'))
+
+_search_executor = None
+_search_executor_lock = threading.Lock()
+
+
+def search_executor():
+    """Thread pool for racing searches, created lazily so process workers get their own"""
+    global _search_executor
+    with _search_executor_lock:
+        if _search_executor is None:
+            _search_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(1, RESOLVER_WORKERS * len(SEARCH_ORDER)),
+                thread_name_prefix='search'
+            )
+        return _search_executor
+
+
+def race_search(query, order=None, grace=SEARCH_GRACE):
+    """Run every search strategy at once and return (strategy, result) for the best-ranked winner.
+
+    The first strategy in order is preferred: once a lower-ranked one succeeds, higher-ranked
+    searches still running get grace seconds to finish before the lower-ranked result is taken.
+    """
+    strategies = [SEARCH_STRATEGIES[name] for name in (order or SEARCH_ORDER) if name in SEARCH_STRATEGIES]
+    if not strategies:
+        return None, None
+
+    started = time.monotonic()
+    cancelled = threading.Event()
+    executor = search_executor()
+    futures = {}
+    for rank, strategy in enumerate(strategies):
+        strategy.stats['runs'] += 1
+        futures[executor.submit(strategy.search, query, cancelled)] = rank
+
+    results = {}
+    pending = set(futures)
+    deadline = None
+    try:
+        while pending:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            done, pending = concurrent.futures.wait(pending, timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+            if not done:
+                break  # grace window ran out
+            for future in done:
+                strategy = strategies[futures[future]]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f"{strategy.name} search failed ({e})")
+                    result = None
+                if result is None:
+                    strategy.stats['failures'] += 1
+                    continue
+                strategy.stats['latency'].append(time.monotonic() - started)
+                results[futures[future]] = result
+            if results:
+                best = min(results)
+                if not any(futures[future] < best for future in pending):
+                    break
+                if deadline is None:
+                    deadline = time.monotonic() + grace
+    finally:
+        # Losers still queued never start; running ones drop their result
+        cancelled.set()
+        for future in pending:
+            future.cancel()
+            strategies[futures[future]].stats['cancelled'] += 1
+
+    if not results:
+        return None, None
+    winner = strategies[min(results)]
+    winner.stats['wins'] += 1
+    return winner, results[min(results)]
+
+
+def get_video_info(query, steps=None):
+    """Extract video information using yt-dlp.
+
+    With steps, a (name, start, end, attributes) tuple is appended for the search and
+    the format extraction, timed in wall-clock nanoseconds so process workers can report them.
+    """
+    steps = [] if steps is None else steps
+    try:
+        with ydl_pools['resolve'].checkout() as ydl:
+            # If it's not a URL, treat it as a search query
+            if not query.startswith(('http://', 'https://', 'www.', 'music.youtube.com')):
+                # Search every source at once, preferring YouTube Music for full-length tracks
+                started = time.time_ns()
+                strategy, info = race_search(query)
+                steps.append(('search', started, time.time_ns(), {'source': strategy.name if strategy else 'none'}))
+                if info is None:
+                    return None
+                if strategy.flat:
+                    # Flat results only carry the page URL; resolve formats for the winner alone
+                    started = time.time_ns()
+                    info = ydl.extract_info(info.get('url') or info.get('webpage_url'), download=False)
+                    steps.append(('extract', started, time.time_ns(), {}))
+            else:
+                search_query = query
+                started = time.time_ns()
+                info = ydl.extract_info(search_query, download=False)
+                steps.append(('extract', started, time.time_ns(), {}))
+            # Get the best audio URL from the format list
+            audio_format = info
+            if 'url' in info:
+                audio_url = info['url']
+            elif 'formats' in info:
+                # Find the best audio format
+                formats = info.get('formats', [])
+                audio_formats = [f for f in formats if f.get('acodec') != 'none' and f.get('vcodec') == 'none']
+                if audio_formats:
+                    # Sort by bitrate/quality and get the best one
+                    audio_formats.sort(key=lambda x: x.get('abr', 0) or x.get('tbr', 0), reverse=True)
+                    audio_format = audio_formats[0]
+                    audio_url = audio_format['url']
+                else:
+                    # Fallback to best format with audio
+                    best_format = formats[0] if formats else None
+                    audio_format = best_format or {}
+                    audio_url = best_format['url'] if best_format else None
+            else:
+                audio_url = None
+            
+            if not audio_url:
+                raise Exception("Could not extract audio URL")
+            
+            return {
+                'url': audio_url,
+                'title': info.get('title', 'Unknown'),
+                'duration': info.get('duration', 0),
+                'thumbnail': info.get('thumbnail', ''),
+                'id': info.get('id'),
+                'extractor': info.get('extractor_key', ''),
+                'webpage_url': info.get('webpage_url', ''),
+                'acodec': audio_format.get('acodec') or '',
+                'asr': audio_format.get('asr'),
+                'audio_channels': audio_format.get('audio_channels'),
+                'abr': audio_format.get('abr')
+            }
+    except Exception as e:
+        print(f"Error extracting info: {e}")
+        import traceback
+        traceback.print_exc()
+        return None
+
+
+def get_video_info_traced(query):
+    """get_video_info, returning (info, steps) for the caller's trace"""
+    steps = []
+    return get_video_info(query, steps), steps
+
+
+# ==================== RESOLVE CACHE ====================
+
+YOUTUBE_ID_RE = re.compile(
+    r'(?:youtube\.com/(?:watch\?(?:.*&)?v=|shorts/|embed/|live/)|youtu\.be/)([A-Za-z0-9_-]{11})'
+)
+EXPIRE_PATH_RE = re.compile(r'/expire/(\d+)')
+
+
+def extract_video_id(query):
+    """Return the YouTube video ID contained in a URL, or None"""
+    match = YOUTUBE_ID_RE.search(query)
+    return match.group(1) if match else None
+
+
+def parse_stream_expiry(url):
+    """Return the unix time a googlevideo stream URL expires at, or None"""
+    parsed = urllib.parse.urlparse(url)
+    expire = urllib.parse.parse_qs(parsed.query).get('expire')
+    if expire:
+        try:
+            return float(expire[0])
+        except ValueError:
+            return None
+    match = EXPIRE_PATH_RE.search(parsed.path)
+    return float(match.group(1)) if match else None
+
+
+def video_key(info):
+    """Key used for the second cache level: the YouTube ID, or the page URL for other sites"""
+    if info.get('id') and info.get('extractor', '').startswith('Youtube'):
+        return info['id']
+    return info.get('webpage_url') or None
+
+
+def video_key_url(key):
+    """URL that resolves a video key directly, skipping the search step"""
+    if key.startswith(('http://', 'https://')):
+        return key
+    return f"https://www.youtube.com/watch?v={key}"
+
+
+class ResolveCache:
+    """Two-level cache: query -> video key (long TTL), video key -> info with stream URL.
+
+    Stream entries expire when the googlevideo URL does (its ``expire=`` parameter),
+    minus a safety margin. Both levels are LRU with a size bound and can optionally be
+    written through to a SQLite file so they survive restarts. Writes are batched and
+    committed on one background thread, never on the event loop.
+    """
+
+    def __init__(self, max_size=2048, query_ttl=7 * 24 * 3600, default_ttl=3600,
+                 expiry_margin=300, db_path=''):
+        self.max_size = max_size
+        self.query_ttl = query_ttl
+        self.default_ttl = default_ttl
+        self.expiry_margin = expiry_margin
+        self._queries = OrderedDict()  # normalized query -> (video key, expires at)
+        self._videos = OrderedDict()  # video key -> (info, expires at, seconds it took to resolve)
+        self.stats = {
+            'lookups': 0,
+            'query_hits': 0,
+            'video_hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'latency_saved': 0.0,
+        }
+        self._db = None
+        self._executor = None
+        self._writes = []  # (sql, params) waiting for the writer thread
+        self._writes_lock = threading.Lock()
+        if db_path:
+            self._open_db(db_path)
+
+    @staticmethod
+    def normalize(query):
+        """Searches ignore case and spacing; URLs only in the scheme and host, as paths and tokens are case-sensitive"""
+        query = query.strip()
+        if query.lower().startswith(('http://', 'https://')):
+            parts = urllib.parse.urlsplit(query)
+            userinfo, at, host = parts.netloc.rpartition('@')
+            return urllib.parse.urlunsplit(
+                (parts.scheme.lower(), userinfo + at + host.lower(), parts.path, parts.query, parts.fragment)
+            )
+        return ' '.join(query.lower().split())
+
+    def _open_db(self, db_path):
+        """Open the SQLite file and load entries that have not expired yet"""
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS queries (query TEXT PRIMARY KEY, video_key TEXT, expires_at REAL)'
+        )
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS videos '
+            '(video_key TEXT PRIMARY KEY, info TEXT, expires_at REAL, resolve_seconds REAL)'
+        )
+        now = time.time()
+        self._db.execute('DELETE FROM queries WHERE expires_at <= ?', (now,))
+        self._db.execute('DELETE FROM videos WHERE expires_at <= ?', (now,))
+        self._db.commit()
+        # Keep the freshest entries, inserted oldest first so they evict in LRU order
+        queries = self._db.execute(
+            'SELECT query, video_key, expires_at FROM queries ORDER BY expires_at DESC LIMIT ?', (self.max_size,)
+        ).fetchall()
+        for query, key, expires_at in reversed(queries):
+            self._queries[query] = (key, expires_at)
+        videos = self._db.execute(
+            'SELECT video_key, info, expires_at, resolve_seconds FROM videos ORDER BY expires_at DESC LIMIT ?',
+            (self.max_size,)
+        ).fetchall()
+        for key, info, expires_at, resolve_seconds in reversed(videos):
+            self._videos[key] = (json.loads(info), expires_at, resolve_seconds)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='resolve-cache')
+        print(f'Resolve cache loaded {len(self._queries)} queries and {len(self._videos)} streams from {db_path}')
+
+    def _db_write(self, sql, params):
+        """Queue a write; writes queued while a commit is running go into the next one"""
+        if self._executor is None:
+            return
+        with self._writes_lock:
+            self._writes.append((sql, params))
+            if len(self._writes) > 1:
+                return  # a flush is already scheduled
+        self._executor.submit(self._flush)
+
+    def _flush(self):
+        with self._writes_lock:
+            writes, self._writes = self._writes, []
+        try:
+            with self._db:
+                for sql, params in writes:
+                    self._db.execute(sql, params)
+        except sqlite3.Error as e:
+            print(f'Resolve cache write failed: {e}')
+
+    def _query_key(self, query):
+        """Level-1 key for a query; URLs with a YouTube ID map straight to it"""
+        video_id = extract_video_id(query)
+        if video_id:
+            return None, video_id
+        return self.normalize(query), None
+
+    def lookup(self, query, min_ttl=0):
+        """Return (info, video key) for a query.
+
+        info is a cached result whose stream URL stays valid for at least min_ttl seconds
+        (and the expiry margin), or None. video key is set on a level-1 hit so the caller
+        can resolve the video directly instead of searching again.
+        """
+        now = time.time()
+        self.stats['lookups'] += 1
+        query_key, key = self._query_key(query)
+        if key is None:
+            entry = self._queries.get(query_key)
+            if entry is not None:
+                if entry[1] > now:
+                    self._queries.move_to_end(query_key)
+                    key = entry[0]
+                else:
+                    del self._queries[query_key]
+        if key is None:
+            self.stats['misses'] += 1
+            return None, None
+
+        entry = self._videos.get(key)
+        if entry is not None:
+            info, expires_at, resolve_seconds = entry
+            if expires_at - max(self.expiry_margin, min_ttl) > now:
+                self._videos.move_to_end(key)
+                self.stats['video_hits'] += 1
+                self.stats['latency_saved'] += resolve_seconds
+                return dict(info), key
+            # Expired entries stay until re-resolved; store() overwrites them
+        self.stats['query_hits'] += 1
+        return None, key
+
+    def search_seconds(self, key):
+        """How long the last full resolve of a video key took, used to credit skipped searches"""
+        entry = self._videos.get(key)
+        return entry[2] if entry else 0.0
+
+    def store(self, query, info, resolve_seconds):
+        """Cache a freshly resolved info dict under both levels"""
+        key = video_key(info)
+        if not key:
+            return
+        now = time.time()
+        query_key, _ = self._query_key(query)
+        if query_key is not None:
+            query_expires = now + self.query_ttl
+            self._queries[query_key] = (key, query_expires)
+            self._queries.move_to_end(query_key)
+            self._db_write(
+                'INSERT OR REPLACE INTO queries (query, video_key, expires_at) VALUES (?, ?, ?)',
+                (query_key, key, query_expires)
+            )
+
+        expires_at = parse_stream_expiry(info['url']) or now + self.default_ttl
+        previous = self._videos.get(key)
+        if previous is not None:
+            # Keep the cost of the original (search) resolve so later hits credit it
+            resolve_seconds = max(resolve_seconds, previous[2])
+        self._videos[key] = (dict(info), expires_at, resolve_seconds)
+        self._videos.move_to_end(key)
+        self._db_write(
+            'INSERT OR REPLACE INTO videos (video_key, info, expires_at, resolve_seconds) VALUES (?, ?, ?, ?)',
+            (key, json.dumps(info), expires_at, resolve_seconds)
+        )
+        self._evict()
+
+    def _evict(self):
+        while len(self._queries) > self.max_size:
+            query_key, _ = self._queries.popitem(last=False)
+            self.stats['evictions'] += 1
+            self._db_write('DELETE FROM queries WHERE query = ?', (query_key,))
+        while len(self._videos) > self.max_size:
+            key, _ = self._videos.popitem(last=False)
+            self.stats['evictions'] += 1
+            self._db_write('DELETE FROM videos WHERE video_key = ?', (key,))
+
+    def invalidate(self, key):
+        """Forget a video's stream URL (it stopped working) so the next lookup re-resolves it"""
+        self._videos.pop(key, None)
+
+    def hit_rate(self):
+        lookups = self.stats['lookups']
+        return self.stats['video_hits'] / lookups if lookups else 0.0
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)  # commit what is still queued
+            self._executor = None
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+resolve_cache = ResolveCache(
+    max_size=RESOLVE_CACHE_SIZE,
+    query_ttl=RESOLVE_CACHE_QUERY_TTL,
+    default_ttl=RESOLVE_CACHE_DEFAULT_TTL,
+    expiry_margin=RESOLVE_CACHE_EXPIRY_MARGIN,
+    db_path=RESOLVE_CACHE_DB,
+)
+
+
+# ==================== TITLE INDEX ====================
+
+class TitleIndex:
+    """In-memory word index of songs the bot has resolved, for /play autocomplete.
+
+    Titles, and the searches that led to them, are split into words. A query matches
+    songs that contain every one of its words, the last one as a prefix so suggestions
+    follow the user's typing; a word with no match falls back to close spellings.
+    Songs played in the asking guild rank first, then songs played most overall.
+    Lookups never touch the network.
+    """
+
+    WORD_RE = re.compile(r'\w+')
+    MAX_PREFIX_WORDS = 200  # words expanded from one prefix
+
+    def __init__(self, max_songs=5000, max_guild_songs=200):
+        self.max_songs = max_songs
+        self.max_guild_songs = max_guild_songs
+        self._songs = OrderedDict()  # video key -> [title, duration, plays, words], least recent first
+        self._words = {}  # word -> video keys
+        self._sorted_words = []  # for prefix lookups, rebuilt when words were added or dropped
+        self._sorted_stale = False
+        self._guilds = {}  # guild ID -> OrderedDict(video key -> plays), least recent first
+        self.stats = {'lookups': 0, 'latency': deque(maxlen=500)}
+
+    def __len__(self):
+        return len(self._songs)
+
+    @classmethod
+    def words(cls, text):
+        return set(cls.WORD_RE.findall(text.lower())) if text else set()
+
+    def add(self, key, title, duration=0, guild_id=None, alias=None, played=False):
+        """Index a song, with the search that found it as extra words"""
+        if not key or not title:
+            return
+        song = self._songs.get(key)
+        if song is None:
+            song = self._songs[key] = [title, duration or 0, 0, set()]
+            if len(self._songs) > self.max_songs:
+                self._drop(next(iter(self._songs)))
+        else:
+            self._songs.move_to_end(key)
+        for word in (self.words(title) | self.words(alias)) - song[3]:
+            keys = self._words.get(word)
+            if keys is None:
+                keys = self._words[word] = set()
+                self._sorted_stale = True
+            keys.add(key)
+            song[3].add(word)
+        if played:
+            song[2] += 1
+        if guild_id is not None:
+            guild = self._guilds.setdefault(guild_id, OrderedDict())
+            guild[key] = guild.pop(key, 0) + (1 if played else 0)
+            if len(guild) > self.max_guild_songs:
+                guild.popitem(last=False)
+
+    def _drop(self, key):
+        song = self._songs.pop(key)
+        for word in song[3]:
+            keys = self._words[word]
+            keys.discard(key)
+            if not keys:
+                del self._words[word]
+                self._sorted_stale = True
+
+    def load_resolve_cache(self, cache):
+        """Seed the index with what the resolve cache already knows"""
+        for key, (info, _, _) in list(cache._videos.items()):
+            self.add(key, info.get('title'), info.get('duration'))
+        for query, (key, _) in list(cache._queries.items()):
+            if key in self._songs:
+                self.add(key, self._songs[key][0], alias=query)
+
+    def _words_from(self, prefix, limit):
+        """Indexed words starting with prefix"""
+        if self._sorted_stale:
+            self._sorted_words = sorted(self._words)
+            self._sorted_stale = False
+        start = bisect.bisect_left(self._sorted_words, prefix)
+        # Slicing jumps to start; matches are contiguous from there, so stop at the first miss
+        return list(takewhile(
+            lambda word: word.startswith(prefix), self._sorted_words[start:start + limit]
+        ))
+
+    def _match(self, token, prefix):
+        """Video keys containing token (or a word starting with it)"""
+        keys = set(self._words.get(token, ()))
+        if prefix:
+            for word in self._words_from(token, self.MAX_PREFIX_WORDS):
+                keys |= self._words[word]
+        if not keys and len(token) >= 3:
+            # Typo: compare against words with the same first letter only, to stay fast
+            for word in difflib.get_close_matches(token, self._words_from(token[0], 5000), n=3, cutoff=0.75):
+                keys |= self._words[word]
+        return keys
+
+    def search(self, query, guild_id=None, limit=25):
+        """[(video key, title, duration)] best matching query, best first"""
+        started = time.perf_counter()
+        guild = self._guilds.get(guild_id, {})
+        tokens = self.WORD_RE.findall(query.lower())
+        if tokens:
+            candidates = None
+            for index, token in enumerate(tokens):
+                # The word being typed is a prefix; finished words must match whole
+                prefix = index == len(tokens) - 1 and not query[-1:].isspace()
+                keys = self._match(token, prefix)
+                candidates = keys if candidates is None else candidates & keys
+                if not candidates:
+                    break
+        else:
+            # Nothing typed yet: the guild's recent songs
+            candidates = set(islice(reversed(guild), limit))
+        ranked = sorted(
+            (key for key in candidates if key in self._songs),
+            key=lambda key: (key in guild, guild.get(key, 0), self._songs[key][2]),
+            reverse=True
+        )[:limit]
+        self.stats['lookups'] += 1
+        self.stats['latency'].append(time.perf_counter() - started)
+        return [(key, self._songs[key][0], self._songs[key][1]) for key in ranked]
+
+    def latency_percentile(self, percentile):
+        latencies = sorted(self.stats['latency'])
+        if not latencies:
+            return 0.0
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percentile))]
+
+
+title_index = TitleIndex(max_songs=TITLE_INDEX_SIZE)
+title_index.load_resolve_cache(resolve_cache)
+
+
+# ==================== AUDIO CACHE ====================
+
+SAFE_FILE_KEY_RE = re.compile(r'[A-Za-z0-9_-]{1,64}')
+
+
+class AudioCache:
+    """Keeps popular tracks on disk as Ogg Opus files named after their video key.
+
+    A track is saved in the background once it has been played min_plays times. Files are
+    written to a temporary name and renamed into place, so a half-written file is never
+    served. When the cache grows past max_bytes, files are evicted least recently used
+    first ('lru') or least often used first ('lfu', ties broken by recency). The startup
+    scan only stats the files; use counts start over after a restart.
+    """
+
+    def __init__(self, directory, max_bytes, min_plays=3, policy='lru', max_track_seconds=1200, workers=1):
+        self.directory = directory
+        self.enabled = bool(directory)
+        self.max_bytes = max_bytes
+        self.min_plays = min_plays
+        self.policy = policy
+        self.max_track_seconds = max_track_seconds
+        self.workers = workers
+        self.total_bytes = 0
+        self.stats = {'hits': 0, 'stored': 0, 'failed': 0, 'evictions': 0}
+        self._files = OrderedDict()  # file key -> [size, uses], least recently used first
+        self._plays = OrderedDict()  # file key -> plays, for tracks not cached yet
+        self._pending = set()
+        self._processes = set()
+        self._executor = None
+        self._lock = threading.Lock()
+        if self.enabled:
+            os.makedirs(directory, exist_ok=True)
+            self._scan()
+
+    @staticmethod
+    def file_key(key):
+        """File name stem for a video key; page URLs of other sites are hashed"""
+        if SAFE_FILE_KEY_RE.fullmatch(key):
+            return key
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def _path(self, file_key):
+        return os.path.join(self.directory, file_key + '.opus')
+
+    def _scan(self):
+        """Index existing files by name, size and modification time, without opening them"""
+        found = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                if entry.name.startswith('.') and entry.name.endswith('.tmp'):
+                    if self._abandoned(entry):
+                        os.remove(entry.path)  # left over from an interrupted write
+                elif entry.name.endswith('.opus'):
+                    stat = entry.stat()
+                    found.append((stat.st_mtime, entry.name[:-len('.opus')], stat.st_size))
+        for _, file_key, size in sorted(found):
+            self._files[file_key] = [size, 0]
+            self.total_bytes += size
+        self._evict()
+        print(f"Audio cache: {len(self._files)} file(s), {self.total_bytes / 1024 / 1024:.0f} MB")
+
+    def _abandoned(self, entry):
+        """True for a temporary file whose writer is gone: its pid is dead, or it is older than any write can take"""
+        try:
+            if time.time() - entry.stat().st_mtime > self.max_track_seconds * 2 + 60:
+                return True
+            pid = int(entry.name[:-len('.tmp')].rsplit('.', 1)[1])
+        except (OSError, IndexError, ValueError):
+            return True
+        if pid == os.getpid():
+            return True
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return True
+        except OSError:
+            pass  # exists, owned by someone else
+        return False
+
+    def has(self, key):
+        return self.enabled and bool(key) and self.file_key(key) in self._files
+
+    def lookup(self, key):
+        """Path of the cached file for a video key, or None"""
+        if not self.has(key):
+            return None
+        file_key = self.file_key(key)
+        with self._lock:
+            entry = self._files.get(file_key)
+            if entry is None:
+                return None
+            entry[1] += 1
+            self._files.move_to_end(file_key)
+            self.stats['hits'] += 1
+        path = self._path(file_key)
+        try:
+            os.utime(path)  # keeps recency across restarts
+        except OSError:
+            pass
+        return path
+
+    def record_play(self, track):
+        """Count a play and start saving the track once it is popular enough"""
+        if not self.enabled or not track.id or self.has(track.id) or not track.url:
+            return
+        if track.duration and track.duration > self.max_track_seconds:
+            return
+        file_key = self.file_key(track.id)
+        plays = self._plays.pop(file_key, 0) + 1
+        self._plays[file_key] = plays
+        while len(self._plays) > 10000:
+            self._plays.popitem(last=False)
+        if plays < self.min_plays or file_key in self._pending:
+            return
+        self._pending.add(file_key)
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix='audio-cache'
+            )
+        self._executor.submit(self._store, file_key, track.url, track.passthrough, track.duration)
+
+    def _store(self, file_key, url, passthrough, duration):
+        """Download a track to a temporary file and rename it into the cache"""
+        temp_path = os.path.join(self.directory, f".{file_key}.{os.getpid()}.tmp")
+        command = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-nostdin']
+        command += FFMPEG_OPTIONS['before_options'].split() + ['-i', url, '-vn']
+        if passthrough:
+            command += ['-c:a', 'copy']
+        else:
+            command += ['-c:a', 'libopus', '-b:a', AUDIO_CACHE_BITRATE, '-ar', '48000', '-ac', '2']
+        command += ['-f', 'opus', '-y', temp_path]
+        process = None
+        try:
+            process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            self._processes.add(process)
+            _, error = process.communicate(timeout=(duration or self.max_track_seconds) * 2 + 60)
+            if process.returncode != 0:
+                raise RuntimeError(error.decode(errors='replace').strip() or f"ffmpeg exited with {process.returncode}")
+            size = os.path.getsize(temp_path)
+            os.replace(temp_path, self._path(file_key))
+            with self._lock:
+                self._files[file_key] = [size, 0]
+                self.total_bytes += size
+                self._plays.pop(file_key, None)
+                self.stats['stored'] += 1
+                self._evict()
+        except Exception as e:
+            if process is not None and process.poll() is None:
+                process.kill()
+            self.stats['failed'] += 1
+            print(f"Failed to cache audio for {file_key}: {e}")
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+        finally:
+            self._processes.discard(process)
+            self._pending.discard(file_key)
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self._files:
+            if self.policy == 'lfu':
+                file_key = min(self._files.items(), key=lambda item: item[1][1])[0]
+            else:
+                file_key = next(iter(self._files))
+            size, _ = self._files.pop(file_key)
+            self.total_bytes -= size
+            self.stats['evictions'] += 1
+            try:
+                os.remove(self._path(file_key))
+            except OSError as e:
+                print(f"Failed to remove cached audio {file_key}: {e}")
+
+    def close(self):
+        """Stop saving tracks; partial downloads are removed on the next start"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+        for process in list(self._processes):
+            if process is not None and process.poll() is None:
+                process.kill()
+
+    def __len__(self):
+        return len(self._files)
+
+
+audio_cache = AudioCache(
+    # Budgets and indexes are per process, so every cluster worker keeps its own folder
+    os.path.join(AUDIO_CACHE_DIR, f'worker-{CLUSTER_ID}') if AUDIO_CACHE_DIR and CLUSTER_ID is not None else AUDIO_CACHE_DIR,
+    max_bytes=AUDIO_CACHE_MAX_BYTES,
+    min_plays=AUDIO_CACHE_MIN_PLAYS,
+    policy=AUDIO_CACHE_POLICY,
+    max_track_seconds=AUDIO_CACHE_MAX_TRACK_SECONDS,
+    workers=AUDIO_CACHE_WORKERS,
+)
+
+
+# ==================== SESSIONS ====================
+
+def track_row(track):
+    return (track.id, track.title, track.duration, track.requester, track.url, track.expires_at, int(track.passthrough))
+
+
+def track_from_row(row):
+    id, title, duration, requester, url, expires_at, passthrough = row
+    return Track(id, title, duration, requester, url, expires_at, bool(passthrough))
+
+
+class SessionStore:
+    """Saves each guild's queue, current song, position and voice channel to SQLite.
+
+    Snapshots are incremental: a guild's session row is only rewritten when something
+    about it changed, queue rows are inserted and deleted as songs are added and played
+    (tracked through TrackQueue.head_seq), and the queue is only rewritten in full after
+    it was reordered. State is collected on the event loop; the writes happen on one
+    background thread.
+    """
+
+    def __init__(self, db_path=''):
+        self.enabled = bool(db_path)
+        self.stats = {'snapshots': 0, 'rows_written': 0, 'full_rewrites': 0, 'restored': 0, 'last_ms': 0.0}
+        self._saved = {}  # guild ID -> (queue, generation, head seq, tail seq, session row) last written
+        self._frozen = False  # set after the final snapshot at shutdown
+        self._db = None
+        self._executor = None
+        self._task = None
+        if self.enabled:
+            directory = os.path.dirname(db_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS sessions (guild_id INTEGER PRIMARY KEY, channel_id INTEGER, '
+                'current TEXT, position REAL, saved_at REAL)'
+            )
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS queue (guild_id INTEGER, seq INTEGER, id TEXT, title TEXT, '
+                'duration REAL, requester INTEGER, url TEXT, expires_at REAL, passthrough INTEGER, '
+                'PRIMARY KEY (guild_id, seq)) WITHOUT ROWID'
+            )
+            self._db.commit()
+            # One thread owns every write, so they apply in the order they were collected
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='sessions')
+
+    def _collect(self, player_list):
+        """Work out what changed since the last snapshot (runs on the event loop)"""
+        changes = []
+        for player in player_list:
+            voice_client = player.voice_client
+            if voice_client is None or not voice_client.is_connected() or voice_client.channel is None:
+                continue
+            queue = player.queue
+            current = json.dumps(track_row(player.current)) if player.current is not None else None
+            session = (player.guild_id, voice_client.channel.id, current, round(player.position(), 1))
+            saved = self._saved.get(player.guild_id)
+            if saved is None or saved[0] is not queue or saved[1] != queue.generation:
+                rows = [(player.guild_id, queue.head_seq + index) + track_row(track) for index, track in enumerate(queue)]
+                changes.append((session, True, None, rows))
+            else:
+                _, _, saved_head, saved_tail, saved_session = saved
+                start = max(saved_tail, queue.head_seq)
+                rows = [
+                    (player.guild_id, seq) + track_row(track)
+                    for seq, track in enumerate(islice(queue, start - queue.head_seq, None), start)
+                ]
+                played_up_to = queue.head_seq if queue.head_seq != saved_head else None
+                if session == saved_session and not rows and played_up_to is None:
+                    continue
+                changes.append((session, False, played_up_to, rows))
+            self._saved[player.guild_id] = (queue, queue.generation, queue.head_seq, queue.tail_seq, session)
+        return changes
+
+    def _write(self, changes):
+        now = time.time()
+        written = 0
+        try:
+            with self._db:
+                for session, full, played_up_to, rows in changes:
+                    guild_id = session[0]
+                    self._db.execute('INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?)', session + (now,))
+                    if full:
+                        self._db.execute('DELETE FROM queue WHERE guild_id = ?', (guild_id,))
+                    elif played_up_to is not None:
+                        self._db.execute('DELETE FROM queue WHERE guild_id = ? AND seq < ?', (guild_id, played_up_to))
+                    if rows:
+                        self._db.executemany('INSERT OR REPLACE INTO queue VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+                    written += 1 + len(rows)
+        except sqlite3.Error as e:
+            print(f'Session snapshot failed: {e}')
+            # The file no longer matches what was last collected; rewrite everything next time
+            self._saved.clear()
+            return 0
+        return written
+
+    async def snapshot(self, player_list, final=False):
+        """Save what changed since the last snapshot"""
+        if not self.enabled or self._frozen:
+            return
+        started = time.perf_counter()
+        changes = self._collect(player_list)
+        if final:
+            self._frozen = True
+        if changes:
+            written = await asyncio.get_running_loop().run_in_executor(self._executor, self._write, changes)
+            self.stats['rows_written'] += written
+            self.stats['full_rewrites'] += sum(1 for change in changes if change[1])
+        self.stats['snapshots'] += 1
+        self.stats['last_ms'] = (time.perf_counter() - started) * 1000
+
+    def start(self, player_list, interval):
+        """Start the background task that takes a snapshot every interval seconds"""
+        if self.enabled and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._run(player_list, interval))
+
+    async def _run(self, player_list, interval):
+        while not self._frozen:
+            await asyncio.sleep(interval)
+            try:
+                await self.snapshot(player_list)
+            except Exception as e:
+                print(f'Session snapshot failed: {e}')
+
+    def forget(self, guild_id):
+        """Drop a guild's session, e.g. after it left voice on purpose"""
+        if not self.enabled or self._frozen:
+            return
+        self._saved.pop(guild_id, None)
+        self._executor.submit(self._delete, guild_id)
+
+    def _delete(self, guild_id):
+        try:
+            with self._db:
+                self._db.execute('DELETE FROM sessions WHERE guild_id = ?', (guild_id,))
+                self._db.execute('DELETE FROM queue WHERE guild_id = ?', (guild_id,))
+        except sqlite3.Error as e:
+            print(f'Failed to delete session for guild {guild_id}: {e}')
+
+    def _load(self, max_age):
+        cutoff = time.time() - max_age
+        with self._db:
+            self._db.execute('DELETE FROM queue WHERE guild_id IN (SELECT guild_id FROM sessions WHERE saved_at < ?)', (cutoff,))
+            self._db.execute('DELETE FROM sessions WHERE saved_at < ?', (cutoff,))
+        sessions = []
+        for guild_id, channel_id, current, position in self._db.execute(
+            'SELECT guild_id, channel_id, current, position FROM sessions'
+        ):
+            tracks = [track_from_row(row) for row in self._db.execute(
+                'SELECT id, title, duration, requester, url, expires_at, passthrough FROM queue '
+                'WHERE guild_id = ? ORDER BY seq', (guild_id,)
+            )]
+            current = track_from_row(json.loads(current)) if current else None
+            sessions.append((guild_id, channel_id, current, position or 0.0, tracks))
+        return sessions
+
+    async def load(self, max_age):
+        """(guild ID, channel ID, current song, position, queued songs) for sessions saved within max_age seconds"""
+        if not self.enabled:
+            return []
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._load, max_age)
+
+    def close(self):
+        """Finish pending writes and close the file"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+        self.enabled = False
+
+
+session_store = SessionStore(SESSION_DB)
+
+
+# ==================== RESOLVER POOL ====================
+
+class ResolverBusy(Exception):
+    """Raised when the resolver work queue is full"""
+
+
+class ResolverRateLimited(ResolverBusy):
+    """Raised when a user or guild has used up its lookups for now"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class ResolverCancelled(Exception):
+    """Raised when the requester went away before the job finished"""
+
+
+class TokenBucket:
+    """Refills rate tokens per second up to capacity; each request spends one"""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def wait_time(self):
+        """Seconds until a token is available (0 when one is)"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """A token bucket per key (user or guild ID); buckets that have refilled are dropped"""
+
+    def __init__(self, per_minute, burst, max_keys=10000):
+        self.rate = per_minute / 60
+        self.burst = max(1, burst)
+        self.max_keys = max_keys
+        self._buckets = {}
+
+    def wait_time(self, key):
+        if not self.rate or key is None:
+            return 0.0
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self.max_keys:
+                self._prune()
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.burst)
+        return bucket.wait_time()
+
+    def spend(self, key):
+        bucket = self._buckets.get(key)
+        if bucket is not None:
+            bucket.tokens -= 1
+
+    def _prune(self):
+        for key, bucket in list(self._buckets.items()):
+            if bucket.wait_time() == 0 and bucket.tokens >= bucket.capacity:
+                del self._buckets[key]
+
+
+class PrioritySlots:
+    """A semaphore whose waiters are served by priority (lowest first), then in arrival order"""
+
+    def __init__(self, slots):
+        self.free = slots
+        self._waiters = []  # heap of (priority, arrival, future)
+        self._arrivals = 0
+
+    def waiting(self, priority):
+        return sum(1 for waiter in self._waiters if waiter[0] == priority and not waiter[2].done())
+
+    async def acquire(self, priority):
+        if self.free > 0 and not self._waiters:
+            self.free -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._arrivals += 1
+        heapq.heappush(self._waiters, (priority, self._arrivals, future))
+        try:
+            await future
+        except BaseException:
+            if future.done() and not future.cancelled():
+                self.release()  # the slot was handed over just as the waiter gave up
+            raise
+
+    def release(self):
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.free += 1
+
+
+class ResolverPool:
+    """Runs get_video_info in a worker pool so extraction never blocks the event loop.
+
+    Jobs wait for a worker by priority class, so /play is not stuck behind prefetch or
+    playlist lookups, and for one of their guild's slots the same way, so it is not stuck
+    behind its own guild's either. Interactive lookups that miss the cache also spend a token
+    from the requesting user's and guild's buckets, and every class is turned away early
+    once the queue is deep enough.
+    """
+
+    def __init__(self, workers=4, mode='thread', max_pending=64, guild_concurrency=2, timeout=30.0, cache=None,
+                 guild_max_pending=8, user_rate=(6, 5), guild_rate=(30, 20)):
+        self.workers = workers
+        self.cache = cache
+        self.mode = mode
+        self.max_pending = max_pending
+        self.guild_concurrency = guild_concurrency
+        self.guild_max_pending = guild_max_pending
+        self.timeout = timeout
+        self.pending = 0
+        self.user_limits = RateLimiter(*user_rate)
+        self.guild_limits = RateLimiter(*guild_rate)
+        self.stats = {
+            name: {'started': 0, 'rejected': 0, 'rate_limited': 0, 'waits': deque(maxlen=500)}
+            for name in RESOLVE_PRIORITIES
+        }
+        self._executor = None
+        self._global_limit = PrioritySlots(workers)
+        self._guild_limits = {}  # guild_id -> [PrioritySlots, number of jobs using it]
+
+    def _get_executor(self):
+        """Create the worker pool on first use"""
+        if self._executor is None:
+            if self.mode == 'process':
+                # Forked workers start with the functions already loaded instead of importing bot.py again
+                context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+                self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+            else:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix='resolver'
+                )
+        return self._executor
+
+    def start(self):
+        """Start process-mode workers now, before this process has any other thread.
+
+        Forking once the event loop, the metrics server or the watchdog run can copy a lock
+        another thread holds into a worker, which then hangs on it.
+        """
+        if self.mode == 'process':
+            self._get_executor().submit(int).result()  # the pool forks all its workers on the first job
+
+    def _acquire_guild_limit(self, guild_id):
+        entry = self._guild_limits.get(guild_id)
+        if entry is None:
+            entry = self._guild_limits[guild_id] = [PrioritySlots(self.guild_concurrency), 0]
+        entry[1] += 1
+        return entry[0]
+
+    def _release_guild_limit(self, guild_id):
+        entry = self._guild_limits.get(guild_id)
+        if entry is not None:
+            entry[1] -= 1
+            if entry[1] <= 0:
+                del self._guild_limits[guild_id]
+
+    def charge(self, user_id=None, guild_id=None):
+        """Spend one lookup from the user's and the guild's token buckets.
+
+        Raises ResolverRateLimited, without spending anything, when either is empty.
+        """
+        user_wait = self.user_limits.wait_time(user_id)
+        guild_wait = self.guild_limits.wait_time(guild_id)
+        if user_wait or guild_wait:
+            self.stats['interactive']['rate_limited'] += 1
+            if user_wait >= guild_wait:
+                raise ResolverRateLimited("You are adding songs too quickly", user_wait)
+            raise ResolverRateLimited("This server is adding songs too quickly", guild_wait)
+        self.user_limits.spend(user_id)
+        self.guild_limits.spend(guild_id)
+
+    def queued(self, priority):
+        """Jobs of a priority class waiting for a worker"""
+        return self._global_limit.waiting(priority)
+
+    def wait_percentile(self, priority, percentile):
+        waits = sorted(self.stats[RESOLVE_PRIORITIES[priority]]['waits'])
+        if not waits:
+            return 0.0
+        return waits[min(len(waits) - 1, int(len(waits) * percentile))]
+
+    async def resolve(self, query, guild_id=None, is_alive=None, min_ttl=0, priority=RESOLVE_INTERACTIVE, user_id=None,
+                      trace=None):
+        """Resolve a query in the pool.
+
+        Cached results are returned straight away when their stream URL stays valid
+        for at least min_ttl seconds. With user_id, a lookup that needs a worker is charged
+        to the user's and guild's token buckets (see charge()). With trace, the wait for a worker
+        and the worker's search and extraction are added to it as spans.
+
+        Raises ResolverBusy when the work queue is full for this priority class or guild,
+        ResolverRateLimited when the user or guild is over its rate, asyncio.TimeoutError
+        when the job (including time spent waiting for a slot) exceeds the timeout, and
+        ResolverCancelled when is_alive() turns false before the job finishes.
+        """
+        key = None
+        if self.cache is not None:
+            info, key = self.cache.lookup(query, min_ttl=min_ttl)
+            if info is not None:
+                if trace is not None:
+                    trace.annotate(cache='hit')
+                return info
+        if trace is not None:
+            trace.annotate(cache='video' if key else 'miss')
+
+        stats = self.stats[RESOLVE_PRIORITIES[priority]]
+        if self.pending >= self.max_pending * RESOLVE_PENDING_SHARE[priority]:
+            stats['rejected'] += 1
+            raise ResolverBusy("The bot is busy looking up other songs")
+        guild_entry = self._guild_limits.get(guild_id)
+        if guild_id is not None and guild_entry is not None and guild_entry[1] >= self.guild_max_pending:
+            stats['rejected'] += 1
+            raise ResolverBusy("This server already has too many songs being looked up")
+        if user_id is not None:
+            self.charge(user_id, guild_id)
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+        queued_at = time.perf_counter()
+        self.pending += 1
+        guild_limit = self._acquire_guild_limit(guild_id)
+        try:
+            await self._acquire(guild_limit.acquire(priority), guild_limit, deadline, is_alive)
+            try:
+                await self._acquire(self._global_limit.acquire(priority), self._global_limit, deadline, is_alive)
+                try:
+                    if is_alive is not None and not is_alive():
+                        raise ResolverCancelled
+                    waited = time.perf_counter() - queued_at
+                    stats['started'] += 1
+                    stats['waits'].append(waited)
+                    RESOLVE_QUEUE_SECONDS.observe(waited, priority=RESOLVE_PRIORITIES[priority])
+                    # A level-1 cache hit resolves the video directly and skips the search
+                    target = video_key_url(key) if key else query
+                    started = time.perf_counter()
+                    if trace is None:
+                        job = loop.run_in_executor(self._get_executor(), get_video_info, target)
+                        info = await self._wait(job, deadline, is_alive)
+                    else:
+                        now = time.time_ns()
+                        trace.add('resolver_queue', now - int(waited * 1e9), now, priority=RESOLVE_PRIORITIES[priority])
+                        job = loop.run_in_executor(self._get_executor(), get_video_info_traced, target)
+                        info, steps = await self._wait(job, deadline, is_alive)
+                        for name, step_start, step_end, attributes in steps:
+                            trace.add(name, step_start, step_end, **attributes)
+                    elapsed = time.perf_counter() - started
+                    RESOLVE_SECONDS.observe(elapsed, outcome='ok' if info else 'failed')
+                    if info and self.cache is not None:
+                        if key:
+                            self.cache.stats['latency_saved'] += max(0.0, self.cache.search_seconds(key) - elapsed)
+                        self.cache.store(query, info, elapsed)
+                    return info
+                finally:
+                    self._global_limit.release()
+            finally:
+                guild_limit.release()
+        finally:
+            self._release_guild_limit(guild_id)
+            self.pending -= 1
+
+    async def _acquire(self, acquiring, semaphore, deadline, is_alive):
+        """Wait for a concurrency slot, giving up on timeout or when the requester is gone"""
+        acquire = asyncio.ensure_future(acquiring)
+        try:
+            await self._wait(acquire, deadline, is_alive)
+        except BaseException:
+            if acquire.done() and not acquire.cancelled():
+                semaphore.release()
+            raise
+
+    async def _wait(self, future, deadline, is_alive):
+        """Await a future, cancelling it on timeout or when is_alive() turns false"""
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    raise asyncio.TimeoutError
+                if is_alive is not None:
+                    remaining = min(remaining, 1.0)
+                done, _ = await asyncio.wait({future}, timeout=remaining)
+                if done:
+                    return future.result()
+                if is_alive is not None and not is_alive():
+                    raise ResolverCancelled
+        except BaseException:
+            future.cancel()
+            raise
+
+    async def warm(self, func):
+        """Run func in the pool ahead of the first resolve (once per worker in process mode)"""
+        loop = asyncio.get_running_loop()
+        executor = self._get_executor()
+        count = self.workers if self.mode == 'process' else 1
+        results = await asyncio.gather(
+            *(loop.run_in_executor(executor, func) for _ in range(count)), return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                print(f"Error warming resolver pool: {result}")
+
+    def shutdown(self):
+        """Stop the worker pool without waiting for running extractions"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+resolver = ResolverPool(
+    workers=RESOLVER_WORKERS,
+    mode=RESOLVER_MODE,
+    max_pending=RESOLVER_MAX_PENDING,
+    guild_concurrency=RESOLVER_GUILD_CONCURRENCY,
+    timeout=RESOLVER_TIMEOUT,
+    cache=resolve_cache,
+    guild_max_pending=RESOLVER_GUILD_MAX_PENDING,
+    user_rate=(RESOLVER_USER_RATE, RESOLVER_USER_BURST),
+    guild_rate=(RESOLVER_GUILD_RATE, RESOLVER_GUILD_BURST),
+)
+resolver.start()
+
+
+# ==================== PLAYLISTS ====================
+
+def is_playlist_url(query):
+    """True for playlist and album URLs (a single video inside a playlist is not one)"""
+    if not query.startswith(('http://', 'https://', 'www.', 'music.youtube.com')):
+        return False
+    parsed = urllib.parse.urlparse(query if '://' in query else f'https://{query}')
+    params = urllib.parse.parse_qs(parsed.query)
+    if 'list' in params and (parsed.path.rstrip('/') == '/playlist' or 'v' not in params):
+        return True
+    return parsed.path.startswith('/browse/') or '/sets/' in parsed.path
+
+
+def flat_entry_key(entry):
+    """Video key for a flat playlist entry, matching video_key() for resolved ones"""
+    if entry.get('id') and entry.get('ie_key', '').startswith('Youtube'):
+        return entry['id']
+    return entry.get('url') or entry.get('webpage_url')
+
+
+class PlaylistIngest:
+    """Streams a playlist into a player's queue.
+
+    A worker thread walks the flat (unresolved) playlist lazily, page by page, and hands
+    entries to the event loop through a small bounded queue. The first playable entry is
+    resolved straight away so audio starts as fast as for a single song; the rest are
+    queued unresolved and the prefetcher resolves them as they near the head.
+    """
+
+    FIRST_ENTRY_ATTEMPTS = 5
+
+    def __init__(self, player, url, requester=None, max_tracks=1000):
+        self.player = player
+        self.url = url
+        self.requester = requester
+        self.max_tracks = max_tracks
+        self.title = None
+        self.queued = 0
+        self._items = asyncio.Queue(maxsize=50)
+        self._stopped = threading.Event()
+        self._loop = None
+        self._producer = None
+        self._consumer = None
+
+    def _push(self, item):
+        """Hand an item to the event loop, waiting while the consumer is behind"""
+        future = asyncio.run_coroutine_threadsafe(self._items.put(item), self._loop)
+        while not self._stopped.is_set():
+            try:
+                future.result(timeout=1)
+                return True
+            except concurrent.futures.TimeoutError:
+                continue
+        future.cancel()
+        return False
+
+    def _produce(self):
+        """Walk the playlist in a worker thread"""
+        try:
+            with ydl_pools['playlist'].checkout() as ydl:
+                info = ydl.extract_info(self.url, download=False, process=False)
+                # Albums and some playlist links redirect to the real playlist first
+                for _ in range(3):
+                    if info.get('_type') not in ('url', 'url_transparent'):
+                        break
+                    info = ydl.extract_info(info['url'], download=False, process=False)
+                if not self._push(('playlist', info.get('title') or 'Playlist')):
+                    return
+                count = 0
+                for entry in info.get('entries') or []:
+                    if self._stopped.is_set() or count >= self.max_tracks:
+                        break
+                    if not entry or not flat_entry_key(entry):
+                        continue
+                    if not self._push(('entry', entry)):
+                        return
+                    count += 1
+        except Exception as e:
+            print(f"Error reading playlist {self.url}: {e}")
+            self._push(('error', str(e)))
+            return
+        self._push(('done', None))
+
+    def _track(self, entry):
+        return Track(flat_entry_key(entry), entry.get('title') or 'Unknown', entry.get('duration'), self.requester)
+
+    async def start(self, is_alive=None):
+        """Start ingesting and return the first queued Track once it is resolved, or None"""
+        self._loop = asyncio.get_running_loop()
+        self._producer = self._loop.run_in_executor(None, self._produce)
+        self.player.ingests.add(self)
+        try:
+            kind, value = await asyncio.wait_for(self._items.get(), RESOLVER_TIMEOUT)
+            if kind != 'playlist':
+                self.cancel()
+                return None
+            self.title = value
+
+            first = None
+            for _ in range(self.FIRST_ENTRY_ATTEMPTS):
+                kind, entry = await asyncio.wait_for(self._items.get(), RESOLVER_TIMEOUT)
+                if kind != 'entry':
+                    break
+                track = self._track(entry)
+                info = await resolver.resolve(
+                    video_key_url(track.id), guild_id=self.player.guild_id, is_alive=is_alive
+                )
+                if info:
+                    track.update_stream(info)
+                    first = track
+                    break
+            if first is None:
+                self.cancel()
+                return None
+
+            await self.player.add_to_queue(first)
+            self.queued = 1
+            self._consumer = asyncio.create_task(self._consume())
+            return first
+        except BaseException:
+            self.cancel()
+            raise
+
+    async def _consume(self):
+        """Queue the remaining entries as they arrive"""
+        try:
+            while True:
+                kind, entry = await self._items.get()
+                if kind != 'entry':
+                    break
+                await self.player.add_to_queue(self._track(entry))
+                self.queued += 1
+        except QueueFull:
+            pass
+        finally:
+            self._stopped.set()
+            self.player.ingests.discard(self)
+        print(f"Queued {self.queued} track(s) from playlist {self.title}")
+
+    def cancel(self):
+        """Stop reading the playlist; tracks already queued stay queued"""
+        self._stopped.set()
+        self.player.ingests.discard(self)
+        if self._consumer is not None and self._consumer is not asyncio.current_task():
+            self._consumer.cancel()
+
+
+# ==================== CLUSTER ====================
+
+CLUSTER_COMMANDS = {}
+
+
+def cluster_command(name):
+    """Register a coroutine function that can be broadcast to every worker"""
+    def decorator(func):
+        CLUSTER_COMMANDS[name] = func
+        return func
+    return decorator
+
+
+@cluster_command('leave_all')
+async def cluster_leave_all():
+    """Leave every voice channel"""
+    await players.evict_all()
+
+
+@cluster_command('recycle_ydl')
+async def cluster_recycle_ydl():
+    """Replace pooled yt-dlp instances, e.g. after updating cookies"""
+    await resolver.warm(refresh_ydl_pools)
+
+
+def cluster_stats_snapshot():
+    """Counters this process reports to the cluster launcher"""
+    return {
+        'shards': SHARD_IDS,
+        'pid': os.getpid(),
+        'guilds': len(bot.guilds),
+        'players': len(players),
+        'playing': sum(1 for voice_client in bot.voice_clients if voice_client.is_playing()),
+        'streams': len(ffmpeg_supervisor),
+        'latency': bot.latency,
+        'resolver_pending': resolver.pending,
+        'reported_at': time.time(),
+    }
+
+
+class ClusterClient:
+    """Worker end of the cluster IPC channel: reports stats and runs broadcast commands"""
+
+    def __init__(self, cluster_id, address, authkey):
+        self.cluster_id = cluster_id
+        self.address = address
+        self.authkey = authkey
+        self._conn = None
+        self._loop = None
+        self._thread = None
+        self._reporter = None
+        self._send_lock = threading.Lock()
+        self._replies = {}  # request id -> future
+        self._next_id = 0
+
+    def start(self, loop):
+        """Connect to the launcher; safe to call again on reconnect"""
+        if self._thread is not None:
+            return
+        self._loop = loop
+        self._conn = multiprocessing.connection.Client(self.address, authkey=self.authkey)
+        self.send({'op': 'hello', 'cluster': self.cluster_id, 'shards': SHARD_IDS})
+        self._thread = threading.Thread(target=self._run, name='cluster-ipc', daemon=True)
+        self._thread.start()
+        self._reporter = loop.create_task(self._report())
+
+    def send(self, message):
+        with self._send_lock:
+            self._conn.send(message)
+
+    async def request(self, op, timeout=5.0, **data):
+        """Send a request to the launcher and wait for its reply"""
+        self._next_id += 1
+        request_id = self._next_id
+        future = self._replies[request_id] = self._loop.create_future()
+        try:
+            self.send({'op': op, 'id': request_id, **data})
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self._replies.pop(request_id, None)
+
+    def _run(self):
+        while True:
+            try:
+                message = self._conn.recv()
+            except (EOFError, OSError):
+                break
+            self._loop.call_soon_threadsafe(self._dispatch, message)
+        # Without the launcher a restarted copy of this worker could run the same shards
+        print("Lost connection to the cluster launcher, shutting down")
+        asyncio.run_coroutine_threadsafe(bot.close(), self._loop)
+
+    def _dispatch(self, message):
+        op = message.get('op')
+        if op == 'reply':
+            future = self._replies.get(message.get('id'))
+            if future is not None and not future.done():
+                future.set_result(message.get('data'))
+        elif op == 'command':
+            func = CLUSTER_COMMANDS.get(message.get('command'))
+            if func is None:
+                print(f"Unknown cluster command: {message.get('command')}")
+            else:
+                asyncio.ensure_future(self._run_command(message['command'], func))
+
+    async def _run_command(self, name, func):
+        try:
+            await func()
+            print(f"Ran cluster command {name}")
+        except Exception as e:
+            print(f"Error running cluster command {name}: {e}")
+
+    async def _report(self):
+        while True:
+            try:
+                self.send({'op': 'stats', 'data': cluster_stats_snapshot()})
+            except (OSError, ValueError) as e:
+                print(f"Failed to report cluster stats: {e}")
+                return
+            await asyncio.sleep(CLUSTER_STATS_INTERVAL)
+
+
+cluster = ClusterClient(
+    int(CLUSTER_ID), (CLUSTER_IPC_HOST, CLUSTER_IPC_PORT), bytes.fromhex(CLUSTER_IPC_KEY)
+) if CLUSTER_ID is not None else None
+
+
+# ==================== TRACING ====================
+
+class Span:
+    """One timed step of a trace, in wall-clock nanoseconds"""
+
+    __slots__ = ('name', 'span_id', 'parent_id', 'start_ns', 'end_ns', 'attributes', 'error')
+
+    def __init__(self, name, parent_id=None, start_ns=None, attributes=None):
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.start_ns = time.time_ns() if start_ns is None else start_ns
+        self.end_ns = None
+        self.attributes = attributes or {}
+        self.error = None
+
+    @property
+    def seconds(self):
+        return ((self.end_ns or self.start_ns) - self.start_ns) / 1e9
+
+
+class PlayTrace:
+    """Spans of one play command, from the command arriving to the song's first audio frame.
+
+    Spans nest under the innermost span still open. The trace is handed to the tracer
+    once the command has returned and, if its song started playing, the voice client has
+    read the first frame (or TRACE_AUDIO_WAIT ran out).
+    """
+
+    def __init__(self, tracer, name, **attributes):
+        self.tracer = tracer
+        self.trace_id = os.urandom(16).hex()
+        self.root = Span(name, attributes=attributes)
+        self.spans = [self.root]
+        self.ttfa = None  # seconds from the command arriving to the first audio frame
+        self._open = [self.root]
+        self._audio = None  # span waiting for the first frame
+        self._ended = False
+        self._written = False
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        span = Span(name, self._open[-1].span_id, attributes=attributes)
+        self.spans.append(span)
+        self._open.append(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = str(e) or type(e).__name__
+            raise
+        finally:
+            span.end_ns = time.time_ns()
+            self._open.remove(span)
+
+    def add(self, name, start_ns, end_ns, **attributes):
+        """Record a step that was timed elsewhere, such as in a resolver worker"""
+        span = Span(name, self._open[-1].span_id, start_ns, attributes)
+        span.end_ns = end_ns
+        self.spans.append(span)
+
+    def annotate(self, **attributes):
+        """Add attributes to the innermost open span"""
+        self._open[-1].attributes.update(attributes)
+
+    def wait_for_audio(self, **attributes):
+        """The song was handed to the voice client; time until it reads the first frame"""
+        self._audio = Span('first_audio', self._open[-1].span_id, attributes=attributes)
+        self.spans.append(self._audio)
+
+    def heard(self):
+        """The first frame was read; called from the audio thread"""
+        bot.loop.call_soon_threadsafe(self._heard, time.time_ns())
+
+    def _heard(self, at):
+        if self._written or self._audio is None:
+            return
+        self._audio.end_ns = at
+        self.ttfa = (at - self.root.start_ns) / 1e9
+        if self._ended:
+            self._write()
+
+    def end(self):
+        """The command returned; write the trace now unless its song is still starting"""
+        self.root.end_ns = time.time_ns()
+        self._ended = True
+        if self._audio is not None and self._audio.end_ns is None:
+            asyncio.get_running_loop().call_later(TRACE_AUDIO_WAIT, self._give_up)
+        else:
+            self._write()
+
+    def _give_up(self):
+        if not self._written:
+            self._audio.end_ns = time.time_ns()
+            self._audio.error = "no audio"
+            self._write()
+
+    @property
+    def outcome(self):
+        if self.ttfa is not None:
+            return 'played'
+        if self._audio is not None:
+            return 'no_audio'
+        # Only commands that queued their song or playlist reach the follow-up
+        if any(span.name == 'followup' and span.error is None for span in self.spans):
+            return 'queued'
+        return 'failed'
+
+    def _write(self):
+        self._written = True
+        self.tracer.record(self)
+
+
+def trace_span(trace, name, **attributes):
+    """trace.span(), or nothing when there is no trace"""
+    return contextlib.nullcontext() if trace is None else trace.span(name, **attributes)
+
+
+def otlp_value(value):
+    """An attribute value in OTLP/JSON form"""
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+class Tracer:
+    """Collects finished play traces: time to first audio for !stats and /metrics, JSON lines in a file"""
+
+    def __init__(self, path='', format='json'):
+        self.path = path
+        self.format = format
+        self.stats = {
+            'outcomes': {},
+            'ttfa': deque(maxlen=500),
+            'spans': {},  # span name -> recent durations in seconds
+        }
+        self._file = None
+        self._lock = threading.Lock()
+
+    def start(self, name, **attributes):
+        return PlayTrace(self, name, **attributes)
+
+    def record(self, trace):
+        outcome = trace.outcome
+        self.stats['outcomes'][outcome] = self.stats['outcomes'].get(outcome, 0) + 1
+        for span in trace.spans[1:]:
+            if span.end_ns is not None:
+                self.stats['spans'].setdefault(span.name, deque(maxlen=500)).append(span.seconds)
+        if trace.ttfa is not None:
+            self.stats['ttfa'].append(trace.ttfa)
+            TTFA_SECONDS.observe(trace.ttfa, command=trace.root.name)
+        if self.path:
+            line = json.dumps(self.otlp(trace) if self.format == 'otlp' else self.summary(trace), separators=(',', ':'))
+            asyncio.get_running_loop().run_in_executor(None, self._append, line)
+
+    def _append(self, line):
+        with self._lock:
+            try:
+                if self._file is None:
+                    self._file = open(self.path, 'a', encoding='utf-8')
+                self._file.write(line + "\n")
+                self._file.flush()
+            except OSError as e:
+                print(f"Error writing trace to {self.path}: {e}")
+
+    def summary(self, trace):
+        """One trace as a flat JSON object, with span times in milliseconds from the command arriving"""
+        start = trace.root.start_ns
+        return {
+            'trace_id': trace.trace_id,
+            'span_id': trace.root.span_id,
+            'name': trace.root.name,
+            'time': datetime.datetime.fromtimestamp(start / 1e9, datetime.timezone.utc).isoformat(),
+            'ttfa_ms': None if trace.ttfa is None else round(trace.ttfa * 1000, 1),
+            'duration_ms': round(trace.root.seconds * 1000, 1),
+            'outcome': trace.outcome,
+            'attributes': trace.root.attributes,
+            'spans': [
+                {
+                    'name': span.name, 'span_id': span.span_id, 'parent_id': span.parent_id,
+                    'start_ms': round((span.start_ns - start) / 1e6, 1), 'duration_ms': round(span.seconds * 1000, 1),
+                    'attributes': span.attributes, 'error': span.error,
+                }
+                for span in trace.spans[1:]
+            ],
+        }
+
+    def otlp(self, trace):
+        """One trace as an OTLP/JSON ExportTraceServiceRequest; TTFA is the root span's play.ttfa_ms"""
+        root_attributes = dict(trace.root.attributes, outcome=trace.outcome)
+        if trace.ttfa is not None:
+            root_attributes['play.ttfa_ms'] = round(trace.ttfa * 1000, 1)
+        spans = []
+        for span in trace.spans:
+            attributes = root_attributes if span is trace.root else span.attributes
+            spans.append({
+                'traceId': trace.trace_id,
+                'spanId': span.span_id,
+                'parentSpanId': span.parent_id or '',
+                'name': span.name,
+                'kind': 1,  # SPAN_KIND_INTERNAL
+                'startTimeUnixNano': str(span.start_ns),
+                'endTimeUnixNano': str(span.end_ns or span.start_ns),
+                'attributes': [
+                    {'key': key, 'value': otlp_value(value)} for key, value in attributes.items() if value is not None
+                ],
+                'status': {'code': 2, 'message': span.error} if span.error else {},
+            })
+        return {'resourceSpans': [{
+            'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': 'discord-music-bot'}}]},
+            'scopeSpans': [{'scope': {'name': 'bot.play'}, 'spans': spans}],
+        }]}
+
+    def ttfa_percentile(self, percentile):
+        values = sorted(self.stats['ttfa'])
+        if not values:
+            return 0.0
+        return values[min(len(values) - 1, int(len(values) * percentile))]
+
+    def span_percentile(self, name, percentile):
+        values = sorted(self.stats['spans'].get(name, ()))
+        if not values:
+            return 0.0
+        return values[min(len(values) - 1, int(len(values) * percentile))]
+
+
+tracer = Tracer(TRACE_FILE, TRACE_FORMAT)
+
+
+# ==================== METRICS ====================
+
+def format_labels(labels):
+    """Render (name, value) pairs as a Prometheus label set"""
+    if not labels:
+        return ''
+    pairs = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+class Histogram:
+    """Prometheus-style histogram, optionally split by labels"""
+
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self._series = {}  # sorted label items -> [count per bucket..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = [(key, list(series)) for key, series in self._series.items()]
+        for key, series in snapshot:
+            for bound, count in zip(self.buckets, series):
+                lines.append(f"{self.name}_bucket{format_labels(key + (('le', f'{bound:g}'),))} {count}")
+            lines.append(f"{self.name}_bucket{format_labels(key + (('le', '+Inf'),))} {series[-1]}")
+            lines.append(f"{self.name}_sum{format_labels(key)} {series[-2]}")
+            lines.append(f"{self.name}_count{format_labels(key)} {series[-1]}")
+        return lines
+
+
+RESOLVE_SECONDS = Histogram(
+    'bot_resolve_seconds', 'Time spent in get_video_info per resolve',
+    (0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32)
+)
+INTERACTION_RESPONSE_SECONDS = Histogram(
+    'bot_interaction_response_seconds', 'Time from an interaction being created to the bot answering it',
+    (0.05, 0.1, 0.25, 0.5, 1, 2, 3, 5)
+)
+RESOLVE_QUEUE_SECONDS = Histogram(
+    'bot_resolve_queue_seconds', 'Time a lookup waited for a resolver worker, by priority class',
+    (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10)
+)
+RECOVERY_SECONDS = Histogram(
+    'bot_stream_recovery_seconds', 'Time from a stream failing mid-song to its replacement being ready',
+    (0.25, 0.5, 1, 2, 4, 8, 16)
+)
+TTFA_SECONDS = Histogram(
+    'bot_time_to_first_audio_seconds', 'Time from a play command arriving to the first audio frame of its song',
+    (0.25, 0.5, 1, 2, 3, 5, 8, 13, 20)
+)
+
+
+def _timed_response(method, kind):
+    async def timed(self, *args, **kwargs):
+        result = await method(self, *args, **kwargs)
+        interaction = getattr(self, '_parent', None)
+        if interaction is not None:
+            waited = (discord.utils.utcnow() - interaction.created_at).total_seconds()
+            INTERACTION_RESPONSE_SECONDS.observe(waited, kind=kind)
+        return result
+    timed.__wrapped__ = method
+    return timed
+
+
+def instrument_interaction_responses():
+    """Record interaction response latency for every slash command and button"""
+    for name, kind in (('defer', 'defer'), ('send_message', 'message'), ('edit_message', 'edit')):
+        method = getattr(discord.InteractionResponse, name)
+        if not hasattr(method, '__wrapped__'):
+            setattr(discord.InteractionResponse, name, _timed_response(method, kind))
+
+
+class LoopMonitor:
+    """Measures event loop lag by timing a short periodic sleep"""
+
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.lag = 0.0
+        self.last_tick = time.monotonic()
+        self._task = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self.last_tick = time.monotonic()
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.last_tick = time.monotonic()
+            self.lag = max(0.0, self.last_tick - started - self.interval)
+
+    def stalled_for(self):
+        """Current lag; keeps growing while the loop is blocked"""
+        return max(self.lag, time.monotonic() - self.last_tick - self.interval)
+
+
+class GatewayMonitor:
+    """Tracks how long each shard's gateway connection has been down, and the events it delivers"""
+
+    def __init__(self):
+        self.down_since = {}  # shard ID (None when unsharded) -> monotonic time it dropped
+        self.events = {}  # dispatch event name -> count received
+
+    def count_events(self, parsers):
+        """Count every gateway dispatch by type by wrapping discord.py's parsers (a plain call, no task per event)"""
+        for event, parser in list(parsers.items()):
+            if not hasattr(parser, '__wrapped__'):
+                parsers[event] = self._counted(event, parser)
+
+    def _counted(self, event, parser):
+        events = self.events
+
+        def counted(data):
+            events[event] = events.get(event, 0) + 1
+            return parser(data)
+        counted.__wrapped__ = parser
+        return counted
+
+    def up(self, shard_id=None):
+        self.down_since.pop(shard_id, None)
+
+    def down(self, shard_id=None):
+        self.down_since.setdefault(shard_id, time.monotonic())
+
+    def down_for(self):
+        now = time.monotonic()
+        return max((now - since for since in list(self.down_since.values())), default=0.0)
+
+
+loop_monitor = LoopMonitor(interval=0.1)
+gateway_monitor = GatewayMonitor()
+startup_phases = {}  # phase -> seconds after STARTED_AT, in the order they finished
+
+
+def mark_startup(phase):
+    """Record when a startup phase finished (only the first time)"""
+    if phase not in startup_phases:
+        startup_phases[phase] = time.monotonic() - STARTED_AT
+        print(f"Startup: {phase} after {startup_phases[phase]:.2f}s")
+
+
+class LoopWatchdog:
+    """Thread that logs what the event loop is running whenever it blocks past a threshold"""
+
+    stats = {'stalls': 0, 'longest': 0.0, 'recent': deque(maxlen=20)}  # recent: (wall time, seconds, location)
+
+    def __init__(self, monitor, threshold=0.25):
+        self.monitor = monitor
+        self.threshold = threshold
+        self.interval = max(0.02, threshold / 4)
+        self.loop_thread_id = None
+        self._thread = None
+
+    def start(self, loop_thread_id):
+        self.loop_thread_id = loop_thread_id
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='loop-watchdog', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        stalled_for = 0.0
+        location = None
+        while True:
+            time.sleep(self.interval)
+            lag = self.monitor.stalled_for()
+            if lag >= self.threshold:
+                if not stalled_for:
+                    # Grab the stack while the blocking call is still running
+                    frame = sys._current_frames().get(self.loop_thread_id)
+                    stack = traceback.extract_stack(frame) if frame is not None else traceback.StackSummary()
+                    location = f"{stack[-1].filename}:{stack[-1].lineno} in {stack[-1].name}" if stack else "unknown"
+                    print(f"Event loop blocked for {lag:.2f}s, currently running:\n{''.join(stack.format())}", end='')
+                stalled_for = max(stalled_for, lag)
+            elif stalled_for:
+                stats = LoopWatchdog.stats
+                stats['stalls'] += 1
+                stats['longest'] = max(stats['longest'], stalled_for)
+                stats['recent'].append((time.time(), stalled_for, location))
+                print(f"Event loop unblocked after {stalled_for:.2f}s ({location})")
+                stalled_for = 0.0
+
+
+def sample_stacks(seconds, interval=0.005):
+    """Sample every thread's stack and return (collapsed stacks, sample count).
+
+    The output is one "thread;outer;...;inner count" line per distinct stack, which
+    flamegraph.pl and speedscope read directly.
+    """
+    counts = {}
+    samples = 0
+    own_id = threading.get_ident()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            stack.append(names.get(thread_id, f"thread-{thread_id}"))
+            key = ';'.join(reversed(stack))
+            counts[key] = counts.get(key, 0) + 1
+        samples += 1
+        time.sleep(interval)
+    return "\n".join(f"{stack} {count}" for stack, count in sorted(counts.items())) + "\n", samples
+
+
+loop_watchdog = LoopWatchdog(loop_monitor, threshold=LOOP_LAG_THRESHOLD)
+profile_lock = threading.Lock()
+
+
+@bot.listen('on_connect')
+async def track_connect():
+    if not SHARDED:
+        gateway_monitor.up()
+
+
+@bot.listen('on_resumed')
+async def track_resumed():
+    if not SHARDED:
+        gateway_monitor.up()
+
+
+@bot.listen('on_disconnect')
+async def track_disconnect():
+    if not SHARDED:
+        gateway_monitor.down()
+
+
+@bot.listen('on_shard_connect')
+async def track_shard_connect(shard_id):
+    gateway_monitor.up(shard_id)
+
+
+@bot.listen('on_shard_resumed')
+async def track_shard_resumed(shard_id):
+    gateway_monitor.up(shard_id)
+
+
+@bot.listen('on_shard_disconnect')
+async def track_shard_disconnect(shard_id):
+    gateway_monitor.down(shard_id)
+
+
+def gateway_latencies():
+    """(shard ID, heartbeat latency) for every shard this process runs"""
+    if SHARDED:
+        return list(bot.latencies)
+    return [(0, bot.latency)]
+
+
+def render_metrics():
+    """Current metrics in the Prometheus text format"""
+    lines = (RESOLVE_SECONDS.render() + RESOLVE_QUEUE_SECONDS.render() + INTERACTION_RESPONSE_SECONDS.render()
+             + RECOVERY_SECONDS.render() + TTFA_SECONDS.render())
+
+    def add(name, kind, help, samples):
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            lines.append(f"{name}{format_labels(tuple(labels.items()))} {value}")
+
+    ffmpeg_usage = ffmpeg_supervisor.usage()
+    cache = resolve_cache.stats
+    add('bot_guilds', 'gauge', 'Guilds this process serves', [({}, len(bot.guilds))])
+    add('bot_players', 'gauge', 'Live per-guild players', [({}, len(players))])
+    add('bot_queue_depth', 'gauge', 'Songs waiting in each guild queue',
+        [({'guild': guild_id}, depth) for guild_id, depth in players.queue_depths()])
+    add('bot_voice_clients', 'gauge', 'Connected voice clients', [({}, len(bot.voice_clients))])
+    add('bot_ffmpeg_processes', 'gauge', 'Live ffmpeg processes',
+        [({'mode': mode}, usage[0]) for mode, usage in ffmpeg_usage.items()])
+    add('bot_ffmpeg_cpu_cores', 'gauge', 'CPU cores used by live ffmpeg processes over the last sample',
+        [({'mode': mode}, round(usage[1], 4)) for mode, usage in ffmpeg_usage.items()])
+    add('bot_ffmpeg_rss_bytes', 'gauge', 'Resident memory of live ffmpeg processes',
+        [({'mode': mode}, usage[2]) for mode, usage in ffmpeg_usage.items()])
+    add('bot_ffmpeg_supervisor_events_total', 'counter', 'ffmpeg processes killed, reaped and degraded, and players admitted, queued and rejected',
+        [({'event': event}, count) for event, count in FFmpegSupervisor.stats.items()])
+    if ffmpeg_supervisor.host_cpu is not None:
+        add('bot_host_cpu_busy', 'gauge', 'Busy share of all host CPU cores', [({}, round(ffmpeg_supervisor.host_cpu, 4))])
+    add('bot_ffmpeg_started_total', 'counter', 'ffmpeg processes started',
+        [({'mode': mode}, mode_stats['started']) for mode, mode_stats in TrackedFFmpegMixin.stats.items()])
+    add('bot_resolver_pending', 'gauge', 'Resolves queued or running', [({}, resolver.pending)])
+    add('bot_resolver_queued', 'gauge', 'Resolves waiting for a worker, by priority class',
+        [({'priority': name}, resolver.queued(priority)) for priority, name in enumerate(RESOLVE_PRIORITIES)])
+    add('bot_resolver_rejected_total', 'counter', 'Resolves turned away because the queue was too deep, by priority class',
+        [({'priority': name}, resolver.stats[name]['rejected']) for name in RESOLVE_PRIORITIES])
+    add('bot_resolver_rate_limited_total', 'counter', 'Lookups refused because a user or server was over its rate',
+        [({}, resolver.stats['interactive']['rate_limited'])])
+    add('bot_resolve_cache_lookups_total', 'counter', 'Resolve cache lookups', [({}, cache['lookups'])])
+    add('bot_resolve_cache_hits_total', 'counter', 'Resolve cache lookups answered without yt-dlp',
+        [({}, cache['video_hits'])])
+    if audio_cache.enabled:
+        add('bot_audio_cache_bytes', 'gauge', 'Bytes used by the local audio cache', [({}, audio_cache.total_bytes)])
+        add('bot_audio_cache_files', 'gauge', 'Tracks in the local audio cache', [({}, len(audio_cache))])
+        add('bot_audio_cache_events_total', 'counter', 'Local audio cache hits, saves, failures and evictions',
+            [({'event': event}, count) for event, count in audio_cache.stats.items()])
+    if session_store.enabled:
+        add('bot_session_snapshots_total', 'counter', 'Session snapshots taken', [({}, session_store.stats['snapshots'])])
+        add('bot_session_rows_written_total', 'counter', 'Session and queue rows written by snapshots',
+            [({}, session_store.stats['rows_written'])])
+        add('bot_session_snapshot_milliseconds', 'gauge', 'Duration of the last session snapshot',
+            [({}, session_store.stats['last_ms'])])
+    add('bot_gateway_latency_seconds', 'gauge', 'Gateway heartbeat latency',
+        [({'shard': shard_id}, latency) for shard_id, latency in gateway_latencies()])
+    add('bot_gateway_connected', 'gauge', 'Whether every gateway connection is up',
+        [({}, 0 if gateway_monitor.down_since else 1)])
+    add('bot_gateway_events_total', 'counter', 'Gateway events received, by type',
+        [({'event': event}, count) for event, count in list(gateway_monitor.events.items())])
+    add('bot_resident_memory_bytes', 'gauge', 'Resident memory of this bot process', [({}, read_process_rss(os.getpid()) or 0)])
+    add('bot_stream_recoveries_total', 'counter', 'Streams that failed mid-song, by whether they were resumed',
+        [({'outcome': 'recovered'}, MusicPlayer.stats['recovered']),
+         ({'outcome': 'failed'}, MusicPlayer.stats['recovery_failed'])])
+    add('bot_seeks_total', 'counter', 'Seeks within the current song', [({}, MusicPlayer.stats['seeks'])])
+    add('bot_play_traces_total', 'counter', 'Play commands traced, by outcome (played, queued, no_audio, failed)',
+        [({'outcome': outcome}, count) for outcome, count in list(tracer.stats['outcomes'].items())])
+    add('bot_panel_events_total', 'counter', 'Now playing panel update requests, edits, posts, failures and missing permissions',
+        [({'event': event}, count) for event, count in NowPlayingPanel.stats.items()])
+    add('bot_event_loop_lag_seconds', 'gauge', 'Event loop lag', [({}, round(loop_monitor.stalled_for(), 4))])
+    add('bot_startup_phase_seconds', 'gauge', 'Seconds from process start until each startup phase finished',
+        [({'phase': phase}, round(seconds, 3)) for phase, seconds in list(startup_phases.items())])
+    return "\n".join(lines) + "\n"
+
+
+def health_problems():
+    """Reasons the bot is unhealthy; an empty list means healthy"""
+    problems = []
+    stalled = loop_monitor.stalled_for()
+    if stalled > HEALTH_MAX_LOOP_LAG:
+        problems.append(f"event loop stalled for {stalled:.1f}s")
+    if bot.is_closed():
+        problems.append("client is closed")
+    elif not bot.is_ready():
+        if time.monotonic() - STARTED_AT > HEALTH_STARTUP_GRACE:
+            problems.append("not connected to the gateway")
+    else:
+        down = gateway_monitor.down_for()
+        if down > HEALTH_GATEWAY_GRACE:
+            problems.append(f"gateway disconnected for {down:.0f}s")
+    return problems
+
+
+def drop_prefix_commands():
+    """Lean mode: keep only the owner's admin commands (sent in DMs) next to the slash commands"""
+    for command in list(bot.commands):
+        if not command.extras.get('owner_only'):
+            bot.remove_command(command.name)
+
+
+@bot.event
+async def setup_hook():
+    mark_startup('logged_in')
+    gateway_monitor.count_events(bot._connection.parsers)
+    if LEAN_MODE:
+        drop_prefix_commands()
+    # Handles button clicks on panels posted before a restart
+    bot.add_view(MusicPlayerControls())
+    loop_monitor.start()
+    if LOOP_WATCHDOG:
+        loop_watchdog.start(threading.get_ident())
+    if METRICS_PORT:
+        instrument_interaction_responses()
+        MetricsServer(METRICS_HOST, metrics_port(CLUSTER_ID), asyncio.get_running_loop()).start()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(signum, request_shutdown)
+        except (NotImplementedError, RuntimeError):
+            pass  # no loop signal handlers on Windows; Ctrl+C still stops the bot
+
+
+_shutdown_task = None
+
+
+def request_shutdown():
+    """Save sessions and log out on SIGTERM/SIGINT; a second signal exits at once"""
+    global _shutdown_task
+    if _shutdown_task is not None:
+        print('Shutdown already in progress, exiting now')
+        os._exit(1)
+    print('Shutting down...')
+    _shutdown_task = asyncio.create_task(graceful_shutdown())
+
+
+async def graceful_shutdown():
+    try:
+        await session_store.snapshot(players, final=True)
+    except Exception as e:
+        print(f'Final session snapshot failed: {e}')
+    await bot.close()
+
+
+async def restore_sessions():
+    """Rejoin the voice channels saved before the last restart and resume their queues"""
+    restored = 0
+    for guild_id, channel_id, current, position, tracks in await session_store.load(SESSION_MAX_AGE):
+        guild = bot.get_guild(guild_id)
+        if guild is None:
+            continue  # another shard or cluster owns it, or the bot was removed
+        channel = guild.get_channel(channel_id)
+        if channel is None or not any(not member.bot for member in channel.members) or (current is None and not tracks):
+            session_store.forget(guild_id)
+            continue
+        try:
+            player = players.get(guild_id)
+        except PlayerLimitReached:
+            break
+        if player.voice_client is not None or player.queue:
+            continue  # someone started playing before the restore got here
+        # Stream URLs are re-resolved as needed through the resolve cache
+        for track in ([current] if current is not None else []) + tracks:
+            try:
+                player.queue.append(track)
+            except QueueFull:
+                break
+        try:
+            await player.join_voice_channel(channel)
+        except Exception as e:
+            print(f'Failed to rejoin voice in guild {guild_id}: {e}')
+            await players.evict(guild_id)
+            continue
+        await player.play_next(start_at=position if current is not None else 0.0)
+        restored += 1
+    session_store.stats['restored'] += restored
+    if restored:
+        print(f'Restored {restored} session(s)')
+
+
+async def resolve_query(query, guild_id=None, is_alive=None, user_id=None, trace=None):
+    """Resolve a query through the pool, returning (info, error message)"""
+    try:
+        with trace_span(trace, 'resolve'):
+            info = await resolver.resolve(query, guild_id=guild_id, is_alive=is_alive, user_id=user_id, trace=trace)
+    except ResolverRateLimited as e:
+        return None, f"⏳ {e}. Please try again in {math.ceil(e.retry_after)}s."
+    except ResolverBusy as e:
+        return None, f"⏳ {e}. Please try again in a moment."
+    except asyncio.TimeoutError:
+        return None, "❌ Timed out while looking up the song. Please try again."
+    if info:
+        # Typed searches become extra words for the song, so the same words suggest it next time
+        alias = None if query.startswith(('http://', 'https://')) else query
+        title_index.add(video_key(info), info.get('title'), info.get('duration'), guild_id, alias=alias)
+    return info, None
+
+
+async def start_playlist(player, url, requester=None, is_alive=None):
+    """Start streaming a playlist into the queue, returning (ingest, first track, error message)"""
+    try:
+        resolver.charge(requester, player.guild_id)
+    except ResolverRateLimited as e:
+        return None, None, f"⏳ {e}. Please try again in {math.ceil(e.retry_after)}s."
+    ingest = PlaylistIngest(player, url, requester=requester, max_tracks=PLAYLIST_MAX_TRACKS)
+    try:
+        first = await ingest.start(is_alive=is_alive)
+    except ResolverBusy as e:
+        return None, None, f"⏳ {e}. Please try again in a moment."
+    except asyncio.TimeoutError:
+        return None, None, "❌ Timed out while loading the playlist. Please try again."
+    if first is None:
+        return None, None, "❌ Could not load that playlist. It may be private or empty."
+    return ingest, first, None
+
+
+def build_added_embed(info, position):
+    """Reply for a song that was queued behind others"""
+    embed = discord.Embed(title="🎵 Added to Queue", description=f"**{info['title']}**", color=discord.Color.green())
+    embed.add_field(name="Duration", value=format_duration(info.get('duration')), inline=True)
+    embed.add_field(name="Position in Queue", value=position, inline=True)
+    if info.get('thumbnail'):
+        embed.set_thumbnail(url=info['thumbnail'])
+    return embed
+
+
+def build_playlist_embed(ingest, first, will_play_now):
+    """Embed announcing a playlist whose songs are still being queued"""
+    embed = discord.Embed(
+        title="📃 Playing Playlist" if will_play_now else "📃 Queueing Playlist",
+        description=f"**{ingest.title}**",
+        color=discord.Color.green()
+    )
+    embed.add_field(name="Now Playing" if will_play_now else "First Song", value=first.title, inline=False)
+    embed.set_footer(text="The rest of the playlist is being added to the queue in the background")
+    return embed
+
+
+QUEUE_PAGE_SIZE = 10
+
+
+def build_queue_embed(player, page=1):
+    """Build one page of the queue embed; only that page's tracks are read"""
+    embed = discord.Embed(title="📋 Music Queue", color=discord.Color.blue())
+    
+    if player.current:
+        embed.add_field(
+            name="🎵 Now Playing",
+            value=player.current.title,
+            inline=False
+        )
+    
+    if len(player.queue) > 0:
+        pages = (len(player.queue) - 1) // QUEUE_PAGE_SIZE + 1
+        page = max(1, min(page, pages))
+        start = (page - 1) * QUEUE_PAGE_SIZE
+        queue_list = "\n".join(
+            f"{start + i + 1}. {track.title} ({format_duration(track.duration)})"
+            for i, track in enumerate(player.queue.page(page - 1, QUEUE_PAGE_SIZE))
+        )
+        embed.add_field(name="Up Next", value=queue_list, inline=False)
+        embed.set_footer(
+            text=f"Page {page}/{pages} • {len(player.queue)} songs • {format_duration(player.queue.total_duration)} total"
+        )
+    
+    return embed
+
+
+_startup_task = None
 
 
-def get_video_info(query):
-    """Extract video information using yt-dlp"""
-    with yt_dlp.YoutubeDL(YDL_OPTIONS) as ydl:
+def command_tree_hash():
+    """Hash of every global application command as it would be sent to Discord"""
+    # to_dict(tree) is the payload tree.sync() sends; the tree argument needs discord.py 2.4
+    payload = sorted(
+        (command.to_dict(tree) for command in tree.get_commands()),
+        key=lambda command: (command.get('type', 1), command['name'])
+    )
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+async def sync_slash_commands(force=False):
+    """Sync slash commands unless they match the last sync; returns how many were synced, or None"""
+    state = f'{bot.application_id}:{command_tree_hash()}'
+    if not force:
         try:
-            # If it's not a URL, treat it as a search query
-            if not query.startswith(('http://', 'https://', 'www.', 'music.youtube.com')):
-                # Try YouTube Music first for better quality and full-length tracks
-                search_query = f"ytmsearch:{query}"
-                try:
-                    info = ydl.extract_info(search_query, download=False)
-                    # If it's a search result, get the first video
-                    if 'entries' in info:
-                        if info['entries']:
-                            info = info['entries'][0]
-                        else:
-                            raise Exception("No results from YouTube Music")
-                    else:
-                        raise Exception("Invalid response from YouTube Music")
-                except Exception as e:
-                    # Fallback to regular YouTube search if YouTube Music fails
-                    print(f"YouTube Music search failed ({e}), trying regular YouTube search...")
-                    search_query = f"ytsearch:{query}"
-                    info = ydl.extract_info(search_query, download=False)
-                    # If it's a search result, get the first video
-                    if 'entries' in info:
-                        if info['entries']:
-                            info = info['entries'][0]
-                        else:
-                            return None
-                    else:
-                        return None
-            else:
-                search_query = query
-                info = ydl.extract_info(search_query, download=False)
-            # Get the best audio URL from the format list
-            if 'url' in info:
-                audio_url = info['url']
-            elif 'formats' in info:
-                # Find the best audio format
-                formats = info.get('formats', [])
-                audio_formats = [f for f in formats if f.get('acodec') != 'none' and f.get('vcodec') == 'none']
-                if audio_formats:
-                    # Sort by bitrate/quality and get the best one
-                    audio_formats.sort(key=lambda x: x.get('abr', 0) or x.get('tbr', 0), reverse=True)
-                    audio_url = audio_formats[0]['url']
-                else:
-                    # Fallback to best format with audio
-                    best_format = formats[0] if formats else None
-                    audio_url = best_format['url'] if best_format else None
-            else:
-                audio_url = None
-            
-            if not audio_url:
-                raise Exception("Could not extract audio URL")
-            
-            return {
-                'url': audio_url,
-                'title': info.get('title', 'Unknown'),
-                'duration': info.get('duration', 0),
-                'thumbnail': info.get('thumbnail', '')
-            }
-        except Exception as e:
-            print(f"Error extracting info: {e}")
-            import traceback
-            traceback.print_exc()
-            return None
+            with open(COMMAND_SYNC_FILE) as f:
+                if f.read().strip() == state:
+                    print('Slash commands unchanged since the last sync, skipping it')
+                    return None
+        except OSError:
+            pass
+    synced = await tree.sync()
+    print(f'Synced {len(synced)} slash command(s)')
+    try:
+        temp_path = f'{COMMAND_SYNC_FILE}.tmp'
+        with open(temp_path, 'w') as f:
+            f.write(state + '\n')
+        os.replace(temp_path, COMMAND_SYNC_FILE)
+    except OSError as e:
+        print(f'Failed to save the slash command hash: {e}')
+    return len(synced)
+
+
+async def finish_startup():
+    """Startup work that does not need to hold up on_ready: warm yt-dlp and sync slash commands"""
+    async def warm():
+        await resolver.warm(warm_ydl_pools)
+        mark_startup('yt_dlp_warm')
+
+    async def sync():
+        # Commands are global, so one cluster is enough
+        if CLUSTER_ID in (None, '0'):
+            await sync_slash_commands()
+            mark_startup('commands_checked')
+
+    results = await asyncio.gather(warm(), sync(), return_exceptions=True)
+    for task, result in zip(('warm yt-dlp', 'sync slash commands'), results):
+        if isinstance(result, Exception):
+            print(f'Failed to {task}: {result}')
+            traceback.print_exception(result)
+
+
+@bot.listen('on_command_completion')
+async def track_first_command(ctx):
+    mark_startup('first_command')
+
+
+@bot.listen('on_app_command_completion')
+async def track_first_app_command(interaction, command):
+    mark_startup('first_command')
 
 
 @bot.event
 async def on_ready():
+    global _startup_task
     try:
         print(f'{bot.user} has connected to Discord!')
         print(f'Bot is in {len(bot.guilds)} guild(s)')
-        await bot.change_presence(activity=discord.Activity(type=discord.ActivityType.listening, name=f"{PREFIX}help"))
-        # Sync slash commands
-        try:
-            synced = await tree.sync()
-            print(f'Synced {len(synced)} slash command(s)')
-        except Exception as e:
-            print(f'Failed to sync slash commands: {e}')
-            import traceback
-            traceback.print_exc()
+        await bot.change_presence(activity=discord.Activity(
+            type=discord.ActivityType.listening, name="/help" if LEAN_MODE else f"{PREFIX}help"
+        ))
+        if cluster is not None:
+            cluster.start(asyncio.get_running_loop())
+            cluster.send({'op': 'ready'})
+        if _startup_task is not None:
+            return  # reconnected; the rest only runs once
+        mark_startup('ready')
+        players.start()
+        ffmpeg_supervisor.start()
+        _startup_task = asyncio.create_task(finish_startup())
+        if session_store.enabled:
+            await restore_sessions()
+            session_store.start(players, SESSION_SNAPSHOT_INTERVAL)
     except Exception as e:
         print(f'Error in on_ready: {e}')
         import traceback
         traceback.print_exc()
 
 
+@bot.event
+async def on_guild_remove(guild):
+    await players.evict(guild.id)
+
+
+@bot.listen('on_guild_channel_update')
+async def adapt_to_channel_bitrate(before, after):
+    if getattr(before, 'bitrate', None) == getattr(after, 'bitrate', None):
+        return
+    player = players.peek(after.guild.id)
+    if player and player.voice_client and player.voice_client.channel and player.voice_client.channel.id == after.id:
+        await player.adapt_bitrate()
+
+
 @bot.command(name='join', aliases=['j', 'connect'])
+@commands.guild_only()
 async def join(ctx):
     """Join the voice channel the user is in"""
     if not ctx.author.voice:
@@ -308,153 +4700,218 @@ async def join(ctx):
     
     channel = ctx.author.voice.channel
     try:
-        await music_player.join_voice_channel(channel)
+        player = players.get(ctx.guild.id)
+        await player.join_voice_channel(channel)
         await ctx.send(f"Joined {channel.name}")
     except Exception as e:
         await ctx.send(f"Failed to join voice channel: {e}")
 
 
 @bot.command(name='leave', aliases=['disconnect', 'dc', 'stop'])
+@commands.guild_only()
 async def leave(ctx):
     """Leave the voice channel"""
-    await music_player.leave_voice_channel()
+    await players.evict(ctx.guild.id)
     await ctx.send("Left the voice channel")
 
 
 @bot.command(name='play', aliases=['p'])
+@commands.guild_only()
 async def play(ctx, *, query):
     """Play a song from YouTube or other sources"""
     if not ctx.author.voice:
         await ctx.send("You need to be in a voice channel to use this command!")
         return
     
-    # Join voice channel if not already connected
-    if not music_player.voice_client or not music_player.voice_client.is_connected():
-        channel = ctx.author.voice.channel
-        await music_player.join_voice_channel(channel)
-    
-    # Show loading message
-    loading_msg = await ctx.send("🔍 Searching for the song...")
-    
+    trace = tracer.start('!play', guild_id=ctx.guild.id, playlist=is_playlist_url(query))
     try:
-        # Extract video info
-        info = get_video_info(query)
-        
-        if not info:
-            await loading_msg.edit(content="❌ Could not find the requested song. Please try a different search term or URL.")
+        try:
+            player = players.get(ctx.guild.id)
+            with trace.span('admit'):
+                await ffmpeg_supervisor.admit(player, timeout=FFMPEG_ADMIT_WAIT)
+        except (PlayerLimitReached, StreamLimitReached) as e:
+            await ctx.send(f"❌ {e}. Please try again later.")
             return
         
-        # Check if this song will start playing immediately (before adding to queue)
-        will_play_now = not music_player.is_playing and music_player.voice_client and not music_player.voice_client.is_playing()
-        
-        # Add to queue
-        await music_player.add_to_queue(info['url'], info['title'])
-        
-        # Format duration
-        duration = info['duration']
-        minutes, seconds = divmod(duration, 60)
-        duration_str = f"{int(minutes)}:{int(seconds):02d}"
+        # Join voice channel if not already connected
+        if not player.voice_client or not player.voice_client.is_connected():
+            channel = ctx.author.voice.channel
+            with trace.span('voice_connect'):
+                await player.join_voice_channel(channel)
         
-        embed = discord.Embed(
-            title="🎵 Added to Queue" if not will_play_now else "🎵 Now Playing",
-            description=f"**{info['title']}**",
-            color=discord.Color.green()
-        )
-        embed.add_field(name="Duration", value=duration_str, inline=True)
-        if not will_play_now:
-            embed.add_field(name="Position in Queue", value=len(music_player.queue), inline=True)
-        
-        if info['thumbnail']:
-            embed.set_thumbnail(url=info['thumbnail'])
-        
-        # Always show control buttons when there's music (playing or queued)
-        view = MusicPlayerControls()
-        await view.update_buttons()
+        # Show loading message
+        with trace.span('loading_message'):
+            loading_msg = await ctx.send("🔍 Searching for the song...")
         
-        await loading_msg.edit(content=None, embed=embed, view=view)
-        
-        # Store control message reference
-        view.control_message = loading_msg
-        
-    except Exception as e:
-        await loading_msg.edit(content=f"❌ An error occurred: {str(e)}")
+        try:
+            is_alive = lambda: player.voice_client is not None and player.voice_client.is_connected()
+            
+            if is_playlist_url(query):
+                will_play_now = not player.is_playing and player.voice_client and not player.voice_client.is_playing()
+                with trace.span('playlist'):
+                    ingest, first, error = await start_playlist(player, query, requester=ctx.author.id, is_alive=is_alive)
+                if error:
+                    await loading_msg.edit(content=error)
+                    return
+                
+                with trace.span('followup'):
+                    await loading_msg.edit(content=None, embed=build_playlist_embed(ingest, first, will_play_now))
+                    await player.panel.ensure(ctx.channel)
+                return
+            
+            # Extract video info in the resolver pool so the event loop keeps running
+            info, error = await resolve_query(
+                query, guild_id=ctx.guild.id, is_alive=is_alive, user_id=ctx.author.id, trace=trace
+            )
+            
+            if error:
+                await loading_msg.edit(content=error)
+                return
+            
+            if not info:
+                await loading_msg.edit(content="❌ Could not find the requested song. Please try a different search term or URL.")
+                return
+            
+            # Check if this song will start playing immediately (before adding to queue)
+            will_play_now = not player.is_playing and player.voice_client and not player.voice_client.is_playing()
+            
+            # Add to queue
+            track = Track.from_info(info, requester=ctx.author.id)
+            if will_play_now:
+                track.trace = trace
+            with trace.span('queue_insert'):
+                await player.add_to_queue(track)
+            
+            # A song that starts right away turns the reply into the guild's now-playing panel
+            with trace.span('followup'):
+                if will_play_now:
+                    await player.panel.adopt(loading_msg)
+                else:
+                    await loading_msg.edit(content=None, embed=build_added_embed(info, len(player.queue)))
+                    await player.panel.ensure(ctx.channel)
+            
+        except ResolverCancelled:
+            await loading_msg.edit(content="❌ Search cancelled because the bot left the voice channel.")
+        except QueueFull as e:
+            await loading_msg.edit(content=f"❌ {e}")
+        except Exception as e:
+            await loading_msg.edit(content=f"❌ An error occurred: {str(e)}")
+    finally:
+        trace.end()
 
 
 @bot.command(name='pause')
+@commands.guild_only()
 async def pause(ctx):
     """Pause the current song"""
-    if music_player.voice_client and music_player.voice_client.is_playing():
-        music_player.pause()
+    player = players.peek(ctx.guild.id)
+    if player and player.voice_client and player.voice_client.is_playing():
+        player.pause()
         await ctx.send("⏸️ Paused")
     else:
         await ctx.send("Nothing is currently playing")
 
 
 @bot.command(name='resume', aliases=['r'])
+@commands.guild_only()
 async def resume(ctx):
     """Resume the paused song"""
-    if music_player.voice_client and music_player.voice_client.is_paused():
-        music_player.resume()
+    player = players.peek(ctx.guild.id)
+    if player and player.voice_client and player.voice_client.is_paused():
+        player.resume()
         await ctx.send("▶️ Resumed")
     else:
         await ctx.send("Nothing is currently paused")
 
 
 @bot.command(name='skip', aliases=['s', 'next'])
+@commands.guild_only()
 async def skip(ctx):
     """Skip the current song"""
-    if music_player.voice_client and music_player.voice_client.is_playing():
-        music_player.voice_client.stop()
+    player = players.peek(ctx.guild.id)
+    if player and player.voice_client and player.voice_client.is_playing():
+        player.skip()
         await ctx.send("⏭️ Skipped")
     else:
         await ctx.send("Nothing is currently playing")
 
 
 @bot.command(name='queue', aliases=['q'])
-async def queue(ctx):
+@commands.guild_only()
+async def queue(ctx, page: int = 1):
     """Show the current queue"""
-    if not music_player.current and len(music_player.queue) == 0:
+    player = players.peek(ctx.guild.id)
+    if not player or (not player.current and len(player.queue) == 0):
         await ctx.send("The queue is empty")
         return
     
-    embed = discord.Embed(title="📋 Music Queue", color=discord.Color.blue())
-    
-    if music_player.current:
-        embed.add_field(
-            name="🎵 Now Playing",
-            value=music_player.current['title'],
-            inline=False
-        )
-    
-    if len(music_player.queue) > 0:
-        queue_list = "\n".join([f"{i+1}. {song['title']}" for i, song in enumerate(music_player.queue[:10])])
-        if len(music_player.queue) > 10:
-            queue_list += f"\n... and {len(music_player.queue) - 10} more"
-        embed.add_field(name="Up Next", value=queue_list, inline=False)
-    
-    await ctx.send(embed=embed)
+    await ctx.send(embed=build_queue_embed(player, page))
 
 
 @bot.command(name='clear')
+@commands.guild_only()
 async def clear(ctx):
     """Clear the queue"""
-    music_player.queue.clear()
+    player = players.peek(ctx.guild.id)
+    if player:
+        player.clear_queue()
     await ctx.send("🗑️ Queue cleared")
 
 
+@bot.command(name='remove', aliases=['rm'])
+@commands.guild_only()
+async def remove(ctx, position: int):
+    """Remove a song from the queue by its position"""
+    player = players.peek(ctx.guild.id)
+    if not player or not 1 <= position <= len(player.queue):
+        await ctx.send("There is no song at that position in the queue")
+        return
+    
+    track = player.remove(position - 1)
+    await ctx.send(f"🗑️ Removed **{track.title}** from the queue")
+
+
+@bot.command(name='move', aliases=['mv'])
+@commands.guild_only()
+async def move(ctx, position: int, new_position: int):
+    """Move a song in the queue to another position"""
+    player = players.peek(ctx.guild.id)
+    if not player or not 1 <= position <= len(player.queue) or not 1 <= new_position <= len(player.queue):
+        await ctx.send("There is no song at that position in the queue")
+        return
+    
+    track = player.move(position - 1, new_position - 1)
+    await ctx.send(f"↕️ Moved **{track.title}** to position {new_position}")
+
+
+@bot.command(name='shuffle')
+@commands.guild_only()
+async def shuffle(ctx):
+    """Shuffle the queue"""
+    player = players.peek(ctx.guild.id)
+    if not player or len(player.queue) < 2:
+        await ctx.send("Not enough songs in the queue to shuffle")
+        return
+    
+    player.shuffle()
+    await ctx.send("🔀 Queue shuffled")
+
+
 @bot.command(name='volume', aliases=['vol'])
+@commands.guild_only()
 async def volume(ctx, vol: int = None):
     """Set or show the volume (0-100)"""
+    player = players.peek(ctx.guild.id)
     if vol is None:
-        if music_player.voice_client and music_player.voice_client.source:
-            current_vol = int(music_player.voice_client.source.volume * 100)
+        if player and player.voice_client and player.voice_client.source:
+            current_vol = int(player.voice_client.source.volume * 100)
             await ctx.send(f"Current volume: {current_vol}%")
         else:
             await ctx.send("No audio source is currently playing")
     else:
         if 0 <= vol <= 100:
-            if music_player.voice_client and music_player.voice_client.source:
-                music_player.voice_client.source.volume = vol / 100
+            if player and player.voice_client and player.voice_client.source:
+                player.voice_client.source.volume = vol / 100
                 await ctx.send(f"🔊 Volume set to {vol}%")
             else:
                 await ctx.send("No audio source is currently playing")
@@ -462,6 +4919,316 @@ async def volume(ctx, vol: int = None):
             await ctx.send("Volume must be between 0 and 100")
 
 
+@bot.command(name='bitrate')
+@commands.guild_only()
+async def bitrate(ctx, kbps: int = None):
+    """Set this server's transcode bitrate in kbps (0 matches the voice channel), or show it"""
+    player = players.peek(ctx.guild.id)
+    if not player or not player.voice_client:
+        await ctx.send("Not connected to a voice channel")
+        return
+    if kbps is None:
+        mode = "set for this server" if player.bitrate_override else "matched to the voice channel"
+        await ctx.send(f"🎚️ Bitrate: {player.target_bitrate(player.current.abr if player.current else None)} kbps ({mode})")
+        return
+    if kbps and not 32 <= kbps <= 512:
+        await ctx.send("Bitrate must be between 32 and 512 kbps, or 0 to match the voice channel")
+        return
+    player.bitrate_override = kbps or None
+    await player.adapt_bitrate()
+    await ctx.send(f"🎚️ Bitrate set to {kbps} kbps" if kbps else "🎚️ Bitrate matched to the voice channel")
+
+
+@bot.command(name='seek')
+@commands.guild_only()
+async def seek(ctx, position: str):
+    """Jump to a time in the current song (seconds, m:ss or h:mm:ss)"""
+    seconds = parse_timestamp(position)
+    if seconds is None:
+        await ctx.send("Give the time as seconds, m:ss or h:mm:ss")
+        return
+    player = players.peek(ctx.guild.id)
+    if not player or not player.current:
+        await ctx.send("Nothing is playing right now")
+        return
+    if not player.current.duration or seconds >= player.current.duration:
+        await ctx.send(f"Can't seek to {format_duration(seconds)} in this song")
+        return
+    if await player.seek(seconds):
+        await ctx.send(f"⏩ Jumped to {format_duration(seconds)}")
+    else:
+        await ctx.send("❌ Could not seek in this song")
+
+
+@bot.command(name='stats', extras={'owner_only': True})
+@commands.is_owner()
+async def stats(ctx):
+    """Show performance statistics (bot owner only)"""
+    embed = discord.Embed(title="📊 Bot Statistics", color=discord.Color.blue())
+
+    cache = resolve_cache.stats
+    embed.add_field(
+        name="Resolve Cache",
+        value=(
+            f"Hit rate: {resolve_cache.hit_rate():.1%} ({cache['video_hits']}/{cache['lookups']})\n"
+            f"Search skipped: {cache['query_hits']}\n"
+            f"Latency saved: {cache['latency_saved']:.1f}s\n"
+            f"Entries: {len(resolve_cache._queries)} queries, {len(resolve_cache._videos)} streams\n"
+            f"Evictions: {cache['evictions']}"
+        ),
+        inline=False
+    )
+    if audio_cache.enabled:
+        audio = audio_cache.stats
+        embed.add_field(
+            name="Audio Cache",
+            value=(
+                f"Files: {len(audio_cache)} ({audio_cache.total_bytes / 1024 / 1024:.0f}/"
+                f"{audio_cache.max_bytes / 1024 / 1024:.0f} MB, {audio_cache.policy.upper()})\n"
+                f"Plays from disk: {audio['hits']}\n"
+                f"Saved: {audio['stored']} (failed: {audio['failed']}), evicted: {audio['evictions']}"
+            ),
+            inline=False
+        )
+    if session_store.enabled:
+        sessions = session_store.stats
+        embed.add_field(
+            name="Sessions",
+            value=(
+                f"Snapshots: {sessions['snapshots']} (last {sessions['last_ms']:.1f} ms)\n"
+                f"Rows written: {sessions['rows_written']}, full rewrites: {sessions['full_rewrites']}\n"
+                f"Restored at startup: {sessions['restored']}"
+            ),
+            inline=False
+        )
+    prefetch = QueuePrefetcher.stats
+    embed.add_field(
+        name="Prefetch",
+        value=(
+            f"Refreshed: {prefetch['refreshed']} (failed: {prefetch['refresh_failed']})\n"
+            f"Stale at play: {prefetch['stale_at_play']}\n"
+            f"Sources opened ahead used: {prefetch['sources_used']}, discarded: {prefetch['sources_discarded']}"
+        ),
+        inline=False
+    )
+    embed.add_field(
+        name="Resolver Pool",
+        value=(
+            f"Pending: {resolver.pending}/{resolver.max_pending}\nWorkers: {resolver.workers} ({resolver.mode})\n"
+            + "".join(
+                f"{name.capitalize()}: {resolver.queued(priority)} queued, {resolver.stats[name]['started']} run, "
+                f"wait p50 {resolver.wait_percentile(priority, 0.5) * 1000:.0f} ms / "
+                f"p99 {resolver.wait_percentile(priority, 0.99) * 1000:.0f} ms, "
+                f"{resolver.stats[name]['rejected']} turned away\n"
+                for priority, name in enumerate(RESOLVE_PRIORITIES)
+            )
+            + f"Rate limited: {resolver.stats['interactive']['rate_limited']}\n"
+            f"yt-dlp instances: {YoutubeDLPool.stats['created']} created, {YoutubeDLPool.stats['reused']} reused, "
+            f"{YoutubeDLPool.stats['recycled']} recycled, {ydl_pools['resolve'].idle} idle"
+        ),
+        inline=False
+    )
+    embed.add_field(name="Players", value=f"Live: {len(players)}/{players.max_players}", inline=False)
+
+    events = sorted(gateway_monitor.events.items(), key=lambda item: item[1], reverse=True)
+    rss = read_process_rss(os.getpid())
+    gateway_lines = [
+        f"Mode: {'lean (slash only)' if LEAN_MODE else 'prefix and slash'}",
+        f"Events: {sum(count for _, count in events)} "
+        f"({', '.join(f'{event} {count}' for event, count in events[:4]) or 'none yet'})",
+    ]
+    if rss:
+        per_thousand = rss / max(1, len(bot.guilds)) * 1000
+        gateway_lines.append(f"Memory: {rss / 1024 / 1024:.0f} MB ({per_thousand / 1024 / 1024:.0f} MB per 1,000 guilds)")
+    embed.add_field(name="Gateway", value="\n".join(gateway_lines), inline=False)
+
+    search_lines = []
+    for name in SEARCH_ORDER:
+        strategy = SEARCH_STRATEGIES.get(name)
+        if strategy is None:
+            continue
+        search = strategy.stats
+        search_lines.append(
+            f"{name}: {search['wins']}/{search['runs']} won, {search['failures']} failed, "
+            f"{search['cancelled']} cancelled, p50 {strategy.latency_percentile(0.5):.2f}s, "
+            f"p99 {strategy.latency_percentile(0.99):.2f}s"
+        )
+    if search_lines:
+        embed.add_field(name="Search", value="\n".join(search_lines), inline=False)
+    embed.add_field(
+        name="Autocomplete",
+        value=(
+            f"Songs indexed: {len(title_index)}\n"
+            f"Lookups: {title_index.stats['lookups']}, p50 {title_index.latency_percentile(0.5) * 1000:.2f} ms, "
+            f"p99 {title_index.latency_percentile(0.99) * 1000:.2f} ms"
+        ),
+        inline=False
+    )
+
+    audio_lines = []
+    ffmpeg_usage = ffmpeg_supervisor.usage()
+    for mode, mode_stats in TrackedFFmpegMixin.stats.items():
+        live, cpu, rss = ffmpeg_usage[mode]
+        audio_lines.append(
+            f"{mode.capitalize()}: {live} live ({cpu:.0%} CPU, {rss / 1024 / 1024:.0f} MB), "
+            f"{mode_stats['started']} started, {TrackedFFmpegMixin.cpu_per_stream(mode):.1%} CPU per stream"
+        )
+    supervisor = FFmpegSupervisor.stats
+    host_cpu = ffmpeg_supervisor.host_cpu
+    audio_lines.append(
+        f"Host CPU: {'n/a' if host_cpu is None else f'{host_cpu:.0%}'}"
+        f"{' (saturated)' if ffmpeg_supervisor.saturated else ''}, "
+        f"transcode cap: {ffmpeg_supervisor.transcode_capacity() or 'none'}, "
+        f"process cap: {ffmpeg_supervisor.max_processes or 'none'}"
+    )
+    audio_lines.append(
+        f"Degraded: {supervisor['degraded']}, killed: {supervisor['killed']}, reaped: {supervisor['reaped']}, "
+        f"queued: {supervisor['queued']}, refused: {supervisor['rejected']}"
+    )
+    embed.add_field(name="Audio Streams", value="\n".join(audio_lines), inline=False)
+
+    panel = NowPlayingPanel.stats
+    embed.add_field(
+        name="Now Playing Panels",
+        value=(
+            f"Updates requested: {panel['requests']}, edits: {panel['edits']} "
+            f"({panel['requests'] - panel['edits']} coalesced)\n"
+            f"Posted: {panel['posted']}, failed: {panel['failed']}, no permission: {panel['forbidden']}"
+        ),
+        inline=False
+    )
+
+    engine = PlaybackEngine.stats
+    embed.add_field(
+        name="Track Transitions",
+        value=(
+            f"Gapless: {engine['gapless']}, fallback: {engine['fallback']}\n"
+            f"Gap p50: {PlaybackEngine.gap_percentile(0.5) * 1000:.1f} ms, "
+            f"p99: {PlaybackEngine.gap_percentile(0.99) * 1000:.1f} ms"
+        ),
+        inline=False
+    )
+
+    recovery = MusicPlayer.stats
+    embed.add_field(
+        name="Stream Recovery",
+        value=(
+            f"Failures: {recovery['recoveries']}, resumed: {recovery['recovered']}, "
+            f"gave up: {recovery['recovery_failed']}\n"
+            f"Resume p50: {MusicPlayer.recovery_percentile(0.5):.2f}s, "
+            f"p99: {MusicPlayer.recovery_percentile(0.99):.2f}s\n"
+            f"Seeks: {recovery['seeks']}"
+        ),
+        inline=False
+    )
+
+    outcomes = tracer.stats['outcomes']
+    # The slowest steps by p50, so a regression in time to first audio points at its cause
+    slowest = sorted(tracer.stats['spans'], key=lambda name: tracer.span_percentile(name, 0.5), reverse=True)[:4]
+    embed.add_field(
+        name="Time to First Audio",
+        value=(
+            f"p50: {tracer.ttfa_percentile(0.5):.2f}s, p99: {tracer.ttfa_percentile(0.99):.2f}s "
+            f"({outcomes.get('played', 0)} played, {outcomes.get('queued', 0)} queued, "
+            f"{outcomes.get('no_audio', 0) + outcomes.get('failed', 0)} failed)\n"
+            f"Slowest steps (p50): "
+            f"{', '.join(f'{name} {tracer.span_percentile(name, 0.5):.2f}s' for name in slowest) or 'none yet'}"
+        ),
+        inline=False
+    )
+
+    watchdog = LoopWatchdog.stats
+    loop_lines = [
+        f"Lag: {loop_monitor.stalled_for() * 1000:.0f} ms",
+        f"Stalls over {LOOP_LAG_THRESHOLD * 1000:.0f} ms: {watchdog['stalls']} (longest {watchdog['longest']:.2f}s)",
+    ]
+    if watchdog['recent']:
+        _, seconds, location = watchdog['recent'][-1]
+        loop_lines.append(f"Last: {seconds:.2f}s at {os.path.basename(location)}")
+    embed.add_field(name="Event Loop", value="\n".join(loop_lines), inline=False)
+
+    if startup_phases:
+        embed.add_field(
+            name="Startup",
+            value="\n".join(f"{phase}: {seconds:.2f}s" for phase, seconds in list(startup_phases.items())),
+            inline=False
+        )
+
+    await ctx.send(embed=embed)
+
+
+@bot.command(name='sync', extras={'owner_only': True})
+@commands.is_owner()
+async def sync(ctx):
+    """Sync slash commands with Discord even if they look unchanged (bot owner only)"""
+    try:
+        synced = await sync_slash_commands(force=True)
+    except Exception as e:
+        await ctx.send(f"❌ Sync failed: {e}")
+        return
+    await ctx.send(f"✅ Synced {synced} slash command(s)")
+
+
+@bot.command(name='profile', extras={'owner_only': True})
+@commands.is_owner()
+async def profile(ctx, seconds: float = 10.0):
+    """Sample every thread and upload flamegraph-ready collapsed stacks (bot owner only)"""
+    if not profile_lock.acquire(blocking=False):
+        await ctx.send("❌ A profile is already running.")
+        return
+    try:
+        seconds = max(1.0, min(seconds, PROFILE_MAX_SECONDS))
+        await ctx.send(f"🔬 Profiling for {seconds:g}s...")
+        collapsed, samples = await asyncio.get_running_loop().run_in_executor(
+            None, sample_stacks, seconds, PROFILE_INTERVAL
+        )
+    finally:
+        profile_lock.release()
+    await ctx.send(
+        f"Collected {samples} samples. Open the file with flamegraph.pl or https://www.speedscope.app",
+        file=discord.File(io.BytesIO(collapsed.encode()), filename=f"profile-{int(time.time())}.folded")
+    )
+
+
+@bot.command(name='cluster', extras={'owner_only': True})
+@commands.is_owner()
+async def cluster_admin(ctx, command: str = None):
+    """Show per-cluster statistics or broadcast an admin command (bot owner only)"""
+    if command is not None:
+        if command not in CLUSTER_COMMANDS:
+            await ctx.send(f"❌ Unknown cluster command. Available: {', '.join(sorted(CLUSTER_COMMANDS))}")
+            return
+        if cluster is None:
+            await CLUSTER_COMMANDS[command]()
+            await ctx.send(f"✅ Ran `{command}`")
+        else:
+            sent = await cluster.request('broadcast', command=command)
+            await ctx.send(f"✅ Sent `{command}` to {sent} cluster(s)")
+        return
+
+    snapshots = {0: cluster_stats_snapshot()} if cluster is None else await cluster.request('cluster_stats')
+    embed = discord.Embed(title="🖧 Cluster", color=discord.Color.blue())
+    embed.add_field(
+        name="Totals",
+        value=(
+            f"Clusters: {len(snapshots)}\n"
+            f"Guilds: {sum(stats['guilds'] for stats in snapshots.values())}\n"
+            f"Players: {sum(stats['players'] for stats in snapshots.values())} "
+            f"({sum(stats['playing'] for stats in snapshots.values())} playing)\n"
+            f"Audio streams: {sum(stats['streams'] for stats in snapshots.values())}"
+        ),
+        inline=False
+    )
+    now = time.time()
+    lines = [
+        f"#{cluster_id} shards {format_shards(stats['shards'])}, pid {stats['pid']}: {stats['guilds']} guilds, "
+        f"{stats['playing']} playing, {stats['latency'] * 1000:.0f} ms, updated {now - stats['reported_at']:.0f}s ago"
+        for cluster_id, stats in sorted(snapshots.items())
+    ]
+    embed.add_field(name="Clusters", value="\n".join(lines) or "No clusters have reported yet", inline=False)
+    await ctx.send(embed=embed)
+
+
 @bot.command(name='help')
 async def help_command(ctx):
     """Show available commands"""
@@ -478,9 +5245,14 @@ async def help_command(ctx):
         ("!pause", "Pause the current song"),
         ("!resume / !r", "Resume the paused song"),
         ("!skip / !s", "Skip the current song"),
-        ("!queue / !q", "Show the current queue"),
+        ("!queue [page] / !q", "Show the current queue"),
         ("!clear", "Clear the queue"),
+        ("!remove <position> / !rm", "Remove a song from the queue"),
+        ("!move <from> <to> / !mv", "Move a song in the queue"),
+        ("!shuffle", "Shuffle the queue"),
         ("!volume <0-100> / !vol", "Set or show the volume"),
+        ("!bitrate <kbps>", "Set or show the audio bitrate (0 matches the voice channel)"),
+        ("!seek <time>", "Jump to a time in the current song (e.g. 1:30)"),
         ("!help", "Show this help message"),
     ]
     
@@ -493,6 +5265,7 @@ async def help_command(ctx):
 # ==================== SLASH COMMANDS ====================
 
 @tree.command(name="join", description="Join your voice channel")
+@app_commands.guild_only()
 async def slash_join(interaction: discord.Interaction):
     """Slash command to join voice channel"""
     if not interaction.user.voice:
@@ -501,161 +5274,245 @@ async def slash_join(interaction: discord.Interaction):
     
     channel = interaction.user.voice.channel
     try:
-        await music_player.join_voice_channel(channel)
+        player = players.get(interaction.guild_id)
+        await player.join_voice_channel(channel)
         await interaction.response.send_message(f"Joined {channel.name}")
     except Exception as e:
         await interaction.response.send_message(f"Failed to join voice channel: {e}", ephemeral=True)
 
 
 @tree.command(name="leave", description="Leave the voice channel")
+@app_commands.guild_only()
 async def slash_leave(interaction: discord.Interaction):
     """Slash command to leave voice channel"""
-    await music_player.leave_voice_channel()
+    await players.evict(interaction.guild_id)
     await interaction.response.send_message("Left the voice channel")
 
 
-@tree.command(name="play", description="Play a song from YouTube or other sources")
+@tree.command(name="play", description="Play a song or playlist from YouTube or other sources")
+@app_commands.guild_only()
 async def slash_play(interaction: discord.Interaction, query: str):
     """Slash command to play music"""
-    # Defer response IMMEDIATELY (must be within 3 seconds)
+    trace = tracer.start('/play', guild_id=interaction.guild_id, playlist=is_playlist_url(query))
     try:
-        await interaction.response.defer()
-    except (discord.errors.NotFound, discord.errors.InteractionResponded):
-        # Interaction already expired or responded to, just return
-        return
-    
-    # Check voice channel after deferring
-    if not interaction.user.voice:
+        # Defer response IMMEDIATELY (must be within 3 seconds)
         try:
-            await interaction.followup.send("You need to be in a voice channel to use this command!", ephemeral=True)
-        except:
-            pass
-        return
-    
-    # Join voice channel if not already connected
-    if not music_player.voice_client or not music_player.voice_client.is_connected():
-        channel = interaction.user.voice.channel
-        await music_player.join_voice_channel(channel)
-    
-    try:
-        # Extract video info
-        info = get_video_info(query)
-        
-        if not info:
-            await interaction.followup.send("❌ Could not find the requested song. Please try a different search term or URL.")
+            with trace.span('defer'):
+                await interaction.response.defer()
+        except (discord.errors.NotFound, discord.errors.InteractionResponded):
+            # Interaction already expired or responded to, just return
             return
         
-        # Check if this song will start playing immediately (before adding to queue)
-        will_play_now = not music_player.is_playing and music_player.voice_client and not music_player.voice_client.is_playing()
-        
-        # Add to queue
-        await music_player.add_to_queue(info['url'], info['title'])
-        
-        # Format duration
-        duration = info['duration']
-        minutes, seconds = divmod(duration, 60)
-        duration_str = f"{int(minutes)}:{int(seconds):02d}"
-        
-        embed = discord.Embed(
-            title="🎵 Added to Queue" if not will_play_now else "🎵 Now Playing",
-            description=f"**{info['title']}**",
-            color=discord.Color.green()
-        )
-        embed.add_field(name="Duration", value=duration_str, inline=True)
-        if not will_play_now:
-            embed.add_field(name="Position in Queue", value=len(music_player.queue), inline=True)
-        
-        if info['thumbnail']:
-            embed.set_thumbnail(url=info['thumbnail'])
-        
-        # Always show control buttons when there's music (playing or queued)
-        view = MusicPlayerControls()
-        await view.update_buttons()
+        # Check voice channel after deferring
+        if not interaction.user.voice:
+            try:
+                await interaction.followup.send("You need to be in a voice channel to use this command!", ephemeral=True)
+            except discord.HTTPException:
+                pass
+            return
         
-        msg = await interaction.followup.send(embed=embed, view=view)
+        try:
+            player = players.get(interaction.guild_id)
+            with trace.span('admit'):
+                await ffmpeg_supervisor.admit(player, timeout=FFMPEG_ADMIT_WAIT)
+        except (PlayerLimitReached, StreamLimitReached) as e:
+            await interaction.followup.send(f"❌ {e}. Please try again later.", ephemeral=True)
+            return
         
-        # Store control message reference
-        view.control_message = msg
+        # Join voice channel if not already connected
+        if not player.voice_client or not player.voice_client.is_connected():
+            channel = interaction.user.voice.channel
+            with trace.span('voice_connect'):
+                await player.join_voice_channel(channel)
         
-    except Exception as e:
-        await interaction.followup.send(f"❌ An error occurred: {str(e)}")
+        try:
+            is_alive = lambda: not interaction.is_expired() and player.voice_client is not None \
+                and player.voice_client.is_connected()
+            
+            if is_playlist_url(query):
+                will_play_now = not player.is_playing and player.voice_client and not player.voice_client.is_playing()
+                with trace.span('playlist'):
+                    ingest, first, error = await start_playlist(
+                        player, query, requester=interaction.user.id, is_alive=is_alive
+                    )
+                if error:
+                    await interaction.followup.send(error)
+                    return
+                
+                with trace.span('followup'):
+                    await interaction.followup.send(embed=build_playlist_embed(ingest, first, will_play_now))
+                    await player.panel.ensure(interaction.channel)
+                return
+            
+            # Extract video info in the resolver pool; give up if the interaction expires
+            info, error = await resolve_query(
+                query, guild_id=interaction.guild_id, is_alive=is_alive, user_id=interaction.user.id, trace=trace
+            )
+            
+            if error:
+                await interaction.followup.send(error)
+                return
+            
+            if not info:
+                await interaction.followup.send("❌ Could not find the requested song. Please try a different search term or URL.")
+                return
+            
+            # Check if this song will start playing immediately (before adding to queue)
+            will_play_now = not player.is_playing and player.voice_client and not player.voice_client.is_playing()
+            
+            # Add to queue
+            track = Track.from_info(info, requester=interaction.user.id)
+            if will_play_now:
+                track.trace = trace
+            with trace.span('queue_insert'):
+                await player.add_to_queue(track)
+            
+            # A song that starts right away turns the reply into the guild's now-playing panel
+            with trace.span('followup'):
+                if will_play_now:
+                    embed, view = await player.panel.render()
+                    msg = await interaction.followup.send(embed=embed, view=view)
+                    await player.panel.adopt(msg, refresh=False)
+                else:
+                    await interaction.followup.send(embed=build_added_embed(info, len(player.queue)))
+                    await player.panel.ensure(interaction.channel)
+            
+        except ResolverCancelled:
+            # The interaction expired or the bot left voice; nobody is waiting for the result
+            return
+        except QueueFull as e:
+            await interaction.followup.send(f"❌ {e}")
+        except Exception as e:
+            await interaction.followup.send(f"❌ An error occurred: {str(e)}")
+    finally:
+        trace.end()
+
+
+@slash_play.autocomplete('query')
+async def slash_play_autocomplete(interaction: discord.Interaction, current: str):
+    """Suggest songs from the local title index; a picked suggestion resolves by video ID"""
+    choices = []
+    for key, title, duration in title_index.search(current, interaction.guild_id):
+        url = video_key_url(key)
+        if len(url) > 100:
+            continue  # Discord limits choice values to 100 characters
+        suffix = f" ({format_duration(duration)})" if duration else ""
+        choices.append(app_commands.Choice(name=title[:100 - len(suffix)] + suffix, value=url))
+    return choices
 
 
 @tree.command(name="pause", description="Pause the current song")
+@app_commands.guild_only()
 async def slash_pause(interaction: discord.Interaction):
     """Slash command to pause music"""
-    if music_player.voice_client and music_player.voice_client.is_playing():
-        music_player.pause()
+    player = players.peek(interaction.guild_id)
+    if player and player.voice_client and player.voice_client.is_playing():
+        player.pause()
         await interaction.response.send_message("⏸️ Paused")
     else:
         await interaction.response.send_message("Nothing is currently playing", ephemeral=True)
 
 
 @tree.command(name="resume", description="Resume the paused song")
+@app_commands.guild_only()
 async def slash_resume(interaction: discord.Interaction):
     """Slash command to resume music"""
-    if music_player.voice_client and music_player.voice_client.is_paused():
-        music_player.resume()
+    player = players.peek(interaction.guild_id)
+    if player and player.voice_client and player.voice_client.is_paused():
+        player.resume()
         await interaction.response.send_message("▶️ Resumed")
     else:
         await interaction.response.send_message("Nothing is currently paused", ephemeral=True)
 
 
 @tree.command(name="skip", description="Skip the current song")
+@app_commands.guild_only()
 async def slash_skip(interaction: discord.Interaction):
     """Slash command to skip music"""
-    if music_player.voice_client and music_player.voice_client.is_playing():
-        music_player.voice_client.stop()
+    player = players.peek(interaction.guild_id)
+    if player and player.voice_client and player.voice_client.is_playing():
+        player.skip()
         await interaction.response.send_message("⏭️ Skipped")
     else:
         await interaction.response.send_message("Nothing is currently playing", ephemeral=True)
 
 
 @tree.command(name="queue", description="Show the current queue")
-async def slash_queue(interaction: discord.Interaction):
+@app_commands.guild_only()
+async def slash_queue(interaction: discord.Interaction, page: int = 1):
     """Slash command to show queue"""
-    if not music_player.current and len(music_player.queue) == 0:
+    player = players.peek(interaction.guild_id)
+    if not player or (not player.current and len(player.queue) == 0):
         await interaction.response.send_message("The queue is empty", ephemeral=True)
         return
     
-    embed = discord.Embed(title="📋 Music Queue", color=discord.Color.blue())
-    
-    if music_player.current:
-        embed.add_field(
-            name="🎵 Now Playing",
-            value=music_player.current['title'],
-            inline=False
-        )
-    
-    if len(music_player.queue) > 0:
-        queue_list = "\n".join([f"{i+1}. {song['title']}" for i, song in enumerate(music_player.queue[:10])])
-        if len(music_player.queue) > 10:
-            queue_list += f"\n... and {len(music_player.queue) - 10} more"
-        embed.add_field(name="Up Next", value=queue_list, inline=False)
-    
-    await interaction.response.send_message(embed=embed)
+    await interaction.response.send_message(embed=build_queue_embed(player, page))
 
 
 @tree.command(name="clear", description="Clear the queue")
+@app_commands.guild_only()
 async def slash_clear(interaction: discord.Interaction):
     """Slash command to clear queue"""
-    music_player.queue.clear()
+    player = players.peek(interaction.guild_id)
+    if player:
+        player.clear_queue()
     await interaction.response.send_message("🗑️ Queue cleared")
 
 
+@tree.command(name="remove", description="Remove a song from the queue")
+@app_commands.guild_only()
+async def slash_remove(interaction: discord.Interaction, position: int):
+    """Slash command to remove a song from the queue"""
+    player = players.peek(interaction.guild_id)
+    if not player or not 1 <= position <= len(player.queue):
+        await interaction.response.send_message("There is no song at that position in the queue", ephemeral=True)
+        return
+    
+    track = player.remove(position - 1)
+    await interaction.response.send_message(f"🗑️ Removed **{track.title}** from the queue")
+
+
+@tree.command(name="move", description="Move a song to another position in the queue")
+@app_commands.guild_only()
+async def slash_move(interaction: discord.Interaction, position: int, new_position: int):
+    """Slash command to move a song in the queue"""
+    player = players.peek(interaction.guild_id)
+    if not player or not 1 <= position <= len(player.queue) or not 1 <= new_position <= len(player.queue):
+        await interaction.response.send_message("There is no song at that position in the queue", ephemeral=True)
+        return
+    
+    track = player.move(position - 1, new_position - 1)
+    await interaction.response.send_message(f"↕️ Moved **{track.title}** to position {new_position}")
+
+
+@tree.command(name="shuffle", description="Shuffle the queue")
+@app_commands.guild_only()
+async def slash_shuffle(interaction: discord.Interaction):
+    """Slash command to shuffle the queue"""
+    player = players.peek(interaction.guild_id)
+    if not player or len(player.queue) < 2:
+        await interaction.response.send_message("Not enough songs in the queue to shuffle", ephemeral=True)
+        return
+    
+    player.shuffle()
+    await interaction.response.send_message("🔀 Queue shuffled")
+
+
 @tree.command(name="volume", description="Set or show the volume")
+@app_commands.guild_only()
 async def slash_volume(interaction: discord.Interaction, volume: int = None):
     """Slash command to set volume"""
+    player = players.peek(interaction.guild_id)
     if volume is None:
-        if music_player.voice_client and music_player.voice_client.source:
-            current_vol = int(music_player.voice_client.source.volume * 100)
+        if player and player.voice_client and player.voice_client.source:
+            current_vol = int(player.voice_client.source.volume * 100)
             await interaction.response.send_message(f"Current volume: {current_vol}%", ephemeral=True)
         else:
             await interaction.response.send_message("No audio source is currently playing", ephemeral=True)
     else:
         if 0 <= volume <= 100:
-            if music_player.voice_client and music_player.voice_client.source:
-                music_player.voice_client.source.volume = volume / 100
+            if player and player.voice_client and player.voice_client.source:
+                player.voice_client.source.volume = volume / 100
                 await interaction.response.send_message(f"🔊 Volume set to {volume}%")
             else:
                 await interaction.response.send_message("No audio source is currently playing", ephemeral=True)
@@ -663,12 +5520,64 @@ async def slash_volume(interaction: discord.Interaction, volume: int = None):
             await interaction.response.send_message("Volume must be between 0 and 100", ephemeral=True)
 
 
+@tree.command(name="bitrate", description="Set or show this server's audio bitrate")
+@app_commands.guild_only()
+async def slash_bitrate(interaction: discord.Interaction, kbps: int = None):
+    """Slash command to set the transcode bitrate"""
+    player = players.peek(interaction.guild_id)
+    if not player or not player.voice_client:
+        await interaction.response.send_message("Not connected to a voice channel", ephemeral=True)
+        return
+    if kbps is None:
+        mode = "set for this server" if player.bitrate_override else "matched to the voice channel"
+        await interaction.response.send_message(
+            f"🎚️ Bitrate: {player.target_bitrate(player.current.abr if player.current else None)} kbps ({mode})",
+            ephemeral=True
+        )
+        return
+    if kbps and not 32 <= kbps <= 512:
+        await interaction.response.send_message(
+            "Bitrate must be between 32 and 512 kbps, or 0 to match the voice channel", ephemeral=True
+        )
+        return
+    player.bitrate_override = kbps or None
+    await interaction.response.send_message(
+        f"🎚️ Bitrate set to {kbps} kbps" if kbps else "🎚️ Bitrate matched to the voice channel"
+    )
+    await player.adapt_bitrate()
+
+
+@tree.command(name="seek", description="Jump to a time in the current song")
+@app_commands.guild_only()
+async def slash_seek(interaction: discord.Interaction, position: str):
+    """Slash command to seek in the current song"""
+    seconds = parse_timestamp(position)
+    if seconds is None:
+        await interaction.response.send_message("Give the time as seconds, m:ss or h:mm:ss", ephemeral=True)
+        return
+    player = players.peek(interaction.guild_id)
+    if not player or not player.current:
+        await interaction.response.send_message("Nothing is playing right now", ephemeral=True)
+        return
+    if not player.current.duration or seconds >= player.current.duration:
+        await interaction.response.send_message(f"Can't seek to {format_duration(seconds)} in this song", ephemeral=True)
+        return
+    # Opening the stream at the new position can take a moment
+    await interaction.response.defer()
+    if await player.seek(seconds):
+        await interaction.followup.send(f"⏩ Jumped to {format_duration(seconds)}")
+    else:
+        await interaction.followup.send("❌ Could not seek in this song")
+
+
 @tree.command(name="help", description="Show available commands")
 async def slash_help(interaction: discord.Interaction):
     """Slash command to show help"""
     embed = discord.Embed(
         title="🎵 Music Bot Commands",
-        description="Commands for the high-quality audio streaming bot\n\n**Use `/` for slash commands or `!` for prefix commands**",
+        description="Commands for the high-quality audio streaming bot\n\n" + (
+            "**Use `/` for slash commands**" if LEAN_MODE else "**Use `/` for slash commands or `!` for prefix commands**"
+        ),
         color=discord.Color.blue()
     )
     
@@ -679,13 +5588,20 @@ async def slash_help(interaction: discord.Interaction):
         ("`/pause` or `!pause`", "Pause the current song"),
         ("`/resume` or `!resume`", "Resume the paused song"),
         ("`/skip` or `!skip`", "Skip the current song"),
-        ("`/queue` or `!queue`", "Show the current queue"),
+        ("`/queue [page]` or `!queue`", "Show the current queue"),
         ("`/clear` or `!clear`", "Clear the queue"),
+        ("`/remove <position>` or `!remove`", "Remove a song from the queue"),
+        ("`/move <from> <to>` or `!move`", "Move a song in the queue"),
+        ("`/shuffle` or `!shuffle`", "Shuffle the queue"),
         ("`/volume <0-100>` or `!volume`", "Set or show the volume"),
+        ("`/bitrate <kbps>` or `!bitrate`", "Set or show the audio bitrate (0 matches the voice channel)"),
+        ("`/seek <time>` or `!seek`", "Jump to a time in the current song (e.g. 1:30)"),
         ("`/help` or `!help`", "Show this help message"),
     ]
     
     for cmd, desc in commands_list:
+        if LEAN_MODE:
+            cmd = cmd.split(' or ')[0]  # no prefix commands to point at
         embed.add_field(name=cmd, value=desc, inline=False)
     
     await interaction.response.send_message(embed=embed, ephemeral=True)
@@ -708,5 +5624,14 @@ if __name__ == "__main__":
         print("Error: DISCORD_TOKEN not found in environment variables!")
         print("Please create a .env file with your Discord bot token.")
     else:
-        bot.run(TOKEN)
+        mark_startup('loaded')
+        try:
+            bot.run(TOKEN)
+        finally:
+            resolver.shutdown()
+            if _search_executor is not None:
+                _search_executor.shutdown(wait=False, cancel_futures=True)
+            resolve_cache.close()
+            audio_cache.close()
+            session_store.close()
 